@@ -0,0 +1,178 @@
+import collections
+import heapq
+import logging
+import struct
+import threading
+import time
+
+# img_access values: last access time, access count, image size.
+img_access_struct = struct.Struct('<dII')
+
+
+class ImgCacheManager(object):
+    """Keeps the lmdb image cache under a size budget.
+
+    Image accesses are recorded in memory, and written to the ``img_access`` database by ``flush_accesses``.
+    ``evict`` removes the least recently used (policy ``lru``) or least frequently used (policy ``lfu``) images until
+    the cache is under ``low_water`` of ``max_bytes``. ``max_bytes`` counts image bytes, not lmdb's overhead, so it
+    should be set well under the lmdb map size. These are blocking, so should be run in an executor.
+    """
+
+    policies = {
+        'lru': lambda item: item[1],
+        'lfu': lambda item: (item[2], item[1]),
+    }
+
+    def __init__(self, lmdb_env, img_db, max_bytes=None, policy='lru', low_water=0.9):
+        if policy not in self.policies:
+            raise ValueError('Unknown img cache eviction policy: {}'.format(policy))
+        self.lmdb_env = lmdb_env
+        self.img_db = img_db
+        self.access_db = lmdb_env.open_db(b'img_access')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.low_water = low_water
+
+        self.pending_accesses = {}
+        self.pending_accesses_lock = threading.Lock()
+        self.bytes = None
+        self.entries = None
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def record_access(self, key, size):
+        with self.pending_accesses_lock:
+            access_time, hits, _ = self.pending_accesses.get(key, (None, 0, None))
+            self.pending_accesses[key] = (time.time(), hits + 1, size)
+
+    def load(self):
+        """Add access records for images that don't have them (e.g. cached before they were recorded), and count
+        the size of the cache."""
+        with self.lmdb_env.begin(write=True) as tx:
+            img_stat = tx.stat(self.img_db)
+            if img_stat['entries'] != tx.stat(self.access_db)['entries']:
+                logging.info('Adding img cache access records.')
+                with tx.cursor(db=self.img_db) as cursor:
+                    for key, img in cursor:
+                        tx.put(key, img_access_struct.pack(0, 0, len(img)), db=self.access_db, overwrite=False)
+                with tx.cursor(db=self.access_db) as cursor:
+                    for key in list(cursor.iternext(values=False)):
+                        if tx.get(key, db=self.img_db) is None:
+                            tx.delete(key, db=self.access_db)
+        self.count()
+
+    def count(self):
+        """Count the size of the cache from the access records."""
+        entries = 0
+        size = 0
+        with self.lmdb_env.begin() as tx:
+            with tx.cursor(db=self.access_db) as cursor:
+                for key, value in cursor:
+                    entries += 1
+                    size += img_access_struct.unpack(value)[2]
+        self.entries = entries
+        self.bytes = size
+
+    def flush_accesses(self):
+        with self.pending_accesses_lock:
+            pending_accesses = self.pending_accesses
+            self.pending_accesses = {}
+        if not pending_accesses:
+            return
+        with self.lmdb_env.begin(write=True) as tx:
+            for key, (access_time, hits, size) in pending_accesses.items():
+                existing = tx.get(key, db=self.access_db)
+                if existing is None:
+                    self.entries += 1
+                    self.bytes += size
+                else:
+                    hits += img_access_struct.unpack(existing)[1]
+                tx.put(key, img_access_struct.pack(access_time, hits, size), db=self.access_db)
+
+    def evict(self):
+        """Evict images if over budget. Returns the number of images evicted."""
+        if self.max_bytes is None or self.bytes <= self.max_bytes:
+            return 0
+        to_free = self.bytes - self.max_bytes * self.low_water
+        sort_key = self.policies[self.policy]
+
+        with self.lmdb_env.begin(write=True) as tx:
+            with tx.cursor(db=self.access_db) as cursor:
+                items = ((key, *img_access_struct.unpack(value)) for key, value in cursor)
+                # Assume average size items to know how many to look at, and go round again if not enough.
+                n = max(int(to_free / (self.bytes / max(self.entries, 1))) + 1, 1)
+                candidates = heapq.nsmallest(n, items, key=sort_key)
+
+            evicted = 0
+            freed = 0
+            for key, access_time, hits, size in candidates:
+                if freed >= to_free:
+                    break
+                tx.delete(key, db=self.img_db)
+                tx.delete(key, db=self.access_db)
+                evicted += 1
+                freed += size
+
+        self.entries -= evicted
+        self.bytes -= freed
+        self.evictions += evicted
+        self.evicted_bytes += freed
+        logging.info('Evicted {} images ({} bytes) from img cache. Size now {} bytes.'.format(evicted, freed, self.bytes))
+        if evicted and self.bytes > self.max_bytes:
+            evicted += self.evict()
+        return evicted
+
+    def stats(self):
+        return {
+            'bytes': self.bytes,
+            'entries': self.entries,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+        }
+
+
+class LRUCache(object):
+    """In memory least recently used cache, limited by number of entries and the (approximate) size given for each
+    value."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value, size = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        if size > self.max_bytes:
+            return
+        self.items[key] = (value, size)
+        self.bytes += size
+        while len(self.items) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self.items.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def stats(self):
+        return {
+            'entries': len(self.items),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,129 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
+import struct
+
+import msgpack
+
+# Messages between worker processes are msgpack dicts, framed with a length header. The hub (the parent process)
+# relays each message from a worker to all the other workers. bytes in messages stay bytes.
+frame_header = struct.Struct('<I')
+
+
+async def read_frame(reader):
+    length, = frame_header.unpack(await reader.readexactly(frame_header.size))
+    return await reader.readexactly(length)
+
+
+def write_frame(writer, frame):
+    writer.write(frame_header.pack(len(frame)) + frame)
+
+
+async def run_hub(socks):
+    """Relay messages between the workers connected to socks, until they have all disconnected."""
+    streams = [await asyncio.open_unix_connection(sock=sock) for sock in socks]
+
+    async def relay(from_reader):
+        with contextlib.suppress(asyncio.IncompleteReadError, ConnectionError):
+            while True:
+                frame = await read_frame(from_reader)
+                for reader, writer in streams:
+                    if reader is not from_reader and not writer.transport.is_closing():
+                        write_frame(writer, frame)
+
+    try:
+        await asyncio.gather(*(relay(reader) for reader, writer in streams))
+    finally:
+        for reader, writer in streams:
+            writer.close()
+
+
+class ClusterClient(object):
+    """A worker's connection to the hub.
+
+    ``handle_message`` is a coroutine function called with each message published by the other workers. Messages are
+    handled one at a time, in the order they were published, so it should not wait for long.
+    """
+
+    def __init__(self, sock, handle_message, request_timeout=10):
+        self.sock = sock
+        self.handle_message = handle_message
+        self.request_timeout = request_timeout
+        self.request_ids = itertools.count()
+        self.pending_requests = {}
+
+    async def __aenter__(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(sock=self.sock)
+        self.read_fut = asyncio.ensure_future(self.read())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.read_fut.cancel()
+        try:
+            await self.read_fut
+        except asyncio.CancelledError:
+            pass
+        self.writer.close()
+
+    async def publish(self, msg):
+        write_frame(self.writer, msgpack.dumps(msg, use_bin_type=True))
+        await self.writer.drain()
+
+    def request(self, msg):
+        """Publish msg, and wait for a reply, published by another worker with ``reply``. Use as
+        ``async with client.request(msg) as reply:``. Messages that come after the reply are only handled once the
+        with block exits. Raises asyncio.TimeoutError if there is no reply."""
+        return ClusterRequest(self, msg)
+
+    async def reply(self, request, reply):
+        await self.publish({'reply_to': request['request_id'], 'reply': reply})
+
+    async def read(self):
+        while True:
+            try:
+                frame = await read_frame(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logging.error('Lost connection to cluster hub.')
+                return
+            msg = msgpack.loads(frame, raw=False)
+            if 'reply_to' in msg:
+                request = self.pending_requests.get(msg['reply_to'])
+                if request and not request.reply_fut.done():
+                    request.reply_fut.set_result(msg['reply'])
+                    # Not asyncio.wait_for, as that can swallow our cancellation if done is set at the same time.
+                    done_wait = asyncio.ensure_future(request.done.wait())
+                    try:
+                        await asyncio.wait([done_wait], timeout=self.request_timeout)
+                    finally:
+                        done_wait.cancel()
+                continue
+            try:
+                await self.handle_message(msg)
+            except Exception:
+                logging.exception('Error handling cluster message:')
+
+
+class ClusterRequest(object):
+
+    def __init__(self, client, msg):
+        self.client = client
+        self.request_id = '{}-{}'.format(os.getpid(), next(client.request_ids))
+        self.msg = dict(msg, request_id=self.request_id)
+        self.reply_fut = asyncio.get_event_loop().create_future()
+        self.done = asyncio.Event()
+
+    async def __aenter__(self):
+        self.client.pending_requests[self.request_id] = self
+        try:
+            await self.client.publish(self.msg)
+            return await asyncio.wait_for(self.reply_fut, self.client.request_timeout)
+        except BaseException:
+            del self.client.pending_requests[self.request_id]
+            self.done.set()
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        del self.client.pending_requests[self.request_id]
+        self.done.set()
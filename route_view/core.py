@@ -1,12 +1,18 @@
+import array
 import asyncio
 import collections
+import collections.abc
+import contextlib
 import functools
+import hashlib
 import itertools
 import json
 import logging
-import os
+import math
+import random
 import struct
 import threading
+import time
 import xml.etree.ElementTree as xml
 
 import aiohttp
@@ -17,11 +23,11 @@ from more_itertools import (
     chunked,
     peekable,
 )
+import numpy
 from numpy import (
     arccos,
     cross,
     deg2rad,
-    dot,
     rad2deg,
 )
 from nvector import (
@@ -30,8 +36,13 @@ from nvector import (
     unit,
 )
 
+from route_view.cache import ImgCacheManager, LRUCache
+from route_view.scheduler import ApiScheduler, CircuitBreaker, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
 from route_view.util import (
+    cancel_and_wait,
     id_decode,
+    id_encode,
+    iter_prefetched,
     runs_in_executor,
 )
 
@@ -62,15 +73,25 @@ class IndexedPoint(Point):
 
 
 route_meta_attrs = {'name', 'owner', 'private'}
-route_route_attrs = {'route_points', 'route_bounds', 'pano_chain'}
+route_route_attrs = {'route_points', 'route_bounds', 'pano_chain', 'route_detail'}
 route_status_attrs = {'processing_complete', 'processing_status'}
 route_meta_and_status_attrs = route_meta_attrs | route_status_attrs
+# Saved with the status, but not sent to clients.
+route_saved_status_attrs = route_status_attrs | {'panos_resets'}
+# Resets of panos remembered, so that clients that have panos from before them can be told where to reset to.
+panos_resets_kept = 16
+# Tolerances (meters) of the levels of detail route points are sent to clients at, coarsest first. The last has all
+# the points.
+route_detail_levels = (1000, 300, 100, 30, 10, 3, 0)
+# Clients are first sent the most detailed level with at most this many points.
+route_initial_max_points = 2000
 
 
 @attr.s
 class Route(object):
     id = attr.ib()
-    dir_route = attr.ib()
+    # RouteStore the route is saved in.
+    store = attr.ib()
     change_callback = attr.ib()
     name = attr.ib(default=None)
     owner = attr.ib(default=None)
@@ -82,78 +103,127 @@ class Route(object):
     route_points = attr.ib(default=None, init=False)
     route_bounds = attr.ib(default=None, init=False)
     panos = attr.ib(default=attr.Factory(list), init=False)
+    # Panos are only loaded for processing. See ensure_panos_loaded.
+    panos_loaded = attr.ib(default=False, init=False)
     pano_chain = attr.ib(default=attr.Factory(dict), init=False)
     panos_len_at_last_save = attr.ib(default=0, init=False)
+    # Changed by apply_remote_change since loaded, so may not match what is saved.
+    has_remote_changes = attr.ib(default=False, init=False)
+    # Each reset of panos starts a new epoch. List of [epoch, panos kept] for recent resets.
+    panos_resets = attr.ib(default=attr.Factory(list), init=False)
+    # Changes when route_points do, so that clients that already have them don't need them again.
+    route_version = attr.ib(default=None, init=False)
+    # See route_points_detail.
+    route_detail = attr.ib(default=None, init=False)
+    # Encoded route levels, by level.
+    route_levels_encoded = attr.ib(default=attr.Factory(dict), init=False, repr=False)
     save_processing_lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
     google_api = attr.ib(default=None)
+    # Number of api requests to run ahead of processing. 1 is strictly sequential.
+    pipeline_depth = attr.ib(default=1)
+    # If set, processing is started by the queue, rather than straight away.
+    processing_queue = attr.ib(default=None)
+    # Save progress at least this often (seconds) while processing.
+    checkpoint_interval = attr.ib(default=30)
+    # If set, a GeometryPool that the heavy geometry is run in.
+    geometry_pool = attr.ib(default=None)
+    # Long routes are split into up to this many segments (of at least min_segment_length meters,) which are
+    # processed at the same time.
+    segments = attr.ib(default=1)
+    min_segment_length = attr.ib(default=50000)
 
     @classmethod
     @runs_in_executor
-    def load(cls, id, dir_route, change_callback):
-        with open(os.path.join(dir_route, 'meta.json'), 'r') as f:
-            meta = json.load(f)
-        return Route(id, dir_route, change_callback, **meta)
+    def load(cls, id, store, change_callback):
+        meta = store.load(id, 'meta')
+        return Route(id, store, change_callback, **meta)
 
-    @runs_in_executor
-    def ensure_data_loaded(self):
-        # TODO resume processing if not complete
+    async def ensure_data_loaded(self):
         if not self.data_loaded:
-            with open(os.path.join(self.dir_route, 'route.pack'), 'rb') as f:
-                route = msgpack.unpack(f, encoding='utf-8')
-            route['route_points'] = route_with_distance_and_index(route['route_points'])
-
-            with open(os.path.join(self.dir_route, 'status.json'), 'r') as f:
-                status = json.load(f)
+            loop = asyncio.get_event_loop()
+            route, status = await loop.run_in_executor(None, self.load_data)
+            if self.geometry_pool:
+                route['route_points'] = await self.geometry_pool.route_with_distance_and_index(route['route_points'])
+            else:
+                route['route_points'] = await loop.run_in_executor(None, route_with_distance_and_index, route['route_points'])
+            route['route_version'] = route_points_version(route['route_points'])
+            # Routes saved before route_detail was added.
+            detail_saved = 'route_detail' in route
+            if detail_saved:
+                route['route_detail'] = numpy.frombuffer(route['route_detail'], dtype='<f4')
+            elif self.geometry_pool:
+                route['route_detail'] = await self.geometry_pool.run(
+                    route_points_detail, route['route_points'].lat, route['route_points'].lng)
+            else:
+                route['route_detail'] = await loop.run_in_executor(
+                    None, route_points_detail, route['route_points'].lat, route['route_points'].lng)
+            if self.data_loaded:
+                # Loaded, or new route points set, while we were busy.
+                return
 
             for k, v in itertools.chain(route.items(), status.items()):
                 setattr(self, k, v)
-
-            panos = []
-            with open(os.path.join(self.dir_route, 'panos.pack'), 'rb') as f:
-                unpacker = msgpack.Unpacker(f, encoding='utf-8')
-                while True:
-                    try:
-                        panos.append(unpacker.unpack())
-                    except msgpack.OutOfData:
-                        break
-            for pano in panos:
-                if pano['type'] == 'pano':
-                    pano['point'] = Point(*pano['point'])
-                    pano['original_point'] = Point(*pano['original_point'])
-                if pano['type'] == 'no_images':
-                    pano['start_point'] = Point(*pano['start_point'])
-                    pano['point'] = Point(*pano['point'])
-            self.panos = panos
+            self.panos = []
+            self.panos_len_at_last_save = 0
+            self.panos_loaded = False
 
             self.data_loaded = True
+            self.has_remote_changes = False
+            if not detail_saved:
+                await self.save_route()
+
+            queued = self.processing_queue is not None and self.processing_queue.has_job(self.id)
+            if self.processing_status.get('processing', True) and self.process_task is None and not queued:
+                await self.set_status({'text': 'Processing unexpectedly cancelled.', 'cancelable': False, 'resumable': True, 'processing': False})
+                await self.save_processing()
 
-            if self.processing_status.get('processing', True) and self.process_task is None:
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(self.set_status({'text': 'Processing unexpectedly cancelled.', 'cancelable': False, 'resumable': True, 'processing': False}))
-                self.save_processing.__wrapped__(self)
+    def load_data(self):
+        return self.store.load(self.id, 'route'), self.store.load(self.id, 'status')
+
+    @runs_in_executor
+    def ensure_panos_loaded(self):
+        """Load all the saved panos, which is only needed to process the route. Viewers load them in windows, with
+        load_panos_window."""
+        if not self.panos_loaded:
+            with self.save_processing_lock:
+                self.panos = self.store.load_panos(self.id, Point)
+                self.panos_len_at_last_save = len(self.panos)
+            if self.processing_complete and self.panos:
+                # May have been saved before it was marked.
+                self.panos[-1]['last'] = True
+            self.panos_loaded = True
 
     @runs_in_executor
     def save_metadata(self):
         meta = attr.asdict(self, filter=lambda a, v: a.name in route_meta_attrs)
-        with open(os.path.join(self.dir_route, 'meta.json'), 'w') as f:
-            json.dump(meta, f)
+        self.store.save(self.id, 'meta', meta)
 
     @runs_in_executor
     def save_route(self):
         def json_encode(obj):
             if isinstance(obj, Point):
                 return (obj.lat, obj.lng)
+            if isinstance(obj, RoutePoints):
+                return obj.lat_lng_list()
+            if isinstance(obj, numpy.ndarray):
+                return obj.astype('<f4').tobytes()
             if isinstance(obj, Route):
                 return attr.asdict(obj, recurse=False, filter=lambda a, v: a.name in route_route_attrs)
 
-        with open(os.path.join(self.dir_route, 'route.pack'), 'wb') as f:
-            msgpack.pack(self, f, default=json_encode)
+        self.store.save(self.id, 'route', self, default=json_encode)
+
+    async def load_panos_window(self, start_dist, end_dist):
+        """The panos with at_dist between start_dist and end_dist. If the panos are not loaded, only the saved blocks
+        with some in the window are read."""
+        if self.panos_loaded:
+            return [pano for pano in self.panos if start_dist <= pano.get('at_dist', -1) <= end_dist]
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self.store.load_panos_window, self.id, start_dist, end_dist, Point)
 
     @runs_in_executor
     def clear_saved_panos(self):
         with self.save_processing_lock:
-            with open(os.path.join(self.dir_route, 'panos.pack'), 'wb'):
-                pass
+            self.store.clear_panos(self.id)
             self.panos_len_at_last_save = 0
 
     @runs_in_executor
@@ -162,82 +232,203 @@ class Route(object):
             if isinstance(obj, Point):
                 return (obj.lat, obj.lng)
             if isinstance(obj, Route):
-                return attr.asdict(obj, recurse=False, filter=lambda a, v: a.name in route_status_attrs)
-
-        def panos_json_encode(obj):
-            if isinstance(obj, Point):
-                return (obj.lat, obj.lng)
+                return attr.asdict(obj, recurse=False, filter=lambda a, v: a.name in route_saved_status_attrs)
 
         with self.save_processing_lock:
-
-            with open(os.path.join(self.dir_route, 'status.json'), 'w') as f:
-                json.dump(self, f, default=state_json_encode)
-
             panos_to_append = self.panos[self.panos_len_at_last_save:]
-            if panos_to_append:
-                with open(os.path.join(self.dir_route, 'panos.pack'), 'ab') as f:
-                    for pano in self.panos[self.panos_len_at_last_save:]:
-                        msgpack.pack(pano, f, default=panos_json_encode)
-                self.panos_len_at_last_save = len(self.panos)
+            self.store.save_processing(self.id, self, panos_to_append, default=state_json_encode)
+            self.panos_len_at_last_save = len(self.panos)
 
     async def load_route_from_upload(self, upload):
-        if upload.startswith(b'<?xml'):
-            xml_doc = xml.fromstring(upload)
-            if xml_doc.tag in ('{http://www.topografix.com/GPX/1/1}gpx', '{http://www.topografix.com/GPX/1/0}gpx'):
-                await(self.load_gpx(xml_doc))
-        assert len(self.route_points) > 2
-
-    async def load_gpx(self, xml_doc):
-        gpx_ns = {
-            '1.0': {'gpx': 'http://www.topografix.com/GPX/1/0', },
-            '1.1': {'gpx': 'http://www.topografix.com/GPX/1/1', },
-        }[xml_doc.attrib['version']]
-
-        self.name = ', '.join((item.text for item in xml_doc.findall('./gpx:trk/gpx:name', gpx_ns)))
+        """Load the route from a GPX upload: bytes, or an async iterable of chunks of bytes. Chunks are parsed as they
+        come, off the event loop, so the whole document is never in memory. Raises GpxError if it's not a usable
+        GPX."""
+        loop = asyncio.get_event_loop()
+        parser = GpxParser()
+        if isinstance(upload, bytes):
+            await loop.run_in_executor(None, parser.feed, upload)
+        else:
+            async for chunk in upload:
+                await loop.run_in_executor(None, parser.feed, chunk)
+        name, lat, lng = await loop.run_in_executor(None, parser.close)
+        if len(lat) < 3:
+            raise GpxError('The GPX file has less than 3 track points.')
+
+        if name:
+            self.name = name
         await self.save_metadata()
 
-        trkpts = xml_doc.findall('./gpx:trk/gpx:trkseg/gpx:trkpt', gpx_ns)
-        points = route_with_distance_and_index((float(trkpt.attrib['lat']), float(trkpt.attrib['lon'])) for trkpt in trkpts)
+        if self.geometry_pool:
+            points = await self.geometry_pool.route_points_from_lat_lng(lat, lng)
+        else:
+            points = route_points_from_lat_lng(lat, lng)
         await self.set_route_points(points)
 
     async def set_route_points(self, points):
         if self.process_task:
             self.process_task.cancel()
             await self.process_task
+        if self.geometry_pool:
+            detail = await self.geometry_pool.run(route_points_detail, points.lat, points.lng)
+        else:
+            detail = route_points_detail(points.lat, points.lng)
         self.route_points = points
+        self.route_version = route_points_version(points)
+        self.route_detail = detail
+        self.route_levels_encoded = {}
         self.route_bounds = dict(
-            north=max((p.lat for p in self.route_points)),
-            south=min((p.lat for p in self.route_points)),
-            east=max((p.lng for p in self.route_points)),
-            west=min((p.lng for p in self.route_points)),
+            north=float(points.lat.max()),
+            south=float(points.lat.min()),
+            east=float(points.lng.max()),
+            west=float(points.lng.min()),
         )
         await self.reset_processed()
+        self.panos_loaded = True
         self.data_loaded = True
         self.processing_complete = False
-        await self.change_callback({'route_bounds': self.route_bounds, 'route_points': self.route_points, 'route_distance': self.route_points[-1].distance})
+        await self.change_callback(self.route_points_change())
         await self.save_route()
 
-    def get_existing_changes(self):
+    def route_points_change(self, level=None):
+        """The route, with the points of a level of detail. By default, the most detailed level with at most
+        route_initial_max_points points."""
+        if level is None:
+            level = 0
+            while level + 1 < len(route_detail_levels) and \
+                    (self.route_detail >= route_detail_levels[level + 1]).sum() <= route_initial_max_points:
+                level += 1
+        polyline, indexes = self.route_level_encoded(level)
+        return {'route_bounds': self.route_bounds, 'route_distance': self.route_points[-1].distance, 'route_version': self.route_version,
+                'route_detail_levels': route_detail_levels, 'route_level': level,
+                'route_polyline': polyline, 'route_indexes': indexes}
+
+    def route_level_encoded(self, level):
+        """The points of a level of detail, as an encoded polyline, and their indexes in route_points, delta
+        encoded the same way."""
+        try:
+            return self.route_levels_encoded[level]
+        except KeyError:
+            indexes = numpy.flatnonzero(self.route_detail >= route_detail_levels[level])
+            lat = numpy.round(self.route_points.lat[indexes] * 1e5).astype(numpy.int64)
+            lng = numpy.round(self.route_points.lng[indexes] * 1e5).astype(numpy.int64)
+            encoded = self.route_levels_encoded[level] = (polyline_encode(lat, lng), polyline_encode(indexes))
+            return encoded
+
+    def get_existing_changes(self, route_version=None, panos_epoch=None, panos_count=0, saved_panos_count=None):
+        """Changes to bring a client up to date. A client that has the route_points of route_version, and
+        panos_count panos of panos_epoch, is only sent what it does not have. If the panos are not loaded, pass
+        saved_panos_count from load_panos_count.
+
+        Panos are only sent if the route is being processed here, as then new ones are sent as they come. Otherwise,
+        the client is told to load them in windows (see load_panos_window), so that it can start showing a long route
+        without all of it being loaded."""
         yield attr.asdict(self, filter=lambda a, v: a.name in route_meta_and_status_attrs)
-        if self.route_points:
-            yield {'route_bounds': self.route_bounds, 'route_points': self.route_points, 'route_distance': self.route_points[-1].distance}
-        if self.panos:
-            for chunk in chunked(self.panos, 500):
+        if self.route_points and route_version != self.route_version:
+            yield self.route_points_change()
+        have_count = len(self.panos) if self.panos_loaded else saved_panos_count
+        kept = self.panos_kept_since(panos_epoch, panos_count, have_count)
+        if kept < panos_count:
+            yield {'reset_panos_index': kept - 1, 'panos_epoch': self.panos_epoch}
+        elif panos_epoch != self.panos_epoch:
+            yield {'panos_epoch': self.panos_epoch}
+        if self.process_task is not None:
+            for chunk in chunked(self.panos[kept:], 500):
                 yield {'panos': chunk}
+        else:
+            yield {'panos_windowed': True}
+        if self.processing_complete and have_count:
+            yield {'last_pano_index': have_count - 1}
+
+    @runs_in_executor
+    def load_panos_count(self):
+        """How many panos are saved."""
+        return self.store.panos_count(self.id)
+
+    @property
+    def panos_epoch(self):
+        return self.panos_resets[-1][0] if self.panos_resets else 0
+
+    def panos_kept_since(self, panos_epoch, panos_count, have_count):
+        """How many of panos_count panos, from panos_epoch, are still the same as the have_count we have."""
+        if panos_epoch is None or panos_epoch > self.panos_epoch:
+            return 0
+        if panos_epoch < self.panos_epoch:
+            later_kept = [kept for epoch, kept in self.panos_resets if epoch > panos_epoch]
+            if len(later_kept) < self.panos_epoch - panos_epoch:
+                # Reset more times than we remember.
+                return 0
+            panos_count = min([panos_count] + later_kept)
+        # We may have fewer, if processing was interrupted before they were saved.
+        return min(panos_count, have_count)
+
+    async def reset_panos(self, keep):
+        """Remove the panos after the first keep, and tell clients."""
+        self.panos = self.panos[:keep]
+        self.panos_resets = (self.panos_resets + [[self.panos_epoch + 1, keep]])[-panos_resets_kept:]
+        await self.clear_saved_panos()
+        await self.save_processing()
+        await self.change_callback({'reset_panos_index': keep - 1, 'panos_epoch': self.panos_epoch})
+
+    def apply_remote_change(self, change):
+        """Update this copy of the route with a change (as decoded from msgpack) made by another process that is
+        processing it, rather than loading it all again."""
+        for key in route_meta_and_status_attrs & change.keys():
+            setattr(self, key, change[key])
+        if not self.data_loaded:
+            return
+        self.has_remote_changes = True
+        if 'route_version' in change:
+            # Clients are sent simplified route points, so we can't use them. Load the route again when next needed.
+            self.data_loaded = False
+            return
+        if 'reset_panos_index' in change:
+            keep = change['reset_panos_index'] + 1
+            self.panos = self.panos[:keep]
+            self.panos_resets = (self.panos_resets + [[change['panos_epoch'], keep]])[-panos_resets_kept:]
+        if not self.panos_loaded:
+            return
+        if 'panos' in change and 'panos_window' not in change:
+            self.panos.extend(
+                {key: Point(value['lat'], value['lng']) if isinstance(value, dict) and value.keys() == {'lat', 'lng'} else value
+                 for key, value in pano.items()}
+                for pano in change['panos'])
+        if change.get('last_pano_index', len(self.panos)) < len(self.panos):
+            self.panos[change['last_pano_index']]['last'] = True
+        # They are saved by the process that made them.
+        self.panos_len_at_last_save = len(self.panos)
 
     async def start_processing(self):
+        if self.has_remote_changes:
+            # Carry on from what was saved, which may be behind what we were sent, if the process that was processing
+            # it stopped before saving.
+            self.data_loaded = False
+            await self.ensure_data_loaded()
+        await self.ensure_panos_loaded()
+        if self.process_task:
+            return
         self.process_task = asyncio.ensure_future(self.process())
         self.process_task.add_done_callback(self.process_task_done_callback)
 
     async def cancel_processing(self):
         if self.process_task:
-            self.process_task.cancel()
+            process_task = self.process_task
+            process_task.cancel()
+            # Wait for it to finish saving.
+            await asyncio.wait([process_task])
+        elif self.processing_queue and await self.processing_queue.remove(self.id):
+            await self.set_status({'text': 'Processing cancelled.', 'cancelable': False, 'resumable': True, 'processing': False})
 
     async def resume_processing(self):
-        if not self.process_task:
+        if self.process_task:
+            return
+        if self.processing_queue:
+            await self.set_status({'text': 'Waiting to be processed.', 'cancelable': True, 'resumable': False, 'processing': True})
+            await self.processing_queue.enqueue(self.id)
+        else:
             await self.start_processing()
 
     async def add_pano_chain_item(self, src, dest):
+        await self.ensure_panos_loaded()
         self.pano_chain[src] = dest
         for i, pano in enumerate(self.panos):
             if pano.get('id') == src:
@@ -248,11 +439,7 @@ class Route(object):
         if i is not None:
             await self.cancel_processing()
 
-            self.panos = self.panos[:i + 1]
-            await self.clear_saved_panos()
-            await self.save_processing()
-            await self.change_callback({'reset_panos_index': i})
-
+            await self.reset_panos(i + 1)
             await self.resume_processing()
 
     async def set_status(self, status):
@@ -267,223 +454,637 @@ class Route(object):
         self.process_task = None
 
     async def reset_processed(self):
-        self.panos = []
-        await self.clear_saved_panos()
-        await self.save_processing()
-        await self.change_callback({'reset_panos_index': -1})
+        await self.reset_panos(0)
+
+    def make_segments(self, start_index, start_distance):
+        """Split the route from ``start_distance`` into up to ``self.segments`` segments, of at least
+        ``self.min_segment_length``. Segments after the first start at a route point."""
+        remaining = self.route_points[-1].distance - start_distance
+        n = max(1, min(self.segments, int(remaining // self.min_segment_length)))
+        segments = [ProcessSegment(index=0, start_index=start_index)]
+        for i in range(1, n):
+            index = int(numpy.searchsorted(self.route_points.distance, start_distance + remaining * i / n))
+            if index <= segments[-1].start_index or index >= len(self.route_points) - 1:
+                continue
+            segment = ProcessSegment(index=len(segments), start_index=index)
+            segments[-1].next = segment
+            segments[-1].stop_distance = float(self.route_points.distance[index])
+            segments.append(segment)
+        return segments
 
     async def process(self):
         google_api = self.google_api
         await self.set_status({'text': 'Downloading street view image metadata.', 'cancelable': True, 'resumable': False, 'processing': True})
+        last_save_task = None
+        send_changes_task = None
+        prefetch_tasks = set()
         try:
 
             if not self.panos:
-                last_pano = None
-                last_point_index = 0
-                last_point = self.route_points[0]
-                last_at_distance = 0
-                last_pano_data = None
-                no_pano_link = True
+                start_state = dict(
+                    last_pano=None,
+                    last_point_index=0,
+                    last_point=self.route_points[0],
+                    last_at_distance=0,
+                    last_pano_data=None,
+                    no_pano_link=True,
+                )
             else:
                 last_pano = self.panos[-1]
-                last_point_index = last_pano['prev_route_index']
-                last_point = last_pano['point']
-                last_at_distance = last_pano['at_dist']
+                start_state = dict(
+                    last_pano=last_pano,
+                    last_point_index=last_pano['prev_route_index'],
+                    last_point=last_pano['point'],
+                    last_at_distance=last_pano['at_dist'],
+                )
                 if last_pano['type'] == 'pano':
-                    last_pano_data = await google_api.get_pano_id(last_pano['id'])
-                    no_pano_link = False
+                    start_state.update(last_pano_data=await google_api.get_pano_id(last_pano['id'], client=self.id), no_pano_link=False)
                 else:
-                    last_pano_data = None
-                    no_pano_link = True
-            panos_ids = collections.deque([pano['id'] for pano in self.panos if 'id' in pano][:-10], 10)
+                    start_state.update(last_pano_data=None, no_pano_link=True)
+            start_state['panos_ids'] = collections.deque([pano['id'] for pano in self.panos if 'id' in pano][:-10], 10)
 
-            last_save_task = None
+            last_save_time = time.monotonic()
             inverse_line_cached = functools.lru_cache(32)(geodesic.InverseLine)
 
-            new_panos = []
-            has_new_panos = asyncio.Event()
+            segments = self.make_segments(start_state['last_point_index'], start_state['last_at_distance'])
+            segments_changed = asyncio.Event()
 
             async def send_changes():
-                nonlocal new_panos
+                nonlocal last_save_task, last_save_time
+                # Segments are joined up in order. Panos of the segment at the head are sent as they come, and
+                # panos of segments further on are sent as segment_panos, so clients can show the progress.
+                head = segments[0]
+                committed = 0
+                previewed = [0] * len(segments)
                 while True:
                     await asyncio.sleep(0.2)
-                    await has_new_panos.wait()
-                    has_new_panos.clear()
-                    self.panos.extend(new_panos)
-                    await self.change_callback({'panos': new_panos})
-                    new_panos = []
+                    await segments_changed.wait()
+                    segments_changed.clear()
 
-                    if self.processing_complete:
+                    new_panos = []
+                    complete = False
+                    while True:
+                        if head.next is None:
+                            new_panos.extend(head.panos[committed:])
+                            committed = len(head.panos)
+                            complete = head.done
+                            break
+                        stop = committed
+                        while stop < len(head.panos) and head.panos[stop]['at_dist'] < head.stop_distance:
+                            stop += 1
+                        new_panos.extend(head.panos[committed:stop])
+                        committed = stop
+                        next_segment = head.next
+                        # Wait till next has got as far as head has, so we can find where they join.
+                        if not head.done or not (next_segment.done or not head.panos or (
+                                next_segment.panos and next_segment.panos[-1]['at_dist'] >= head.panos[-1]['at_dist'])):
+                            break
+                        stop, next_start = join_segments(head, next_segment, committed)
+                        new_panos.extend(head.panos[committed:stop])
+                        logging.debug('Joined processing segments {} and {} at {}, {}.'.format(head.index, next_segment.index, stop, next_start))
+                        head = next_segment
+                        committed = next_start
+
+                    if new_panos:
+                        self.panos.extend(new_panos)
+                        await self.change_callback({'panos': new_panos})
+                    if complete and self.panos:
+                        # The tail may have been sent already, so mark it separately.
+                        self.panos[-1]['last'] = True
+                        await self.change_callback({'last_pano_index': len(self.panos) - 1})
+
+                    for segment in segments[head.index + 1:]:
+                        if len(segment.panos) > previewed[segment.index]:
+                            await self.change_callback({'segment_panos': segment.panos[previewed[segment.index]:], 'segment': segment.index})
+                            previewed[segment.index] = len(segment.panos)
+
+                    if complete:
                         break
 
+                    unsaved_panos = len(self.panos) - self.panos_len_at_last_save
+                    if (not last_save_task or last_save_task.done()) and (
+                            unsaved_panos > 100 or
+                            (unsaved_panos and time.monotonic() - last_save_time > self.checkpoint_interval)):
+                        if last_save_task:
+                            await asyncio.shield(last_save_task)
+                        last_save_task = asyncio.ensure_future(self.save_processing())
+                        last_save_time = time.monotonic()
+
             send_changes_task = asyncio.ensure_future(send_changes())
 
-            while True:
-                if no_pano_link:
-                    points_with_set_spacing = iter_route_points_with_set_spacing(
-                        inverse_line_cached, [last_point] + self.route_points[last_point_index + 1:],
-                        spacing=itertools.chain(itertools.repeat(10, 4), itertools.repeat(20, 3),
-                                                itertools.repeat(60, 10), itertools.repeat(100, 10),
-                                                itertools.repeat(200)))
-                    if last_point == self.route_points[0]:
-                        points_with_set_spacing = itertools.chain(((last_point, last_point, 0, 10), ), points_with_set_spacing)
-
-                    points_with_set_spacing_for_no_images = peekable(iter_route_points_with_set_spacing(
-                        inverse_line_cached, [last_point] + self.route_points[last_point_index + 1:],
-                        spacing=20))
-
-                    no_image_start_point = last_point
-                    no_image_start_index = last_point_index + 1
-                    no_image_start_distance = last_at_distance
-
-                    for point, last_route_point, dist_from_last, point_dist in points_with_set_spacing:
-                        radius = round(point_dist * 0.75)
-                        logging.debug("Get pano at {} radius={}".format(point, radius))
-                        pano_data = await google_api.get_pano_ll(point, radius=radius)
-
-                        if dist_from_last > 80:
-                            try:
-                                while points_with_set_spacing_for_no_images.peek()[2] <= dist_from_last:
-                                    no_image_point = next(points_with_set_spacing_for_no_images)
-                                    last_point_index = (no_image_point[1].index if isinstance(no_image_point[1], IndexedPoint) else last_point_index)
-                                    no_images_item = dict(
-                                        type='no_images', point=no_image_point[0],
-                                        prev_route_index=last_point_index + 1,
-                                        at_dist=no_image_point[2] + no_image_start_distance, dist_from_last=no_image_point[3],
-                                        start_point=no_image_start_point, start_route_index=no_image_start_index,
-                                        start_dist_from=no_image_point[2],
-                                    )
-                                    new_panos.append(no_images_item)
-                                    has_new_panos.set()
-                                    last_pano = no_images_item
-                                    last_pano_data = None
-                                    last_point = no_image_point[0]
-                                    last_at_distance = no_image_point[2] + no_image_start_distance
-                            except StopIteration:
-                                pass
-                        if pano_data and pano_data['Location']['panoId'] not in panos_ids:
-                            no_pano_link = False
-                            break
-                    else:
-                        break
-                    del points_with_set_spacing
+            async def get_pano_ll(item):
+                point, last_route_point, dist_from_last, point_dist = item
+                radius = round(point_dist * 0.75)
+                logging.debug("Get pano at {} radius={}".format(point, radius))
+                return await google_api.get_pano_ll(point, radius=radius, client=self.id)
+
+            # Fetch pano data ahead of the loop below, following the link that goes the way the route does from each
+            # accepted pano, for up to pipeline_depth - 1 hops. Links that turn off (side streets) are not followed.
+            # The loop then gets them from the api's cache.
+
+            def prefetch_ahead(pano_data, yaw, hops, panos_ids):
+                if hops <= 0:
+                    return
+                pano_id = pano_data['Location']['panoId']
+                if pano_id in self.pano_chain:
+                    link_id, link_yaw = self.pano_chain[pano_id], yaw
                 else:
-                    if last_pano['id'] in self.pano_chain:
-                        link_pano_id = self.pano_chain[last_pano['id']]
-                    else:
-                        if last_point_index + 2 == len(self.route_points) and distance(last_point, self.route_points[-1]) < 10:
-                            break
-                        yaw_to_next = get_azimuth_to_distance_on_route(inverse_line_cached, last_point, self.route_points[last_point_index + 1:], 10)
-                        yaw_diff = lambda item: abs(deg_wrap_to_closest(float(item['yawDeg']) - yaw_to_next, 0))
-                        links = last_pano_data.get('Links')
-                        if links:
-                            pano_link = min(links, key=yaw_diff)
-
-                            if yaw_diff(pano_link) > 15:
-                                logging.debug("Yaw too different: {} {} {}".format(yaw_diff(pano_link), pano_link['yawDeg'], yaw_to_next))
-                                link_pano_id = None
+                    yaw_diff = lambda item: abs(deg_wrap_to_closest(float(item['yawDeg']) - yaw, 0))
+                    links = pano_data.get('Links')
+                    if not links:
+                        return
+                    link = min(links, key=yaw_diff)
+                    if yaw_diff(link) > 15:
+                        return
+                    link_id, link_yaw = link['panoId'], float(link['yawDeg'])
+                if link_id in panos_ids:
+                    return
+                task = asyncio.ensure_future(google_api.get_pano_id(link_id, client=self.id))
+                prefetch_tasks.add(task)
+                task.add_done_callback(functools.partial(prefetch_ahead_done, link_yaw, hops - 1, panos_ids))
+
+            def prefetch_ahead_done(yaw, hops, panos_ids, task):
+                prefetch_tasks.discard(task)
+                if not task.cancelled() and task.exception() is None and task.result():
+                    prefetch_ahead(task.result(), yaw, hops, panos_ids)
+
+            async def crawl(segment, last_pano, last_point_index, last_point, last_at_distance, last_pano_data, no_pano_link, panos_ids):
+                # Crawl from the given state till the end of the route, or for segments with a next segment, till we
+                # get to a pano it has, or segment_max_overlap past it's start.
+                if segment.next is not None:
+                    max_distance = segment.stop_distance + segment_max_overlap
+                else:
+                    max_distance = None
+                start_point = self.route_points[segment.start_index if segment.index else 0]
+
+                while True:
+                    if no_pano_link:
+                        points_with_set_spacing = iter_route_points_with_set_spacing(
+                            inverse_line_cached, RouteSlice(self.route_points, last_point_index + 1, last_point),
+                            spacing=itertools.chain(itertools.repeat(10, 4), itertools.repeat(20, 3),
+                                                    itertools.repeat(60, 10), itertools.repeat(100, 10),
+                                                    itertools.repeat(200)))
+                        if last_point == start_point:
+                            points_with_set_spacing = itertools.chain(((last_point, last_point, 0, 10), ), points_with_set_spacing)
+
+                        points_with_set_spacing_for_no_images = peekable(iter_route_points_with_set_spacing(
+                            inverse_line_cached, RouteSlice(self.route_points, last_point_index + 1, last_point),
+                            spacing=20))
+
+                        no_image_start_point = last_point
+                        no_image_start_index = last_point_index + 1
+                        no_image_start_distance = last_at_distance
+
+                        pano_lls = iter_prefetched(points_with_set_spacing, get_pano_ll, self.pipeline_depth)
+                        try:
+                            async for (point, last_route_point, dist_from_last, point_dist), pano_data in pano_lls:
+                                if max_distance is not None and no_image_start_distance + dist_from_last > max_distance:
+                                    pano_data = None
+                                    break
+                                if dist_from_last > 80:
+                                    try:
+                                        while points_with_set_spacing_for_no_images.peek()[2] <= dist_from_last:
+                                            no_image_point = next(points_with_set_spacing_for_no_images)
+                                            last_point_index = (no_image_point[1].index if isinstance(no_image_point[1], IndexedPoint) else last_point_index)
+                                            no_images_item = dict(
+                                                type='no_images', point=no_image_point[0],
+                                                prev_route_index=last_point_index + 1,
+                                                at_dist=no_image_point[2] + no_image_start_distance, dist_from_last=no_image_point[3],
+                                                start_point=no_image_start_point, start_route_index=no_image_start_index,
+                                                start_dist_from=no_image_point[2],
+                                            )
+                                            segment.add(no_images_item)
+                                            segments_changed.set()
+                                            last_pano = no_images_item
+                                            last_pano_data = None
+                                            last_point = no_image_point[0]
+                                            last_at_distance = no_image_point[2] + no_image_start_distance
+                                    except StopIteration:
+                                        pass
+                                if pano_data and pano_data['Location']['panoId'] not in panos_ids:
+                                    no_pano_link = False
+                                    break
                             else:
-                                link_pano_id = pano_link['panoId']
+                                break
+                        finally:
+                            await pano_lls.aclose()
+                        del points_with_set_spacing
+                        if no_pano_link:
+                            # Got to max_distance.
+                            break
+                    else:
+                        if last_pano['id'] in self.pano_chain:
+                            link_pano_id = self.pano_chain[last_pano['id']]
                         else:
-                            link_pano_id = None
+                            if last_point_index + 2 == len(self.route_points) and distance(last_point, self.route_points[-1]) < 10:
+                                break
+                            yaw_to_next = get_azimuth_to_distance_on_route(
+                                inverse_line_cached, RouteSlice(self.route_points, last_point_index + 1, last_point), 10)
+                            yaw_diff = lambda item: abs(deg_wrap_to_closest(float(item['yawDeg']) - yaw_to_next, 0))
+                            links = last_pano_data.get('Links')
+                            if links:
+                                pano_link = min(links, key=yaw_diff)
+
+                                if yaw_diff(pano_link) > 15:
+                                    logging.debug("Yaw too different: {} {} {}".format(yaw_diff(pano_link), pano_link['yawDeg'], yaw_to_next))
+                                    link_pano_id = None
+                                else:
+                                    link_pano_id = pano_link['panoId']
+                            else:
+                                link_pano_id = None
+
+                        if link_pano_id:
+                            no_pano_link = False
+                            # logging.debug("Getting pano form link: {} -> {}".format(last_pano['id'], link_pano_id))
+                            pano_data = await google_api.get_pano_id(link_pano_id, client=self.id)
 
-                    if link_pano_id:
-                        no_pano_link = False
-                        # logging.debug("Getting pano form link: {} -> {}".format(last_pano['id'], link_pano_id))
-                        pano_data = await google_api.get_pano_id(link_pano_id)
+                            if not pano_data:
+                                # What????
+                                no_pano_link = True
 
-                        if not pano_data:
-                            # What????
+                        else:
                             no_pano_link = True
+                            pano_data = None
+
+                    if pano_data:
+                        location = pano_data['Location']
+                        pano_point = Point(lat=float(location['lat']), lng=float(location['lng']))
+                        route_slice = RouteSlice(self.route_points, last_point_index + 1, last_point)
+                        if self.geometry_pool:
+                            point_pair, c_point, dist = await self.geometry_pool.find_closest_point_pair(route_slice, pano_point)
+                        else:
+                            point_pair, c_point, dist = find_closest_point_pair(route_slice, pano_point)
+
+                        if dist > 25:
+                            logging.debug("Distance {} to nearest point too great for pano: {}"
+                                          .format(dist, location['panoId']))
+                            last_pano = None
+                            no_pano_link = True
+                        else:
+                            heading = get_azimuth_to_distance_on_route(
+                                inverse_line_cached, RouteSlice(self.route_points, point_pair[1].index, c_point), 50)
+                            heading = round(heading, 1) % 360
+                            c_point_dist = point_pair[1].distance - distance(point_pair[1], c_point)
+                            distance_from_last = c_point_dist - last_at_distance
+
+                            pano = dict(
+                                type='pano', id=location['panoId'], point=pano_point, original_point=pano_point,
+                                description=location['description'], prev_route_index=point_pair[1].index - 1, heading=heading,
+                                at_dist=c_point_dist, dist_from_last=distance_from_last)
+                            segment.add(pano)
+                            segments_changed.set()
+                            panos_ids.append(pano['id'])
+
+                            # logging.debug("Got pano {} {}".format(pano_point, location['description']))
+                            last_pano = pano
+                            last_pano_data = pano_data
+                            prefetch_ahead(pano_data, heading, self.pipeline_depth - 1, panos_ids)
+                            last_point_index = point_pair[1].index - 1
+                            last_point = c_point
+                            last_at_distance = c_point_dist
+
+                            if segment.next is not None and last_at_distance >= segment.stop_distance and pano['id'] in segment.next.pano_ids:
+                                # Joined up with the next segment.
+                                break
+
+                    if last_point == self.route_points[-1]:
+                        break
+                    if max_distance is not None and last_at_distance > max_distance:
+                        break
+
+                if segment.next is None and self.route_points[-1].distance - last_at_distance > 100:
+                    segment.add(dict(
+                        type='no_images',
+                        start_point=last_point.to_point(), start_index=last_point_index + 1,
+                        end_point=self.route_points[-1].to_point(), end_index=len(self.route_points) - 2,
+                        start_distance=last_pano['at_distance'] + 1, end_distance=self.route_points[-1].distance,
+                    ))
+                segment.done = True
+                segments_changed.set()
+
+            crawl_tasks = [asyncio.ensure_future(crawl(segments[0], **start_state))]
+            for segment in segments[1:]:
+                start_point = self.route_points[segment.start_index]
+                crawl_tasks.append(asyncio.ensure_future(crawl(
+                    segment, last_pano=None, last_point_index=segment.start_index, last_point=start_point,
+                    last_at_distance=start_point.distance, last_pano_data=None, no_pano_link=True,
+                    panos_ids=collections.deque(maxlen=10))))
+            if len(segments) > 1:
+                logging.info('Processing route {} in {} segments.'.format(self.id, len(segments)))
+            try:
+                await asyncio.gather(*crawl_tasks)
+            finally:
+                for task in crawl_tasks:
+                    task.cancel()
 
-                    else:
-                        no_pano_link = True
-                        pano_data = None
-
-                if pano_data:
-                    location = pano_data['Location']
-                    pano_point = Point(lat=float(location['lat']), lng=float(location['lng']))
-                    point_pair, c_point, dist = find_closest_point_pair([last_point] + self.route_points[last_point_index + 1:], pano_point)
-
-                    if dist > 25:
-                        logging.debug("Distance {} to nearest point too great for pano: {}"
-                                      .format(dist, location['panoId']))
-                        last_pano = None
-                        no_pano_link = True
-                    else:
-                        heading = get_azimuth_to_distance_on_route(inverse_line_cached, c_point, self.route_points[point_pair[1].index:], 50)
-                        heading = round(heading, 1) % 360
-                        c_point_dist = point_pair[1].distance - distance(point_pair[1], c_point)
-                        distance_from_last = c_point_dist - last_at_distance
-
-                        pano = dict(
-                            type='pano', id=location['panoId'], point=pano_point, original_point=pano_point,
-                            description=location['description'], prev_route_index=point_pair[1].index - 1, heading=heading,
-                            at_dist=c_point_dist, dist_from_last=distance_from_last)
-                        new_panos.append(pano)
-                        has_new_panos.set()
-                        panos_ids.append(pano['id'])
-
-                        # logging.debug("Got pano {} {}".format(pano_point, location['description']))
-                        last_pano = pano
-                        last_pano_data = pano_data
-                        last_point_index = point_pair[1].index - 1
-                        last_point = c_point
-                        last_at_distance = c_point_dist
-
-                        if (not last_save_task or last_save_task.done()) and len(self.panos) - self.panos_len_at_last_save > 100:
-                            if last_save_task:
-                                await asyncio.shield(last_save_task)
-                            last_save_task = asyncio.ensure_future(self.save_processing())
-
-                if last_point == self.route_points[-1]:
-                    break
-
-            if self.route_points[-1].distance - last_at_distance > 100:
-                new_panos.append(dict(
-                    type='no_images',
-                    start_point=last_point.to_point(), start_index=last_point_index + 1,
-                    end_point=self.route_points[-1].to_point(), end_index=len(self.route_points) - 2,
-                    start_distance=last_pano['at_distance'] + 1, end_distance=self.route_points[-1].distance,
-                ))
-                has_new_panos.set()
-
-            new_panos[-1]['last'] = True
-            self.processing_complete = True
             await send_changes_task
+            self.processing_complete = True
             await self.set_status({'text': 'Complete', 'cancelable': False, 'resumable': False, 'processing': False})
         except asyncio.CancelledError:
-            send_changes_task.cancel()
-            try:
-                await send_changes_task
-            except asyncio.CancelledError:
-                pass
+            await cancel_and_wait(send_changes_task)
             logging.info('Processing cancelled.')
             await self.set_status({'text': 'Processing cancelled.', 'cancelable': False, 'resumable': True, 'processing': False})
         except Exception as e:
             logging.exception('Processing error: ')
+            await cancel_and_wait(send_changes_task)
             await self.set_status({'text': 'Processing error: {}'.format(e), 'cancelable': False, 'resumable': True, 'processing': False})
         finally:
+            for task in list(prefetch_tasks):
+                task.cancel()
             if last_save_task:
                 await asyncio.shield(last_save_task)
             await asyncio.shield(self.save_processing())
 
 
-def route_with_distance_and_index(route):
-    dist = 0
-    previous_point = None
+# How far past it's end a segment is processed, to find a pano to join it to the next segment with.
+segment_max_overlap = 1000
+
+
+@attr.s
+class ProcessSegment(object):
+    """A part of a route that is processed at the same time as the others, starting at route point
+    ``start_index``. Processing stops after ``stop_distance`` (where ``next`` starts,) once it finds a pano that
+    ``next`` has."""
+    index = attr.ib()
+    start_index = attr.ib()
+    stop_distance = attr.ib(default=None)
+    next = attr.ib(default=None, repr=False)
+    panos = attr.ib(default=attr.Factory(list), repr=False)
+    pano_ids = attr.ib(default=attr.Factory(dict), repr=False)
+    done = attr.ib(default=False)
+
+    def add(self, pano):
+        if pano['type'] == 'pano':
+            self.pano_ids.setdefault(pano['id'], len(self.panos))
+        self.panos.append(pano)
+
+
+def join_segments(segment, next_segment, committed):
+    """Work out where segment's panos join next_segment's panos. Returns ``(stop, next_start)``, to join
+    ``segment.panos[:stop]`` to ``next_segment.panos[next_start:]``. The first of segment's panos from
+    ``committed - 1`` that next_segment has is used. If there isn't one, they are joined at the start of
+    next_segment."""
+    for i in range(max(committed - 1, 0), len(segment.panos)):
+        pano = segment.panos[i]
+        if pano['type'] == 'pano' and pano['id'] in next_segment.pano_ids:
+            return i + 1, next_segment.pano_ids[pano['id']] + 1
+    if not next_segment.panos:
+        return len(segment.panos), 0
+    next_first = next_segment.panos[0]
+    stop = committed
+    while stop < len(segment.panos) and segment.panos[stop]['at_dist'] < next_first['at_dist']:
+        stop += 1
+    if stop and 'dist_from_last' in next_first:
+        next_segment.panos[0] = dict(next_first, dist_from_last=next_first['at_dist'] - segment.panos[stop - 1]['at_dist'])
+    return stop, 0
+
+
+class GpxError(Exception):
+    pass
+
+
+gpx_namespaces = ('http://www.topografix.com/GPX/1/1', 'http://www.topografix.com/GPX/1/0')
+
+
+class GpxParser(object):
+    """Incremental GPX parser. Feed it the document in chunks, then close() it for ``(name, lat, lng)``: the track
+    names, joined, and arrays of the track points.
+
+    Points are collected into arrays as they are parsed, and elements are dropped once they have ended, so memory
+    used is about that of the points, not of the document. Raises GpxError.
+    """
+
+    def __init__(self):
+        self.parser = xml.XMLPullParser(events=('start', 'end'))
+        self.ns = None
+        self.path = []
+        self.elements = []
+        self.names = []
+        self.lat = array.array('d')
+        self.lng = array.array('d')
+
+    def feed(self, data):
+        try:
+            self.parser.feed(data)
+            self.read_events()
+        except xml.ParseError as e:
+            raise GpxError('Could not parse the GPX file: {}'.format(e))
+
+    def close(self):
+        try:
+            self.parser.close()
+            self.read_events()
+        except xml.ParseError as e:
+            raise GpxError('Could not parse the GPX file: {}'.format(e))
+        if self.ns is None:
+            raise GpxError('Not a GPX file.')
+        return ', '.join(self.names), numpy.frombuffer(self.lat), numpy.frombuffer(self.lng)
+
+    def read_events(self):
+        for event, element in self.parser.read_events():
+            ns, _, tag = element.tag[1:].rpartition('}')
+            if event == 'start':
+                if self.ns is None:
+                    if ns not in gpx_namespaces or tag != 'gpx':
+                        raise GpxError('Not a GPX file.')
+                    self.ns = ns
+                self.path.append(tag if ns == self.ns else None)
+                self.elements.append(element)
+            else:
+                path = tuple(self.path)
+                if path == ('gpx', 'trk', 'trkseg', 'trkpt'):
+                    try:
+                        self.lat.append(float(element.attrib['lat']))
+                        self.lng.append(float(element.attrib['lon']))
+                    except (KeyError, ValueError):
+                        raise GpxError('Track point without a valid lat and lon.')
+                elif path == ('gpx', 'trk', 'name') and element.text:
+                    self.names.append(element.text)
+                self.path.pop()
+                self.elements.pop()
+                if self.elements:
+                    # Drop ended elements, so that the tree does not grow. Earlier siblings have already been
+                    # dropped, so this is cheap.
+                    self.elements[-1].remove(element)
+
+
+def route_with_distance_and_index(route, exact=False):
+    lat_lng = numpy.fromiter(itertools.chain.from_iterable(route), dtype=float).reshape((-1, 2))
+    return route_points_from_lat_lng(numpy.ascontiguousarray(lat_lng[:, 0]), numpy.ascontiguousarray(lat_lng[:, 1]), exact)
+
+
+def route_points_from_lat_lng(lat, lng, exact=False):
+    distances = numpy.zeros(len(lat))
+    distances[1:] = segment_distances(lat, lng, exact=exact)
+
+    return RoutePoints(lat=lat, lng=lng, distance=numpy.cumsum(distances),
+                       nv=lat_lon2n_E(deg2rad(lat), deg2rad(lng)))
+
+
+def route_points_version(route_points):
+    """A hash of the route points' locations."""
+    digest = hashlib.sha1(numpy.ascontiguousarray(route_points.lat).tobytes() + numpy.ascontiguousarray(route_points.lng).tobytes()).digest()
+    return id_encode(digest[:16]).decode('ascii')
+
+
+def route_points_detail(lat, lng):
+    """How much detail each route point adds: the Douglas-Peucker tolerance (meters) below which the point is kept.
+    So the points with detail >= a tolerance are that tolerance's simplification. The first and last points are
+    inf. Distances are on an equirectangular projection, which is close enough for this."""
+    n = len(lat)
+    detail = numpy.zeros(n)
+    if n == 0:
+        return detail
+    detail[0] = detail[-1] = numpy.inf
+    y = deg2rad(lat) * earth_radius
+    x = deg2rad(lng) * earth_radius * math.cos(math.radians(float(lat.mean())))
+    todo = [(0, n - 1, numpy.inf)]
+    while todo:
+        start, end, parent_detail = todo.pop()
+        if end - start < 2:
+            continue
+        px = x[start + 1:end] - x[start]
+        py = y[start + 1:end] - y[start]
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        length = math.hypot(dx, dy)
+        if length:
+            dist = numpy.abs(dx * py - dy * px) / length
+        else:
+            dist = numpy.hypot(px, py)
+        i = int(dist.argmax())
+        mid = start + 1 + i
+        # A point is never kept at a tolerance its parent is not.
+        detail[mid] = min(dist[i], parent_detail)
+        todo.append((start, mid, detail[mid]))
+        todo.append((mid, end, detail[mid]))
+    return detail
+
+
+def polyline_encode(*columns):
+    """Encode int columns in the encoded polyline format: values are the difference from the value before, in
+    zigzag, 5 bit chunks, with the columns interleaved. With lat and lng * 1e5 this is Google's encoded polyline."""
+    deltas = numpy.diff(numpy.stack(columns).astype(numpy.int64), axis=1, prepend=0).T.ravel()
+    values = (deltas << 1) ^ (deltas >> 63)
+    # Up to 13 chunks of 5 bits, least significant first. Chunks other than the last of a value have 0x20 set.
+    shifts = numpy.arange(13) * 5
+    chunks = (values[:, None] >> shifts) & 0x1f
+    n_chunks = numpy.maximum(1, (values[:, None] >> shifts != 0).sum(axis=1))
+    keep = numpy.arange(13) < n_chunks[:, None]
+    chunks[numpy.arange(13) < n_chunks[:, None] - 1] |= 0x20
+    return (chunks[keep] + 63).astype(numpy.uint8).tobytes().decode('ascii')
+
+
+@attr.s(slots=True, cmp=False)
+class RoutePoints(collections.abc.Sequence):
+    """Route points stored as columns of float64 arrays.
+
+    ``lat``, ``lng`` and ``distance`` (cumulative distance along the route) have shape (n, ), and ``nv`` is the
+    3 x n array of n-vectors. Items are IndexedPoint, created on demand.
+    """
+    lat = attr.ib()
+    lng = attr.ib()
+    distance = attr.ib()
+    nv = attr.ib()
+    _segment_index = attr.ib(default=None, init=False, repr=False)
+    # Copy in shared memory, for GeometryPool.
+    _shared = attr.ib(default=None, init=False, repr=False)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('RoutePoints index out of range')
+        return IndexedPoint(lat=float(self.lat[i]), lng=float(self.lng[i]), nv=self.nv[:, i:i + 1],
+                            index=i, distance=float(self.distance[i]))
+
+    def __iter__(self):
+        for i, (lat, lng, dist) in enumerate(zip(self.lat.tolist(), self.lng.tolist(), self.distance.tolist())):
+            yield IndexedPoint(lat=lat, lng=lng, nv=self.nv[:, i:i + 1], index=i, distance=dist)
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def nv_array(self, start, stop):
+        return self.nv[:, start:stop]
+
+    def lat_lng_list(self):
+        return numpy.column_stack((self.lat, self.lng)).tolist()
+
+    @property
+    def segment_index(self):
+        """SegmentIndex of this route's segments, built on first use."""
+        if self._segment_index is None:
+            self._segment_index = SegmentIndex.build(self.nv)
+        return self._segment_index
+
+
+@attr.s(slots=True, cmp=False)
+class RouteSlice(collections.abc.Sequence):
+    """A read only view of ``points[start:stop]``, with ``first_point`` in front of it.
 
-    def get_point(i, point):
-        nonlocal dist
-        nonlocal previous_point
-        point = IndexedPoint(*point, index=i)
-        if previous_point:
-            dist += distance(previous_point, point)
-        point.distance = dist
-        previous_point = point
-        return point
+    Equivalent to ``[first_point] + points[start:stop]``, without copying ``points``.
+    """
+    points = attr.ib()
+    start = attr.ib()
+    first_point = attr.ib()
+    stop = attr.ib(default=None)
 
-    return [get_point(i, point) for i, point in enumerate(route)]
+    @property
+    def end(self):
+        return len(self.points) if self.stop is None else self.stop
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('RouteSlice index out of range')
+        if i == 0:
+            return self.first_point
+        return self.points[self.start + i - 1]
+
+    def __iter__(self):
+        yield self.first_point
+        points = self.points
+        for i in range(self.start, self.end):
+            yield points[i]
+
+    def pair_at_distance(self, dist):
+        """Find the pair of points that is ``dist`` along this slice. ``self.points`` must be RoutePoints.
+
+        Returns ``(i, pair_start_distance)`` for the pair ``(self[i], self[i + 1])``, or None if ``dist`` is past the
+        end of the slice. Only the first pair's length is calculated, the rest are found by binary search of the
+        cumulative distances.
+        """
+        points = self.points
+        if self.start >= self.end:
+            return None
+        first_pair_distance = distance(self.first_point, points[self.start])
+        if dist <= first_pair_distance:
+            return 0, 0
+        route_dist = dist - first_pair_distance + points.distance[self.start]
+        k = max(int(numpy.searchsorted(points.distance, route_dist)), self.start + 1)
+        if k >= self.end:
+            return None
+        return k - self.start, first_pair_distance + points.distance[k - 1] - points.distance[self.start]
+
+    def nv_array(self, start, stop):
+        nv = points_nv_array(self.points, self.start + max(start - 1, 0), self.start + stop - 1)
+        if start == 0:
+            nv = numpy.hstack((self.first_point.nv, nv))
+        return nv
 
 
 def pairs(items):
@@ -494,46 +1095,292 @@ def pairs(items):
         item1 = item2
 
 
-def find_closest_point_pair(points, to_point, req_min_dist=20, stop_after_dist=50):
-    tpn = to_point.nv
-    min_distance = None
-    min_point_pair = None
-    min_c_point = None
-    for point1, point2 in pairs(points):
-        p1 = point1.nv
-        p2 = point2.nv
-        c12 = cross(p1, p2, axis=0)
-        ctp = cross(tpn, c12, axis=0)
-        c = unit(cross(ctp, c12, axis=0))
-        p1h = p1.reshape((3, ))
-        p2h = p2.reshape((3, ))
-        dp1p2 = arccos(dot(p1h, p2h))
-
-        sutable_c = None
-        for co in (c, 0 - c):
-            co_rs = co.reshape((3, ))
-            dp1co = arccos(dot(p1h, co_rs))
-            dp2co = arccos(dot(p2h, co_rs))
-            if abs(dp1co + dp2co - dp1p2) < 0.000001:
-                sutable_c = co
-                break
+# Mean earth radius, used to turn n-vector angles into approximate distances when ranking candidates.
+earth_radius = 6371008.8
 
-        if sutable_c is not None:
-            c_point_lat, c_point_lng = n_E2lat_lon(sutable_c)
-            c_point = Point(lat=rad2deg(c_point_lat[0]), lng=rad2deg(c_point_lng[0]))
-            c_dist = distance(to_point, c_point)
+
+def points_nv_array(points, start=0, stop=None):
+    """Return the n-vectors of ``points[start:stop]`` as a 3 x n array.
+
+    Uses the precomputed n-vectors of ``points`` if it has them (e.g. RoutePoints, RouteSlice.)
+    """
+    if stop is None:
+        stop = len(points)
+    if hasattr(points, 'nv_array'):
+        return points.nv_array(start, stop)
+    points = points[start:stop]
+    lats = numpy.fromiter((point.lat for point in points), dtype=float)
+    lngs = numpy.fromiter((point.lng for point in points), dtype=float)
+    return lat_lon2n_E(deg2rad(lats), deg2rad(lngs))
+
+
+def nv_angle(nv1, nv2):
+    """Angle between n-vectors. Unlike arccos of the dot product, this stays accurate for very small angles."""
+    return numpy.arctan2(numpy.linalg.norm(cross(nv1, nv2, axis=0), axis=0), (nv1 * nv2).sum(axis=0))
+
+
+def closest_points_on_segments(nv1, nv2, tpn):
+    """Project ``tpn`` onto the great circle segments ``nv1[:, i]`` -> ``nv2[:, i]``.
+
+    All inputs are 3 x n n-vector arrays (``tpn`` may be 3 x 1). Returns the closest point on each segment as a
+    3 x n array, and the angular distance from ``tpn`` to it. Where the projection does not fall on the segment,
+    the closer of the two segment ends is used.
+    """
+    c12 = cross(nv1, nv2, axis=0)
+    ctp = cross(tpn, c12, axis=0)
+    c = unit(cross(ctp, c12, axis=0))
+    dp1p2 = arccos(numpy.clip((nv1 * nv2).sum(axis=0), -1, 1))
+
+    # Zero length segments have no great circle. Leave them to fall back to the segment ends.
+    has_circle = numpy.any(c12 != 0, axis=0)
+    sutable_c = numpy.full_like(c, numpy.nan)
+    for co in (c, 0 - c):
+        dp1co = arccos(numpy.clip((nv1 * co).sum(axis=0), -1, 1))
+        dp2co = arccos(numpy.clip((nv2 * co).sum(axis=0), -1, 1))
+        on_segment = has_circle & (numpy.abs(dp1co + dp2co - dp1p2) < 0.000001) & numpy.isnan(sutable_c[0])
+        sutable_c[:, on_segment] = co[:, on_segment]
+
+    d1 = nv_angle(nv1, tpn)
+    d2 = nv_angle(nv2, tpn)
+    dc = nv_angle(sutable_c, tpn)
+
+    no_c = numpy.isnan(sutable_c[0])
+    closest = numpy.where(no_c, numpy.where(d2 < d1, 2, 1), 0)
+    c_nv = numpy.where(closest == 0, sutable_c, numpy.where(closest == 1, nv1, nv2))
+    c_angle = numpy.where(closest == 0, dc, numpy.minimum(d1, d2))
+    return c_nv, c_angle, closest
+
+
+# Cells keys pack 3 signed cell coordinates into 21 bits each.
+segment_index_cell_bits = 21
+segment_index_cell_offset = 1 << (segment_index_cell_bits - 1)
+segment_index_offsets = numpy.array(list(itertools.product(range(3), repeat=3))).T
+
+
+@attr.s(slots=True, cmp=False)
+class SegmentIndex(object):
+    """Grid spatial index of route segments, for finding the segments near a point.
+
+    The grid is over n-vector (unit sphere earth centred) space, so it has no problems at the poles or antimeridian.
+    Segments are split into pieces no longer than half a cell, and each piece is added to all the cells its bounding
+    box overlaps. ``cell_keys`` is sorted, and the segments in cell ``cell_keys[i]`` are
+    ``segment_ids[cell_starts[i]:cell_starts[i + 1]]``.
+    """
+    nv = attr.ib(repr=False)
+    cell_size = attr.ib()
+    cell_keys = attr.ib(repr=False)
+    cell_starts = attr.ib(repr=False)
+    segment_ids = attr.ib(repr=False)
+
+    @classmethod
+    def build(cls, nv, cell_size=100):
+        """Build an index of the segments between the points of the 3 x n array ``nv``. ``cell_size`` is in meters."""
+        assert cell_size >= 10, 'cell_size too small for cell key packing.'
+        cell = cell_size / earth_radius
+        nv1 = nv[:, :-1]
+        nv2 = nv[:, 1:]
+        chords = numpy.linalg.norm(nv2 - nv1, axis=0)
+        n_pieces = numpy.maximum(numpy.ceil(chords / (cell / 2)), 1).astype(int)
+
+        piece_segment = numpy.repeat(numpy.arange(len(n_pieces)), n_pieces)
+        piece_i = numpy.arange(len(piece_segment)) - numpy.repeat(numpy.cumsum(n_pieces) - n_pieces, n_pieces)
+        t1 = piece_i / n_pieces[piece_segment]
+        t2 = (piece_i + 1) / n_pieces[piece_segment]
+        seg_nv1 = nv1[:, piece_segment]
+        seg_d = nv2[:, piece_segment] - seg_nv1
+        piece_nv1 = unit(seg_nv1 + seg_d * t1)
+        piece_nv2 = unit(seg_nv1 + seg_d * t2)
+
+        # Pad for the arc bulging out from the chord between the piece ends.
+        pad = cell * 0.01
+        lo = numpy.floor((numpy.minimum(piece_nv1, piece_nv2) - pad) / cell).astype(numpy.int64)
+        hi = numpy.floor((numpy.maximum(piece_nv1, piece_nv2) + pad) / cell).astype(numpy.int64)
+
+        cells = lo[:, :, None] + segment_index_offsets[:, None, :]
+        valid = (cells <= hi[:, :, None]).all(axis=0)
+        keys = cls.cell_key(cells[:, valid])
+        segments = numpy.broadcast_to(piece_segment[:, None], valid.shape)[valid]
+
+        order = numpy.lexsort((segments, keys))
+        keys = keys[order]
+        segments = segments[order]
+        is_new = numpy.ones(len(keys), dtype=bool)
+        is_new[1:] = (keys[1:] != keys[:-1]) | (segments[1:] != segments[:-1])
+        keys = keys[is_new]
+        segments = segments[is_new]
+        cell_keys, cell_starts = numpy.unique(keys, return_index=True)
+        cell_starts = numpy.append(cell_starts, len(keys))
+        return cls(nv=nv, cell_size=cell_size, cell_keys=cell_keys, cell_starts=cell_starts, segment_ids=segments)
+
+    @staticmethod
+    def cell_key(cells):
+        cells = cells + segment_index_cell_offset
+        return (cells[0] << (2 * segment_index_cell_bits)) | (cells[1] << segment_index_cell_bits) | cells[2]
+
+    @property
+    def n_segments(self):
+        return self.nv.shape[1] - 1
+
+    def segment_distances(self, to_point, segments):
+        """Spherical distance from ``to_point`` to each of ``segments``."""
+        c_nv, c_angle, closest = closest_points_on_segments(self.nv[:, segments], self.nv[:, segments + 1], to_point.nv)
+        return c_angle * earth_radius
+
+    def candidates(self, to_point, radius):
+        """Segments in the cells within ``radius`` meters of ``to_point``. Includes some further segments."""
+        cell = self.cell_size / earth_radius
+        # Chords are shorter than arcs, so this covers at least radius.
+        tpn = to_point.nv
+        lo = numpy.floor((tpn - radius / earth_radius) / cell).astype(numpy.int64)
+        hi = numpy.floor((tpn + radius / earth_radius) / cell).astype(numpy.int64)
+        if numpy.prod(hi - lo + 1) > len(self.cell_keys):
+            return numpy.arange(self.n_segments)
+
+        cells = numpy.stack(numpy.meshgrid(*(numpy.arange(low, high + 1) for low, high in zip(lo[:, 0], hi[:, 0])),
+                                           indexing='ij')).reshape((3, -1))
+        keys = self.cell_key(cells)
+        i = numpy.searchsorted(self.cell_keys, keys)
+        found = i < len(self.cell_keys)
+        found[found] = self.cell_keys[i[found]] == keys[found]
+        if not found.any():
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate([self.segment_ids[self.cell_starts[j]:self.cell_starts[j + 1]] for j in i[found]]))
+
+    def within(self, to_point, radius, start=0, stop=None):
+        """Segments with index in ``[start, stop)`` that are within ``radius`` meters of ``to_point``, sorted by index."""
+        stop = self.n_segments if stop is None else stop
+        segments = self.candidates(to_point, radius)
+        segments = segments[(segments >= start) & (segments < stop)]
+        return segments[self.segment_distances(to_point, segments) <= radius]
+
+    def nearest(self, to_point, k=1, start=0, stop=None):
+        """The ``k`` segments with index in ``[start, stop)`` nearest to ``to_point``, sorted by distance."""
+        stop = self.n_segments if stop is None else stop
+        radius = self.cell_size
+        while True:
+            segments = self.candidates(to_point, radius)
+            segments = segments[(segments >= start) & (segments < stop)]
+            distances = self.segment_distances(to_point, segments)
+            exhaustive = len(segments) == stop - start
+            if exhaustive or (distances <= radius).sum() >= k:
+                order = numpy.argsort(distances, kind='stable')[:k]
+                return segments[order]
+            radius *= 4
+
+
+# Spherical and ellipsoidal distances can differ by up to ~0.7%. Candidates this close to the spherical minimum are
+# re-ranked by geodesic distance.
+closest_candidate_rel_tol = 0.01
+closest_candidate_abs_tol = 0.01
+
+
+def find_closest_point_pair(points, to_point, req_min_dist=20, stop_after_dist=50, chunk_size=64):
+    """Find the segment of ``points`` closest to ``to_point``.
+
+    The search stops at the first segment further than ``stop_after_dist`` once a segment closer than
+    ``req_min_dist`` has been seen. For a RouteSlice over RoutePoints, the route's SegmentIndex is used to only look
+    at segments near ``to_point``, otherwise all segments are scanned in order.
+
+    Returns ``((point1, point2), closest_point, distance)``.
+    """
+    if isinstance(points, RouteSlice) and isinstance(points.points, RoutePoints):
+        return find_closest_point_pair_indexed(points, to_point, req_min_dist, stop_after_dist)
+    return scan_closest_point_pair(points, to_point, req_min_dist, stop_after_dist, chunk_size)
+
+
+def find_closest_point_pair_indexed(route_slice, to_point, req_min_dist=20, stop_after_dist=50):
+    """find_closest_point_pair for a RouteSlice, using the route's SegmentIndex.
+
+    Segments further than ``stop_after_dist`` can never be the closest, and after a segment closer than
+    ``req_min_dist`` has been seen, the first of them ends the search. So only the runs of consecutive segments that
+    are near ``to_point`` need to be scanned.
+    """
+    route_points = route_slice.points
+    # The slice's first pair is part of the route segment before it's start.
+    first_segment = route_slice.start - 1
+    stop_segment = route_slice.end - 1
+    if first_segment >= stop_segment:
+        return None, None, None
+
+    segment_index = route_points.segment_index
+    radius = stop_after_dist * (1 + closest_candidate_rel_tol) + closest_candidate_abs_tol
+    segments = segment_index.within(to_point, radius, first_segment, stop_segment)
+    if not len(segments):
+        # Nothing is near, so the scan would not stop early, and which is closest depends on the slice's partial first
+        # pair, and on the geodesic distances of the candidates. Leave it to the scan.
+        return scan_closest_point_pair(route_slice, to_point, req_min_dist, stop_after_dist)
+
+    result = (None, None, None)
+    run_breaks = numpy.flatnonzero(numpy.diff(segments) != 1) + 1
+    for run in numpy.split(segments, run_breaks):
+        run_start = int(run[0])
+        run_stop = int(run[-1]) + 2
+        if run_start == first_segment:
+            run_points = RouteSlice(route_points, route_slice.start, route_slice.first_point, stop=run_stop)
         else:
-            c_dist, c_point = min(((distance(to_point, p), p) for p in (point1, point2)))
+            run_points = RouteSlice(route_points, run_start + 1, route_points[run_start], stop=run_stop)
+        run_result = scan_closest_point_pair(run_points, to_point, req_min_dist, stop_after_dist)
+        if run_result[2] is not None and (result[2] is None or run_result[2] < result[2]):
+            result = run_result
+        if result[2] is not None and result[2] < req_min_dist:
+            break
+    if result[2] is None or result[2] > stop_after_dist:
+        # Only the full segment of the slice's partial first pair was near.
+        return scan_closest_point_pair(route_slice, to_point, req_min_dist, stop_after_dist)
+    return result
+
 
-        if min_distance is None or c_dist < min_distance:
-            min_distance = c_dist
-            min_point_pair = (point1, point2)
-            min_c_point = c_point
+def scan_closest_point_pair(points, to_point, req_min_dist=20, stop_after_dist=50, chunk_size=64):
+    """Find the segment of ``points`` closest to ``to_point``, scanning the segments in order.
 
-        if min_distance < req_min_dist and c_dist > stop_after_dist:
+    Segments are projected in batches of ``chunk_size``, and ranked by spherical distance. The search stops at the
+    first segment further than ``stop_after_dist`` once a segment closer than ``req_min_dist`` has been seen. Only
+    the candidates that are near the spherical minimum have their geodesic distance calculated.
+
+    Returns ``((point1, point2), closest_point, distance)``.
+    """
+    tpn = to_point.nv
+    n_segments = len(points) - 1
+    min_distance = None
+    candidates = []
+
+    for chunk_start in range(0, n_segments, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, n_segments)
+        nv = points_nv_array(points, chunk_start, chunk_end + 1)
+        c_nv, c_angle, closest = closest_points_on_segments(nv[:, :-1], nv[:, 1:], tpn)
+        c_dist = c_angle * earth_radius
+
+        running_min = numpy.minimum.accumulate(c_dist)
+        if min_distance is not None:
+            running_min = numpy.minimum(running_min, min_distance)
+        stop = numpy.flatnonzero((running_min < req_min_dist) & (c_dist > stop_after_dist))
+        if len(stop):
+            c_dist = c_dist[:stop[0] + 1]
+
+        chunk_min = c_dist.min()
+        if min_distance is None or chunk_min < min_distance:
+            min_distance = chunk_min
+        near = numpy.flatnonzero(c_dist <= chunk_min * (1 + closest_candidate_rel_tol) + closest_candidate_abs_tol)
+        candidates.extend((c_dist[i], chunk_start + i, c_nv[:, i:i + 1], closest[i]) for i in near)
+
+        if len(stop):
             break
 
-    return min_point_pair, min_c_point, min_distance
+    result = (None, None, None)
+    max_candidate_distance = min_distance * (1 + closest_candidate_rel_tol) + closest_candidate_abs_tol if candidates else 0
+    for approx_distance, index, c_nv, closest in candidates:
+        if approx_distance > max_candidate_distance:
+            continue
+        point_pair = (points[index], points[index + 1])
+        if closest == 0:
+            c_point_lat, c_point_lng = n_E2lat_lon(c_nv)
+            c_point = Point(lat=rad2deg(c_point_lat[0]), lng=rad2deg(c_point_lng[0]))
+        else:
+            c_point = point_pair[closest - 1]
+        c_dist = distance(to_point, c_point)
+        if result[2] is None or c_dist < result[2]:
+            result = (point_pair, c_point, c_dist)
+    return result
 
 
 def iter_route_points_with_set_spacing(inverse_line_cached, points, spacing=10):
@@ -565,6 +1412,43 @@ def distance(point1, point2):
     return geodesic.Inverse(point1.lat, point1.lng, point2.lat, point2.lng)['s12']
 
 
+# Limits for using the approximation in segment_distances. See it's docstring for the error bounds.
+approx_distance_max_segment = 10000
+approx_distance_max_lat = 80
+
+
+def segment_distances(lat, lng, exact=False):
+    """Return the lengths of the segments between consecutive points of the ``lat`` and ``lng`` arrays.
+
+    By default, this uses an ellipsoidal approximation: the meridional and prime vertical radii of curvature at the
+    mean latitude of each segment. Compared to the WGS84 geodesic, the error is under 4 cm for segments shorter than
+    10 km, and under 0.1 mm for segments shorter than 1 km (for latitudes below 80°.) Longer segments, segments
+    at higher latitudes, or all segments if ``exact`` is set, are calculated with geographiclib.
+    """
+    lat1 = lat[:-1]
+    lat2 = lat[1:]
+    if exact:
+        exact_indexes = range(len(lat1))
+        distances = numpy.empty(len(lat1))
+    else:
+        e2 = geodesic.f * (2 - geodesic.f)
+        phi1 = deg2rad(lat1)
+        phi2 = deg2rad(lat2)
+        phi_m = (phi1 + phi2) / 2
+        d_lambda = deg2rad((lng[1:] - lng[:-1] + 180) % 360 - 180)
+        w = 1 - e2 * numpy.sin(phi_m) ** 2
+        meridional_radius = geodesic.a * (1 - e2) / w ** 1.5
+        prime_vertical_radius = geodesic.a / numpy.sqrt(w)
+        distances = numpy.hypot(meridional_radius * (phi2 - phi1), prime_vertical_radius * numpy.cos(phi_m) * d_lambda)
+        exact_indexes = numpy.flatnonzero(
+            (distances > approx_distance_max_segment) |
+            (numpy.abs(lat1) > approx_distance_max_lat) | (numpy.abs(lat2) > approx_distance_max_lat))
+
+    for i in exact_indexes:
+        distances[i] = geodesic.Inverse(lat[i], lng[i], lat[i + 1], lng[i + 1])['s12']
+    return distances
+
+
 def distance_and_azimuth(point1, point2):
     geo = geodesic.Inverse(point1.lat, point1.lng, point2.lat, point2.lng)
     return geo['s12'], geo['azi1']
@@ -576,6 +1460,18 @@ def point_from_distance_and_azimuth(point, distance, azimuth):
 
 
 def geo_from_distance_on_route(inverse_line_cached, route, dist):
+    if isinstance(route, RouteSlice) and isinstance(route.points, RoutePoints):
+        pair_at = route.pair_at_distance(dist)
+        if pair_at is None:
+            return geodesic.Inverse(route[0].lat, route[0].lng, route[-1].lat, route[-1].lng)
+        i, pair_start_distance = pair_at
+        point1 = route[i]
+        point2 = route[i + 1]
+        geo = geodesic.InverseLine(point1.lat, point1.lng, point2.lat, point2.lng).Position(dist - pair_start_distance)
+        if i != 0:
+            geo = geodesic.Inverse(route[0].lat, route[0].lng, geo['lat2'], geo['lon2'])
+        return geo
+
     distance_covered = 0
     first_pair = True
     for point1, point2, in pairs(route):
@@ -591,8 +1487,8 @@ def geo_from_distance_on_route(inverse_line_cached, route, dist):
     return geodesic.Inverse(route[0].lat, route[0].lng, route[-1].lat, route[-1].lng)
 
 
-def get_azimuth_to_distance_on_route(inverse_line_cached, from_point, route, dist):
-    to_geo = geo_from_distance_on_route(inverse_line_cached, [from_point] + route, dist)
+def get_azimuth_to_distance_on_route(inverse_line_cached, route, dist):
+    to_geo = geo_from_distance_on_route(inverse_line_cached, route, dist)
     return to_geo['azi1']
 
 
@@ -605,60 +1501,258 @@ def deg_wrap_to_closest(deg, to_deg):
     return min(deg, up, down, key=lambda x: abs(to_deg - x))
 
 
+# get_pano_ll cache keys are the location rounded to this many degrees (~1 m), and the radius.
+ll_cache_quantum = 0.00001
+
+
+async def count_trace(counter, stat, session, trace_config_ctx, params):
+    counter[stat] += 1
+
+
+def is_retryable_status(status):
+    return status >= 500 or status == 429
+
+
+def ll_cache_key(point, radius):
+    return struct.pack('<iiH', round(point.lat / ll_cache_quantum), round(point.lng / ll_cache_quantum), round(radius))
+
+
+# Size, in degrees, of the grid cells of the pano location index.
+pano_location_index_cell = 0.001
+# Approximate meters per degree of latitude.
+meters_per_deg = 111320
+
+
+def pano_location_index_key(lat_cell, lng_cell):
+    return struct.pack('<ii', lat_cell, lng_cell)
+
+
+def pano_location_index_item(id_b, data):
+    """Return the ``(key, value)`` for the pano location index for a pano's data."""
+    location = data['Location']
+    lat = float(location['lat'])
+    lng = float(location['lng'])
+    key = pano_location_index_key(math.floor(lat / pano_location_index_cell), math.floor(lng / pano_location_index_cell))
+    return key, id_b + struct.pack('<dd', lat, lng)
+
+
 class GoogleApi(object):
 
-    def __init__(self, api_key, lmdb_env):
-        self.session = aiohttp.ClientSession()
+    cbk_url = 'https://cbks0.googleapis.com/cbk'
+    streetview_url = 'https://maps.googleapis.com/maps/api/streetview'
+
+    def __init__(self, api_key, lmdb_env, ll_cache_ttl=30 * 24 * 3600, ll_cache_negative_ttl=7 * 24 * 3600,
+                 prefer_local_ll=False, img_cache_max_bytes=None, img_cache_policy='lru', img_cache_evict_interval=60,
+                 write_interval=10, write_buffer_max_items=10000, write_buffer_max_bytes=64 * 1024 * 1024,
+                 write_batch_bytes=16 * 1024 * 1024, pano_data_cache_max_entries=10000,
+                 pano_data_cache_max_bytes=32 * 1024 * 1024, rate_limit=50, rate_burst=50, daily_quota=None,
+                 request_timeout=30, retries=3, retry_base_delay=0.5, retry_max_delay=30, hedge_delay=None,
+                 circuit_breaker_failures=5, circuit_breaker_reset=30, connection_limit=100, connection_limit_per_host=20,
+                 keepalive_timeout=60, dns_cache_ttl=300, connect_timeout=10, read_timeout=20, img_cache_evict=True,
+                 img_cache_shared=False):
+        # Connections are kept alive and reused between requests, so that requests don't wait on tcp/tls setup.
+        trace_signal_stats = (
+            ('on_connection_create_end', 'created'),
+            ('on_connection_reuseconn', 'reused'),
+            ('on_connection_queued_start', 'queued'),
+            ('on_dns_cache_hit', 'dns_cache_hits'),
+            ('on_dns_cache_miss', 'dns_cache_misses'),
+        )
+        self.connection_stats = {stat: 0 for _, stat in trace_signal_stats}
+        trace_config = aiohttp.TraceConfig()
+        for signal_name, stat in trace_signal_stats:
+            getattr(trace_config, signal_name).append(functools.partial(count_trace, self.connection_stats, stat))
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=connection_limit, limit_per_host=connection_limit_per_host, keepalive_timeout=keepalive_timeout,
+                use_dns_cache=True, ttl_dns_cache=dns_cache_ttl),
+            timeout=aiohttp.ClientTimeout(total=request_timeout, connect=connect_timeout, sock_read=read_timeout),
+            trace_configs=[trace_config])
         self.api_key = api_key
         self.lmdb_env = lmdb_env
         self.has_unwriten_cache_items = asyncio.Event()
+        self.scheduler = ApiScheduler(lmdb_env, rate=rate_limit, burst=rate_burst, daily_quota=daily_quota)
+
+        # Failed requests (5xx, 429, connection errors and timeouts) are retried up to retries times, with jittered
+        # exponential backoff. While the circuit breaker is open, failures don't use up retries: everything waits
+        # for the api to recover. If hedge_delay is set, metadata requests that take longer than it are sent again,
+        # and the first response used.
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge_delay = hedge_delay
+        self.circuit_breaker = CircuitBreaker(circuit_breaker_failures, circuit_breaker_reset)
+        self.request_stats = {
+            'requests': 0,
+            'failures': 0,
+            'retries': 0,
+            'hedged': 0,
+        }
+
+        # Fetched items are held in the *_unwriten_cache dicts until written to lmdb. They are written every
+        # write_interval, or sooner if there are more than the write_buffer_max_* limits. If there are more than
+        # double the limits, (the writer can't keep up,) fetches wait for the writer before they request more.
+        self.write_interval = write_interval
+        self.write_buffer_max_items = write_buffer_max_items
+        self.write_buffer_max_bytes = write_buffer_max_bytes
+        self.write_batch_bytes = write_batch_bytes
+        self.write_buffer_items = 0
+        self.write_buffer_bytes = 0
+        self.write_buffer_full = asyncio.Event()
+        self.write_buffer_has_room = asyncio.Event()
+        self.write_buffer_has_room.set()
+        self.write_stats = {
+            'flushes': 0,
+            'last_flush_seconds': None,
+            'max_flush_seconds': None,
+            'backpressure_waits': 0,
+        }
+
+        # Values are msgpack (time, pano_id). pano_id is None for no pano at the location.
+        self.get_pano_ll_db = lmdb_env.open_db(b'll_cache')
+        self.get_pano_ll_unwriten_cache = {}
+        self.ll_cache_ttl = ll_cache_ttl
+        self.ll_cache_negative_ttl = ll_cache_negative_ttl
 
         self.get_pano_id_db = lmdb_env.open_db(b'api_cache')
+        # Grid index of the locations of the panos in api_cache. Keys are cells, values are the pano id and location.
+        self.pano_location_index_db = lmdb_env.open_db(b'pano_location_index', dupsort=True)
+        # Answer get_pano_ll with the nearest cached pano, if there is one in the radius.
+        self.prefer_local_ll = prefer_local_ll
         self.get_pano_id_unwriten_cache = {}
         self.get_pano_id_locks = {}
+        # Decoded pano data, so hot panos don't need to be read and unpacked again. Sizes are the msgpack size.
+        # Callers must not modify the data returned.
+        self.pano_data_cache = LRUCache(pano_data_cache_max_entries, pano_data_cache_max_bytes)
 
         self.get_pano_img_db = lmdb_env.open_db(b'img_cache')
         self.get_pano_img_unwriten_cache = {}
         self.get_pano_img_locks = {}
+        self.img_cache = ImgCacheManager(lmdb_env, self.get_pano_img_db, max_bytes=img_cache_max_bytes, policy=img_cache_policy)
+        self.img_cache_evict_interval = img_cache_evict_interval
+        # When other processes share the cache, only one should evict, and it needs to recount the cache's size, as
+        # the others add to it.
+        self.img_cache_evict = img_cache_evict
+        self.img_cache_shared = img_cache_shared
 
         self.reader_tx = self.lmdb_env.begin()
 
     async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._ensure_pano_location_index)
+        self.reader_tx.abort()
+        self.reader_tx = self.lmdb_env.begin()
+        await self.scheduler.__aenter__()
         self.write_cache_items_fut = asyncio.ensure_future(self.write_cache_items())
+        self.manage_img_cache_fut = asyncio.ensure_future(self.manage_img_cache())
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.scheduler.__aexit__(exc_type, exc_val, exc_tb)
         await self.session.close()
+        self.manage_img_cache_fut.cancel()
         self.write_cache_items_fut.cancel()
-        try:
-            await self.write_cache_items_fut
-        except asyncio.CancelledError:
-            pass
+        for fut in (self.manage_img_cache_fut, self.write_cache_items_fut):
+            try:
+                await fut
+            except asyncio.CancelledError:
+                pass
 
-    async def get_pano_ll(self, point, radius=15):
-        async with self.session.get(
-                'http://cbks0.googleapis.com/cbk',
-                params={
-                    'output': 'json',
-                    'radius': str(round(radius)),
-                    'll': latlng_urlstr(point),
-                    'key': self.api_key,
-                }) as r:
-            r.raise_for_status()
-            text = await r.text()
+    def stats(self):
+        return {
+            'scheduler': self.scheduler.stats(),
+            'requests': dict(self.request_stats, circuit_breaker=self.circuit_breaker.stats()),
+            'connections': dict(self.connection_stats),
+            'img_cache': self.img_cache.stats(),
+            'pano_data_cache': self.pano_data_cache.stats(),
+            'write_buffer': dict(
+                self.write_stats,
+                items=self.write_buffer_items,
+                bytes=self.write_buffer_bytes,
+            ),
+        }
+
+    async def get_pano_ll(self, point, radius=15, client=None):
+        key_b = ll_cache_key(point, radius)
+        cached = self.get_pano_ll_unwriten_cache.get(key_b)
+        if cached is None:
+            cached = self.reader_tx.get(key_b, db=self.get_pano_ll_db)
+        if cached:
+            cached_time, pano_id = msgpack.loads(cached, encoding='utf-8')
+            if time.time() - cached_time < (self.ll_cache_ttl if pano_id else self.ll_cache_negative_ttl):
+                if pano_id is None:
+                    return {}
+                data = await self.get_pano_id(pano_id, client=client)
+                if data:
+                    return data
+
+        if self.prefer_local_ll:
+            pano_id = self.get_pano_ll_local(point, radius)
+            if pano_id:
+                data = await self.get_pano_id(pano_id, client=client)
+                if data:
+                    return data
+
+        await self.wait_for_write_buffer_room()
+        text = await self.api_get(
+            self.cbk_url,
+            params={
+                'output': 'json',
+                'radius': str(round(radius)),
+                'll': latlng_urlstr(point),
+                'key': self.api_key,
+            },
+            client=client, hedge=True)
         try:
-            return json.loads(text)
+            data = json.loads(text)
         except Exception as e:
             logging.error('Bad JSON from api: {}\n {}'.format(e, text))
             raise
 
-    async def get_pano_id(self, id):
+        pano_id = data['Location']['panoId'] if data else None
+        self.add_unwriten_cache_item(self.get_pano_ll_unwriten_cache, key_b,
+                                     msgpack.dumps((time.time(), pano_id), encoding='utf-8'))
+        if pano_id:
+            self.add_unwriten_cache_item(self.get_pano_id_unwriten_cache, id_decode(pano_id),
+                                         msgpack.dumps(data, encoding='utf-8'))
+        return data
+
+    def get_pano_ll_local(self, point, radius=15):
+        """Return the id of the nearest pano in the cache that is within radius of point, or None."""
+        lat_cell_radius = radius / meters_per_deg / pano_location_index_cell
+        lng_cell_radius = lat_cell_radius / max(math.cos(math.radians(point.lat)), 0.01)
+        lat_cell = point.lat / pano_location_index_cell
+        lng_cell = point.lng / pano_location_index_cell
+
+        nearest_id_b = None
+        nearest_distance = None
+        with self.reader_tx.cursor(db=self.pano_location_index_db) as cursor:
+            for index_lat_cell in range(math.floor(lat_cell - lat_cell_radius), math.floor(lat_cell + lat_cell_radius) + 1):
+                for index_lng_cell in range(math.floor(lng_cell - lng_cell_radius), math.floor(lng_cell + lng_cell_radius) + 1):
+                    if not cursor.set_key(pano_location_index_key(index_lat_cell, index_lng_cell)):
+                        continue
+                    for value in cursor.iternext_dup():
+                        lat, lng = struct.unpack('<dd', value[16:])
+                        pano_distance = distance(point, Point(lat, lng))
+                        if pano_distance <= radius and (nearest_distance is None or pano_distance < nearest_distance):
+                            nearest_id_b = value[:16]
+                            nearest_distance = pano_distance
+        if nearest_id_b:
+            return id_encode(nearest_id_b).decode('ascii')
+
+    async def get_pano_id(self, id, client=None):
         id_b = id_decode(id)
 
         id_lock = self.get_pano_id_locks.get(id_b)
         if id_lock:
             await id_lock.wait()
 
+        data = self.pano_data_cache.get(id_b)
+        if data is not None:
+            # Don't starve the loop if the whole route is cached.
+            await asyncio.sleep(0)
+            return data
+
         text_b = self.get_pano_id_unwriten_cache.get(id_b)
         if text_b is None:
             text_b = self.reader_tx.get(id_b, db=self.get_pano_id_db)
@@ -672,34 +1766,37 @@ class GoogleApi(object):
             except Exception:
                 logging.exception("Error with cached data:")
             else:
+                self.pano_data_cache.put(id_b, data, len(text_b))
                 return data
 
         id_lock = asyncio.Event()
         self.get_pano_id_locks[id_b] = id_lock
         try:
-            async with self.session.get(
-                    'http://cbks0.googleapis.com/cbk',
-                    params={
-                        'output': 'json',
-                        'panoid': id,
-                        'key': self.api_key,
-                    }) as r:
-                r.raise_for_status()
-                text = await r.text()
+            await self.wait_for_write_buffer_room()
+            text = await self.api_get(
+                self.cbk_url,
+                params={
+                    'output': 'json',
+                    'panoid': id,
+                    'key': self.api_key,
+                },
+                client=client, hedge=True)
             try:
                 data = json.loads(text)
             except Exception as e:
                 logging.error('Bad JSON from api: {}\n {}'.format(e, text))
                 raise
 
-            self.get_pano_id_unwriten_cache[id_b] = msgpack.dumps(data, encoding='utf-8')
-            self.has_unwriten_cache_items.set()
+            text_b = msgpack.dumps(data, encoding='utf-8')
+            self.add_unwriten_cache_item(self.get_pano_id_unwriten_cache, id_b, text_b)
+            if data:
+                self.pano_data_cache.put(id_b, data, len(text_b))
             return data
         finally:
             id_lock.set()
             del self.get_pano_id_locks[id_b]
 
-    async def get_pano_img(self, id, heading):
+    async def get_pano_img(self, id, heading, client=None, priority=PRIORITY_INTERACTIVE):
         heading = round(heading, 1) % 360
         key_b = id_decode(id) + struct.pack('H', int(heading * 100))
 
@@ -712,54 +1809,210 @@ class GoogleApi(object):
             img = self.reader_tx.get(key_b, db=self.get_pano_img_db)
 
         if img:
+            self.img_cache.record_access(key_b, len(img))
             return img
 
         key_lock = asyncio.Event()
         self.get_pano_img_locks[key_b] = key_lock
         try:
-            async with self.session.get(
-                    'http://maps.googleapis.com/maps/api/streetview',
-                    params={
-                        'size': '640x480',
-                        'pano': id,
-                        'heading': str(heading),
-                        'fov': str(110),
-                        'key': self.api_key,
-                    }) as r:
-                r.raise_for_status()
-                img = await r.read()
-
-            self.get_pano_img_unwriten_cache[key_b] = img
-            self.has_unwriten_cache_items.set()
+            await self.wait_for_write_buffer_room()
+            img = await self.api_get(
+                self.streetview_url,
+                params={
+                    'size': '640x480',
+                    'pano': id,
+                    'heading': str(heading),
+                    'fov': str(110),
+                    'key': self.api_key,
+                },
+                client=client, priority=priority)
+
+            self.add_unwriten_cache_item(self.get_pano_img_unwriten_cache, key_b, img)
+            self.img_cache.record_access(key_b, len(img))
             return img
         finally:
             key_lock.set()
             del self.get_pano_img_locks[key_b]
 
+    async def api_get(self, url, params, client=None, priority=PRIORITY_BACKGROUND, hedge=False):
+        """Get url from the api, with the scheduler, retries, hedging and the circuit breaker. Returns the body bytes."""
+        attempt = 0
+        while True:
+            probe = await self.circuit_breaker.wait()
+            recorded = False
+            try:
+                await self.scheduler.acquire(client, priority)
+                self.request_stats['requests'] += 1
+                try:
+                    if hedge and self.hedge_delay is not None:
+                        body = await self.hedged_request(url, params, client, priority)
+                    else:
+                        body = await self.request(url, params)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if isinstance(e, aiohttp.ClientResponseError) and not is_retryable_status(e.status):
+                        raise
+                    self.request_stats['failures'] += 1
+                    self.circuit_breaker.record_failure()
+                    recorded = True
+                    if not self.circuit_breaker.is_open:
+                        if attempt >= self.retries:
+                            raise
+                        attempt += 1
+                        self.request_stats['retries'] += 1
+                        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+                        delay = delay / 2 + random.uniform(0, delay / 2)
+                        logging.warning('Api request failed: {!r}. Retry {} in {:.1f}s.'.format(e, attempt, delay))
+                        await asyncio.sleep(delay)
+                else:
+                    self.circuit_breaker.record_success()
+                    recorded = True
+                    return body
+            finally:
+                # Cancelled, out of quota, or a client error. Otherwise the breaker would wait on the probe forever.
+                if probe and not recorded:
+                    self.circuit_breaker.record_cancelled()
+
+    async def request(self, url, params):
+        async with self.session.get(url, params=params) as r:
+            r.raise_for_status()
+            return await r.read()
+
+    async def hedged_request(self, url, params, client, priority):
+        tasks = {asyncio.ensure_future(self.request(url, params))}
+        try:
+            done, tasks = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if done:
+                return done.pop().result()
+
+            await self.scheduler.acquire(client, priority)
+            self.request_stats['hedged'] += 1
+            tasks.add(asyncio.ensure_future(self.request(url, params)))
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                failed = [task for task in done if task.exception()]
+                for task in done:
+                    if task not in failed:
+                        return task.result()
+                if not tasks:
+                    return failed[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def add_unwriten_cache_item(self, unwriten_cache, key, value):
+        old_value = unwriten_cache.get(key)
+        if old_value is None:
+            self.write_buffer_items += 1
+        else:
+            self.write_buffer_bytes -= len(old_value)
+        unwriten_cache[key] = value
+        self.write_buffer_bytes += len(value)
+        self.has_unwriten_cache_items.set()
+
+        if self.write_buffer_items >= self.write_buffer_max_items or self.write_buffer_bytes >= self.write_buffer_max_bytes:
+            self.write_buffer_full.set()
+            if (self.write_buffer_items >= self.write_buffer_max_items * 2 or
+                    self.write_buffer_bytes >= self.write_buffer_max_bytes * 2):
+                self.write_buffer_has_room.clear()
+
+    async def wait_for_write_buffer_room(self):
+        if not self.write_buffer_has_room.is_set():
+            self.write_stats['backpressure_waits'] += 1
+            await self.write_buffer_has_room.wait()
+
+    def write_batches(self):
+        """Split the unwriten cache items into batches of about write_batch_bytes, to be written a transaction each."""
+        unwriten_caches = (self.get_pano_ll_unwriten_cache, self.get_pano_id_unwriten_cache, self.get_pano_img_unwriten_cache)
+        batch = ([], [], [])
+        batch_bytes = 0
+        for i, unwriten_cache in enumerate(unwriten_caches):
+            for item in list(unwriten_cache.items()):
+                batch[i].append(item)
+                batch_bytes += len(item[1])
+                if batch_bytes >= self.write_batch_bytes:
+                    yield batch
+                    batch = ([], [], [])
+                    batch_bytes = 0
+        if any(batch):
+            yield batch
+
+    def remove_written_cache_items(self, unwriten_cache, written):
+        for key, value in written:
+            # Only if it was not replaced while being written.
+            if unwriten_cache.get(key) is value:
+                del unwriten_cache[key]
+                self.write_buffer_items -= 1
+                self.write_buffer_bytes -= len(value)
+        if self.write_buffer_items < self.write_buffer_max_items * 2 and self.write_buffer_bytes < self.write_buffer_max_bytes * 2:
+            self.write_buffer_has_room.set()
+
     async def write_cache_items(self):
+        loop = asyncio.get_event_loop()
         while True:
             await self.has_unwriten_cache_items.wait()
             try:
-                await asyncio.sleep(10)
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.write_buffer_full.wait(), self.write_interval)
             finally:
-                get_pano_id_too_write = list(self.get_pano_id_unwriten_cache.items())
-                get_pano_img_too_write = list(self.get_pano_img_unwriten_cache.items())
                 self.has_unwriten_cache_items.clear()
-                loop = asyncio.get_event_loop()
+                self.write_buffer_full.clear()
+                start = time.monotonic()
                 try:
-                    await loop.run_in_executor(None, self._write_cache_items, get_pano_id_too_write, get_pano_img_too_write)
-                    for key, value in get_pano_id_too_write:
-                        del self.get_pano_id_unwriten_cache[key]
-                    for key, value in get_pano_img_too_write:
-                        del self.get_pano_img_unwriten_cache[key]
-                    self.reader_tx.abort()
-                    self.reader_tx = self.lmdb_env.begin()
+                    for get_pano_ll_too_write, get_pano_id_too_write, get_pano_img_too_write in self.write_batches():
+                        await loop.run_in_executor(None, self._write_cache_items,
+                                                   get_pano_ll_too_write, get_pano_id_too_write, get_pano_img_too_write)
+                        self.reader_tx.abort()
+                        self.reader_tx = self.lmdb_env.begin()
+                        self.remove_written_cache_items(self.get_pano_ll_unwriten_cache, get_pano_ll_too_write)
+                        self.remove_written_cache_items(self.get_pano_id_unwriten_cache, get_pano_id_too_write)
+                        self.remove_written_cache_items(self.get_pano_img_unwriten_cache, get_pano_img_too_write)
                 except Exception:
                     logging.exception('Error writing cache items:')
+                flush_seconds = time.monotonic() - start
+                self.write_stats['flushes'] += 1
+                self.write_stats['last_flush_seconds'] = flush_seconds
+                self.write_stats['max_flush_seconds'] = max(self.write_stats['max_flush_seconds'] or 0, flush_seconds)
+
+    async def manage_img_cache(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.img_cache.load)
+        while True:
+            await asyncio.sleep(self.img_cache_evict_interval)
+            try:
+                await loop.run_in_executor(None, self.img_cache.flush_accesses)
+                if not self.img_cache_evict:
+                    continue
+                if self.img_cache_shared:
+                    await loop.run_in_executor(None, self.img_cache.count)
+                if await loop.run_in_executor(None, self.img_cache.evict):
+                    # Don't hold on to the evicted images' pages.
+                    self.reader_tx.abort()
+                    self.reader_tx = self.lmdb_env.begin()
+            except Exception:
+                logging.exception('Error managing img cache:')
 
-    def _write_cache_items(self, get_pano_id_too_write, get_pano_img_too_write):
+    def _write_cache_items(self, get_pano_ll_too_write, get_pano_id_too_write, get_pano_img_too_write):
         with self.lmdb_env.begin(write=True) as tx:
+            for key, value in get_pano_ll_too_write:
+                tx.put(key, value, db=self.get_pano_ll_db)
             for key, value in get_pano_id_too_write:
                 tx.put(key, value, db=self.get_pano_id_db)
+                data = msgpack.loads(value, encoding='utf-8')
+                if data:
+                    tx.put(*pano_location_index_item(key, data), db=self.pano_location_index_db)
             for key, value in get_pano_img_too_write:
                 tx.put(key, value, db=self.get_pano_img_db)
+
+    def _ensure_pano_location_index(self):
+        """Index the panos already in api_cache, if the pano location index is empty."""
+        with self.lmdb_env.begin(write=True) as tx:
+            if tx.stat(self.pano_location_index_db)['entries']:
+                return
+            with tx.cursor(db=self.get_pano_id_db) as cursor:
+                for key, value in cursor:
+                    try:
+                        data = msgpack.loads(value, encoding='utf-8')
+                        if data:
+                            tx.put(*pano_location_index_item(key, data), db=self.pano_location_index_db)
+                    except Exception:
+                        logging.exception('Error indexing cached pano {}:'.format(id_encode(key)))
@@ -0,0 +1,176 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import multiprocessing
+import weakref
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+
+from route_view.core import (
+    find_closest_point_pair,
+    Point,
+    route_points_from_lat_lng,
+    RoutePoints,
+    RouteSlice,
+)
+
+# Shared route arrays are a 6 x n float64 array: lat, lng, distance, and the 3 rows of nv.
+shared_route_rows = 6
+
+
+class GeometryPool(object):
+    """Runs the CPU heavy route geometry functions in a pool of ``processes`` processes, so that they don't hold up
+    the event loop (or, because of the GIL, other threads.)
+
+    Route points are passed to the pool processes in shared memory, rather than pickled. A RoutePoints is copied to
+    shared memory once, on first use, and the pool processes keep the RoutePoints (and it's SegmentIndex) they make
+    from it, so the SegmentIndex is also built in the pool.
+    """
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.calls = 0
+
+    async def __aenter__(self):
+        # Not fork, as we have threads running.
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context(start_method))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await asyncio.get_event_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def run(self, fn, *args):
+        self.calls += 1
+        return await asyncio.get_event_loop().run_in_executor(self.executor, fn, *args)
+
+    async def route_with_distance_and_index(self, route):
+        lat_lng = numpy.fromiter(itertools.chain.from_iterable(route), dtype=float).reshape((-1, 2))
+        return await self.route_points_from_lat_lng(lat_lng[:, 0], lat_lng[:, 1])
+
+    async def route_points_from_lat_lng(self, lat, lng):
+        shared = SharedRoutePoints(len(lat))
+        array = shared.array()
+        array[0] = lat
+        array[1] = lng
+        await self.run(shared_route_with_distance_and_index, shared.name, shared.n)
+        route_points = route_points_from_array(array.copy())
+        route_points._shared = shared
+        return route_points
+
+    async def find_closest_point_pair(self, route_slice, to_point, req_min_dist=20, stop_after_dist=50):
+        """find_closest_point_pair for a RouteSlice over RoutePoints."""
+        route_points = route_slice.points
+        shared = share_route_points(route_points)
+        first_point = route_slice.first_point
+        result = await self.run(
+            shared_find_closest_point_pair, shared.name, shared.n, route_slice.start, route_slice.stop,
+            (first_point.lat, first_point.lng), (to_point.lat, to_point.lng), req_min_dist, stop_after_dist)
+        if result is None:
+            return None, None, None
+        pair_index, closest, c_lat, c_lng, dist = result
+        point2 = route_points[pair_index]
+        point1 = first_point if pair_index == route_slice.start else route_points[pair_index - 1]
+        c_point = (point1, point2)[closest - 1] if closest else Point(lat=c_lat, lng=c_lng)
+        return (point1, point2), c_point, dist
+
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'calls': self.calls,
+        }
+
+
+class SharedRoutePoints(object):
+    """Shared memory for the arrays of a route of ``n`` points. It is unlinked when this is garbage collected."""
+
+    def __init__(self, n):
+        self.n = n
+        self.shm = SharedMemory(create=True, size=max(shared_route_rows * n * 8, 8))
+        self.name = self.shm.name
+        weakref.finalize(self, unlink_shared_memory, self.shm)
+
+    def array(self):
+        return shared_array(self.shm, self.n)
+
+
+def unlink_shared_memory(shm):
+    shm.unlink()
+    # Fails if there are still views of it. The mapping then goes when they do.
+    with contextlib.suppress(BufferError):
+        shm.close()
+
+
+def shared_array(shm, n):
+    return numpy.ndarray((shared_route_rows, n), dtype=numpy.float64, buffer=shm.buf)
+
+
+def route_points_from_array(array):
+    return RoutePoints(lat=array[0], lng=array[1], distance=array[2], nv=array[3:])
+
+
+def share_route_points(route_points):
+    if route_points._shared is None:
+        shared = SharedRoutePoints(len(route_points))
+        array = shared.array()
+        array[0] = route_points.lat
+        array[1] = route_points.lng
+        array[2] = route_points.distance
+        array[3:] = route_points.nv
+        del array
+        route_points._shared = shared
+    return route_points._shared
+
+
+# In the pool processes: the routes attached to, most recently used last.
+attached_routes = collections.OrderedDict()
+attached_routes_max = 16
+
+
+def attached_route_points(name, n):
+    try:
+        shm, route_points = attached_routes[name]
+    except KeyError:
+        shm = SharedMemory(name=name)
+        route_points = route_points_from_array(shared_array(shm, n))
+        attached_routes[name] = shm, route_points
+        while len(attached_routes) > attached_routes_max:
+            _, (old_shm, _) = attached_routes.popitem(last=False)
+            with contextlib.suppress(BufferError):
+                old_shm.close()
+    else:
+        attached_routes.move_to_end(name)
+    return route_points
+
+
+def shared_route_with_distance_and_index(name, n):
+    shm = SharedMemory(name=name)
+    try:
+        array = shared_array(shm, n)
+        route_points = route_points_from_lat_lng(array[0], array[1])
+        array[2] = route_points.distance
+        array[3:] = route_points.nv
+        # Views of the shared memory have to go before it can be closed.
+        del array, route_points
+    finally:
+        shm.close()
+
+
+def shared_find_closest_point_pair(name, n, start, stop, first_point, to_point, req_min_dist, stop_after_dist):
+    """Returns ``(pair_index, closest, c_lat, c_lng, distance)``, where the pair ends at route point ``pair_index``, and
+    closest is 1 or 2 if the closest point is the first or second point of the pair, or 0 for the point
+    ``c_lat, c_lng``. None if there are no pairs."""
+    route_points = attached_route_points(name, n)
+    route_slice = RouteSlice(route_points, start, Point(*first_point), stop=stop)
+    point_pair, c_point, dist = find_closest_point_pair(route_slice, Point(*to_point), req_min_dist, stop_after_dist)
+    if point_pair is None:
+        return None
+    if c_point is point_pair[0]:
+        return point_pair[1].index, 1, None, None, dist
+    if c_point is point_pair[1]:
+        return point_pair[1].index, 2, None, None, dist
+    return point_pair[1].index, 0, float(c_point.lat), float(c_point.lng), dist
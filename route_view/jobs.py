@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import time
+
+import msgpack
+
+from route_view.util import mk_id
+
+
+class ProcessingQueue(object):
+    """Queue of routes to process, stored in the ``processing_jobs`` lmdb database, so that routes waiting for, or in
+    the middle of processing are processed when the server starts again.
+
+    ``concurrency`` routes are processed at a time. ``load_route`` is a coroutine function that returns the Route for
+    a route id. Jobs are removed when processing finishes (complete, error or cancelled by the user,) but not when it
+    is cancelled by the server shutting down.
+
+    Several processes (with the same ``generation``) can share the queue. A process claims a job before processing
+    it, and jobs claimed by a process that has died, or by a previous generation, can be claimed again. Jobs added by
+    other processes are found by polling.
+    """
+
+    def __init__(self, lmdb_env, load_route, concurrency=4, generation=None, poll_interval=2):
+        self.lmdb_env = lmdb_env
+        self.jobs_db = lmdb_env.open_db(b'processing_jobs')
+        self.load_route = load_route
+        self.concurrency = concurrency
+        self.generation = generation or mk_id()
+        # generation, pid, and an id, so that queues in the same process are different owners.
+        self.owner = [self.generation, os.getpid(), mk_id()]
+        self.poll_interval = poll_interval
+        self.queue = asyncio.Queue()
+        self.queued = set()
+        self.running = {}
+        # Running routes that have been enqueued again, e.g. cancelled and resumed, to be processed again once they
+        # stop.
+        self.rerun = set()
+        self.closing = False
+        # So that jobs db writes happen in the order the queue changes.
+        self.jobs_db_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        jobs = await loop.run_in_executor(None, self._claimable_jobs)
+        if jobs:
+            logging.info('Resuming processing of {} routes.'.format(len(jobs)))
+        self.add_local(jobs)
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+        self.poll_fut = asyncio.ensure_future(self.poll())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closing = True
+        self.poll_fut.cancel()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.wait(self.workers + [self.poll_fut])
+        process_tasks = [route.process_task for route in self.running.values() if route.process_task]
+        for task in process_tasks:
+            task.cancel()
+        if process_tasks:
+            await asyncio.wait(process_tasks)
+        # Let other processes, or the next start, carry on with them.
+        loop = asyncio.get_event_loop()
+        for route_id in self.running:
+            await loop.run_in_executor(None, self._release_job, route_id)
+
+    def add_local(self, route_ids):
+        for route_id in route_ids:
+            if route_id not in self.queued and route_id not in self.running:
+                self.queued.add(route_id)
+                self.queue.put_nowait(route_id)
+
+    def has_job(self, route_id):
+        """Is route_id waiting or being processed. Blocking."""
+        return self._get_job(route_id) is not None
+
+    async def claimed_elsewhere(self, route_id):
+        """Is route_id being processed by another process."""
+        if route_id in self.running:
+            return False
+        job = await asyncio.get_event_loop().run_in_executor(None, self._get_job, route_id)
+        return job is not None and job[1] is not None and job[1] != self.owner and self.owner_alive(job[1])
+
+    async def enqueue(self, route_id):
+        if route_id in self.running:
+            self.rerun.add(route_id)
+            return
+        if route_id in self.queued:
+            return
+        self.add_local((route_id, ))
+        async with self.jobs_db_lock:
+            await asyncio.get_event_loop().run_in_executor(None, self._put_job, route_id)
+
+    async def remove(self, route_id):
+        """Remove a route that is waiting to be processed. Returns True if it was waiting."""
+        if route_id in self.rerun:
+            self.rerun.discard(route_id)
+            return True
+        if route_id not in self.queued:
+            return False
+        self.queued.discard(route_id)
+        async with self.jobs_db_lock:
+            if route_id not in self.queued:
+                await asyncio.get_event_loop().run_in_executor(None, self._delete_job, route_id, False)
+        return True
+
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            route_id = await self.queue.get()
+            if route_id not in self.queued:
+                # Removed while waiting.
+                continue
+            self.queued.discard(route_id)
+            async with self.jobs_db_lock:
+                claimed = await loop.run_in_executor(None, self._claim_job, route_id)
+            if not claimed:
+                continue
+            try:
+                route = await self.load_route(route_id)
+                self.running[route_id] = route
+                await route.ensure_data_loaded()
+                while True:
+                    if not route.process_task:
+                        await route.start_processing()
+                    # Not await route.process_task, as we don't want cancelling the worker to cancel processing. That
+                    # is done by __aexit__.
+                    await asyncio.wait([route.process_task])
+                    if route_id not in self.rerun:
+                        break
+                    self.rerun.discard(route_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Error processing route {}:'.format(route_id))
+            finally:
+                if not self.closing:
+                    self.running.pop(route_id, None)
+                    self.rerun.discard(route_id)
+                    async with self.jobs_db_lock:
+                        if route_id in self.queued:
+                            await loop.run_in_executor(None, self._release_job, route_id)
+                        else:
+                            await loop.run_in_executor(None, self._delete_job, route_id, True)
+
+    async def poll(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.add_local(await loop.run_in_executor(None, self._claimable_jobs))
+            except Exception:
+                logging.exception('Error polling processing jobs:')
+
+    def owner_alive(self, owner):
+        if owner[0] != self.generation:
+            return False
+        try:
+            os.kill(owner[1], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'waiting': len(self.queued),
+            'running': len(self.running),
+        }
+
+    # Job values are msgpack (queued_time, owner). owner is None until claimed.
+
+    def _get_job(self, route_id, tx=None):
+        if tx is None:
+            with self.lmdb_env.begin() as tx:
+                return self._get_job(route_id, tx)
+        value = tx.get(route_id.encode(), db=self.jobs_db)
+        if value is not None:
+            return msgpack.loads(value, encoding='utf-8')
+
+    def _claimable_jobs(self):
+        jobs = []
+        with self.lmdb_env.begin() as tx:
+            with tx.cursor(db=self.jobs_db) as cursor:
+                for key, value in cursor:
+                    queued_time, owner = msgpack.loads(value, encoding='utf-8')
+                    if owner is None or (owner != self.owner and not self.owner_alive(owner)):
+                        jobs.append((queued_time, key.decode()))
+        return [route_id for queued_time, route_id in sorted(jobs)]
+
+    def _put_job(self, route_id):
+        with self.lmdb_env.begin(write=True) as tx:
+            tx.put(route_id.encode(), msgpack.dumps((time.time(), None), encoding='utf-8'), db=self.jobs_db, overwrite=False)
+
+    def _claim_job(self, route_id):
+        with self.lmdb_env.begin(write=True) as tx:
+            job = self._get_job(route_id, tx)
+            if job is None:
+                return False
+            queued_time, owner = job
+            if owner is not None and owner != self.owner and self.owner_alive(owner):
+                return False
+            tx.put(route_id.encode(), msgpack.dumps((queued_time, self.owner), encoding='utf-8'), db=self.jobs_db)
+            return True
+
+    def _release_job(self, route_id):
+        with self.lmdb_env.begin(write=True) as tx:
+            job = self._get_job(route_id, tx)
+            if job is not None and job[1] == self.owner:
+                tx.put(route_id.encode(), msgpack.dumps((job[0], None), encoding='utf-8'), db=self.jobs_db)
+
+    def _delete_job(self, route_id, claimed):
+        """Delete the job, if it's claimed by us (claimed=True), or not claimed (claimed=False)."""
+        with self.lmdb_env.begin(write=True) as tx:
+            job = self._get_job(route_id, tx)
+            if job is not None and job[1] == (self.owner if claimed else None):
+                tx.delete(route_id.encode(), db=self.jobs_db)
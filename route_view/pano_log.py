@@ -0,0 +1,254 @@
+import os
+import struct
+
+import msgpack
+import numpy
+
+from route_view.util import id_decode, id_encode
+
+# Panos are stored in blocks. Each block has a header, then a column for each field, then the fields stored as
+# strings, then anything that does not fit the schema (msgpack.) RouteStore stores a route's blocks in lmdb, with an
+# index entry per block, with the range of at_dist in it. Before that, routes were saved as files, with the blocks
+# appended to ``panos.bin`` after a file header, or before that, as msgpack in ``panos.pack``. PanoLog reads those, to
+# import them.
+file_header = struct.Struct('<8sH')
+file_magic = b'RVPANOS\0'
+format_version = 1
+block_header = struct.Struct('<4sII')
+block_magic = b'PBLK'
+index_entry = struct.Struct('<QIdd')
+
+pano_types = ('pano', 'no_images')
+
+# (name, kind). Each field has a bit in the presence column. Values that are not of the field's kind go in extra.
+fields = (
+    ('type', 'type'),
+    ('id', 'id'),
+    ('point', 'point'),
+    ('original_point', 'point'),
+    ('description', 'str'),
+    ('prev_route_index', 'int'),
+    ('heading', 'float'),
+    ('at_dist', 'float'),
+    ('dist_from_last', 'float'),
+    ('start_point', 'point'),
+    ('start_route_index', 'int'),
+    ('start_dist_from', 'float'),
+    ('last', 'bool'),
+)
+field_names = {name for name, kind in fields}
+field_bits = {name: i for i, (name, kind) in enumerate(fields)}
+
+kind_dtypes = {
+    'type': numpy.dtype('u1'),
+    'id': numpy.dtype('S16'),
+    'point': numpy.dtype(('<f8', 2)),
+    'int': numpy.dtype('<i8'),
+    'float': numpy.dtype('<f8'),
+    'bool': numpy.dtype('u1'),
+}
+
+
+def fits_kind(kind, value):
+    if kind == 'type':
+        return value in pano_types
+    if kind == 'id':
+        try:
+            return isinstance(value, str) and id_encode(id_decode(value)).decode('ascii') == value
+        except (ValueError, TypeError):
+            return False
+    if kind == 'point':
+        return is_point(value)
+    if kind == 'str':
+        return isinstance(value, str)
+    if kind == 'int':
+        return isinstance(value, (int, numpy.integer)) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+    if kind == 'float':
+        return isinstance(value, (float, numpy.floating))
+    if kind == 'bool':
+        return isinstance(value, bool)
+
+
+def is_point(value):
+    return hasattr(value, 'lat') and hasattr(value, 'lng')
+
+
+def pad8(n):
+    return -n % 8
+
+
+def encode_block(panos):
+    n = len(panos)
+    presence = numpy.zeros(n, dtype='<u2')
+    columns = []
+    strings = []
+    extras = []
+    for i, (name, kind) in enumerate(fields):
+        if kind == 'str':
+            values = []
+        else:
+            column = numpy.zeros(n, dtype=kind_dtypes[kind])
+        for row, pano in enumerate(panos):
+            value = pano.get(name)
+            present = name in pano and fits_kind(kind, value)
+            if present:
+                presence[row] |= 1 << i
+                if kind == 'type':
+                    column[row] = pano_types.index(value)
+                elif kind == 'id':
+                    column[row] = id_decode(value)
+                elif kind == 'point':
+                    column[row] = (value.lat, value.lng)
+                elif kind != 'str':
+                    column[row] = value
+            if kind == 'str':
+                values.append(value.encode('utf-8') if present else b'')
+        if kind == 'str':
+            strings.append(values)
+        else:
+            columns.append(column)
+    for pano, row_presence in zip(panos, presence.tolist()):
+        extra = {name: value for name, value in pano.items()
+                 if name not in field_names or not row_presence & (1 << field_bits[name])}
+        extras.append(msgpack.dumps(extra, default=encode_extra, encoding='utf-8') if extra else b'')
+
+    parts = [presence.tobytes()]
+    for column in columns:
+        parts.append(column.tobytes())
+    for values in strings + [extras]:
+        parts.append(numpy.cumsum([0] + [len(value) for value in values], dtype='<u4').tobytes())
+        parts.append(b''.join(values))
+    body = b''.join(part + b'\0' * pad8(len(part)) for part in parts)
+    return block_header.pack(block_magic, n, block_header.size + len(body)) + body
+
+
+def encode_extra(obj):
+    if is_point(obj):
+        return (obj.lat, obj.lng)
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    raise TypeError('Can not encode {!r}'.format(obj))
+
+
+class Block(object):
+    """Columns of an encoded block in ``buffer`` at ``offset``. The block is copied out of buffer, and the columns are
+    views of the copy."""
+
+    def __init__(self, buffer, offset):
+        magic, self.n, self.size = block_header.unpack_from(buffer, offset)
+        if magic != block_magic:
+            raise ValueError('Bad pano block at {}.'.format(offset))
+        n = self.n
+        data = bytes(buffer[offset:offset + self.size])
+        pos = block_header.size
+
+        def take(dtype, count):
+            nonlocal pos
+            array = numpy.frombuffer(data, dtype=dtype, count=count, offset=pos)
+            pos += array.nbytes + pad8(array.nbytes)
+            return array
+
+        def take_bytes(length):
+            nonlocal pos
+            value = data[pos:pos + length]
+            pos += length + pad8(length)
+            return value
+
+        self.presence = take('<u2', n)
+        self.columns = {}
+        for name, kind in fields:
+            if kind != 'str':
+                self.columns[name] = take(kind_dtypes[kind], n)
+        self.strings = {}
+        for name, kind in fields + (('extra', 'str'), ):
+            if kind == 'str':
+                offsets = take('<u4', n + 1)
+                self.strings[name] = (offsets, take_bytes(int(offsets[-1])))
+
+    def at_dist(self):
+        at_dist = self.columns['at_dist'].copy()
+        at_dist[(self.presence & (1 << field_bits['at_dist'])) == 0] = numpy.nan
+        return at_dist
+
+    def index_entry(self, offset):
+        at_dist = self.at_dist()
+        if numpy.isnan(at_dist).all():
+            return offset, self.n, numpy.nan, numpy.nan
+        return offset, self.n, float(numpy.nanmin(at_dist)), float(numpy.nanmax(at_dist))
+
+    def decode(self, point_cls, rows=None):
+        rows = range(self.n) if rows is None else rows
+        presence = self.presence.tolist()
+        columns = {name: column.tolist() if column.dtype.kind != 'S' else column for name, column in self.columns.items()}
+        panos = []
+        for row in rows:
+            pano = {}
+            row_presence = presence[row]
+            for i, (name, kind) in enumerate(fields):
+                if not row_presence & (1 << i):
+                    continue
+                if kind == 'str':
+                    offsets, data = self.strings[name]
+                    pano[name] = data[offsets[row]:offsets[row + 1]].decode('utf-8')
+                elif kind == 'type':
+                    pano[name] = pano_types[columns[name][row]]
+                elif kind == 'id':
+                    pano[name] = id_encode(columns[name][row].ljust(16, b'\0')).decode('ascii')
+                elif kind == 'point':
+                    pano[name] = point_cls(*columns[name][row])
+                elif kind == 'bool':
+                    pano[name] = bool(columns[name][row])
+                else:
+                    pano[name] = columns[name][row]
+            offsets, data = self.strings['extra']
+            if offsets[row] != offsets[row + 1]:
+                pano.update(msgpack.loads(data[offsets[row]:offsets[row + 1]], encoding='utf-8'))
+            panos.append(pano)
+        return panos
+
+
+class PanoLog(object):
+    """The panos of a route saved as files in ``dir_route``, read to import them. Points are read as
+    ``point_cls(lat, lng)``. Blocking."""
+
+    def __init__(self, dir_route, point_cls):
+        self.dir_route = dir_route
+        self.point_cls = point_cls
+        self.bin_path = os.path.join(dir_route, 'panos.bin')
+        self.old_path = os.path.join(dir_route, 'panos.pack')
+
+    def exists(self):
+        return os.path.exists(self.bin_path)
+
+    def read_blocks(self):
+        """The encoded blocks in panos.bin. A block at the end that was only partly written is left out."""
+        with open(self.bin_path, 'rb') as f:
+            data = f.read()
+        magic, version = file_header.unpack_from(data)
+        if magic != file_magic or version != format_version:
+            raise ValueError('Unknown pano log format: {} {}'.format(magic, version))
+        blocks = []
+        offset = file_header.size
+        while offset + block_header.size <= len(data):
+            magic, n, size = block_header.unpack_from(data, offset)
+            if offset + size > len(data):
+                break
+            blocks.append(data[offset:offset + Block(data, offset).size])
+            offset += size
+        return blocks
+
+    def read_old(self):
+        """The panos in the old msgpack format panos.pack."""
+        panos = []
+        with open(self.old_path, 'rb') as f:
+            unpacker = msgpack.Unpacker(f, encoding='utf-8')
+            while True:
+                try:
+                    panos.append(unpacker.unpack())
+                except msgpack.OutOfData:
+                    break
+        for pano in panos:
+            for key in ('point', 'original_point', 'start_point'):
+                if key in pano:
+                    pano[key] = self.point_cls(*pano[key])
+        return panos
@@ -0,0 +1,138 @@
+import contextlib
+import json
+import os
+import struct
+
+import msgpack
+
+from route_view.pano_log import Block, encode_block, index_entry, PanoLog
+
+
+class RouteStore(object):
+    """Routes, stored in the ``routes`` and ``route_panos`` lmdb databases. Methods are blocking.
+
+    ``routes`` has the parts of a route (meta, route, status, and panos_index) under ``<route_id>/<part>``, all
+    msgpack, except panos_index. ``route_panos`` has the pano blocks saved for a route (in the pano_log block format,)
+    under ``<route_id>/`` and the block number. panos_index has an entry per block, with the range of at_dist in it,
+    so that a distance window can be loaded without reading the other blocks.
+    """
+
+    def __init__(self, lmdb_env):
+        self.lmdb_env = lmdb_env
+        self.routes_db = lmdb_env.open_db(b'routes')
+        self.panos_db = lmdb_env.open_db(b'route_panos')
+
+    def has_route(self, route_id):
+        with self.lmdb_env.begin() as tx:
+            return tx.get(route_key(route_id, 'meta'), db=self.routes_db) is not None
+
+    def route_ids(self):
+        with self.lmdb_env.begin() as tx:
+            return [key[:-len(b'/meta')].decode() for key in tx.cursor(db=self.routes_db).iternext(values=False)
+                    if key.endswith(b'/meta')]
+
+    def load(self, route_id, part):
+        """Raises KeyError if the route does not have part."""
+        with self.lmdb_env.begin() as tx:
+            value = tx.get(route_key(route_id, part), db=self.routes_db)
+        if value is None:
+            raise KeyError((route_id, part))
+        return msgpack.loads(value, encoding='utf-8')
+
+    def save(self, route_id, part, value, default=None):
+        with self.lmdb_env.begin(write=True) as tx:
+            tx.put(route_key(route_id, part), msgpack.dumps(value, default=default, use_bin_type=True), db=self.routes_db)
+
+    def save_processing(self, route_id, status, panos, default=None):
+        """Save status, and append panos, in one transaction."""
+        with self.lmdb_env.begin(write=True) as tx:
+            tx.put(route_key(route_id, 'status'), msgpack.dumps(status, default=default, use_bin_type=True), db=self.routes_db)
+            if panos:
+                self._append_block(tx, route_id, encode_block(panos))
+
+    def _append_block(self, tx, route_id, block):
+        index_key = route_key(route_id, 'panos_index')
+        index = tx.get(index_key, db=self.routes_db) or b''
+        block_number = len(index) // index_entry.size
+        tx.put(panos_key(route_id, block_number), block, db=self.panos_db)
+        tx.put(index_key, index + index_entry.pack(*Block(block, 0).index_entry(block_number)), db=self.routes_db)
+
+    def clear_panos(self, route_id):
+        with self.lmdb_env.begin(write=True) as tx:
+            self._clear_panos(tx, route_id)
+
+    def _clear_panos(self, tx, route_id):
+        prefix = panos_key(route_id, None)
+        cursor = tx.cursor(db=self.panos_db)
+        if cursor.set_range(prefix):
+            while cursor.key().startswith(prefix):
+                if not cursor.delete():
+                    break
+        tx.delete(route_key(route_id, 'panos_index'), db=self.routes_db)
+
+    def _read_index(self, tx, route_id):
+        """List of ``(block_number, n, min_at_dist, max_at_dist)``."""
+        return list(index_entry.iter_unpack(tx.get(route_key(route_id, 'panos_index'), db=self.routes_db) or b''))
+
+    def panos_count(self, route_id):
+        with self.lmdb_env.begin() as tx:
+            return sum(n for block_number, n, min_at_dist, max_at_dist in self._read_index(tx, route_id))
+
+    def load_panos(self, route_id, point_cls):
+        with self.lmdb_env.begin() as tx:
+            return [pano
+                    for block_number, n, min_at_dist, max_at_dist in self._read_index(tx, route_id)
+                    for pano in Block(tx.get(panos_key(route_id, block_number), db=self.panos_db), 0).decode(point_cls)]
+
+    def load_panos_window(self, route_id, start_dist, end_dist, point_cls):
+        """The panos with at_dist in ``[start_dist, end_dist]``. Only blocks that have some are read."""
+        panos = []
+        with self.lmdb_env.begin() as tx:
+            for block_number, n, min_at_dist, max_at_dist in self._read_index(tx, route_id):
+                if not (min_at_dist <= end_dist and max_at_dist >= start_dist):
+                    continue
+                block = Block(tx.get(panos_key(route_id, block_number), db=self.panos_db), 0)
+                at_dist = block.at_dist()
+                panos.extend(block.decode(point_cls, ((at_dist >= start_dist) & (at_dist <= end_dist)).nonzero()[0].tolist()))
+        return panos
+
+    def import_dir(self, route_id, dir_route, point_cls):
+        """Import a route saved in the old format, as files in dir_route. Replaces what is stored for the route."""
+        with open(os.path.join(dir_route, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        with open(os.path.join(dir_route, 'route.pack'), 'rb') as f:
+            route = f.read()
+        status = None
+        with contextlib.suppress(FileNotFoundError):
+            with open(os.path.join(dir_route, 'status.json'), 'r') as f:
+                status = json.load(f)
+
+        pano_log = PanoLog(dir_route, point_cls)
+        if pano_log.exists():
+            blocks = pano_log.read_blocks()
+        elif os.path.exists(pano_log.old_path):
+            panos = pano_log.read_old()
+            blocks = [encode_block(panos[i:i + 1000]) for i in range(0, len(panos), 1000)]
+        else:
+            blocks = []
+
+        with self.lmdb_env.begin(write=True) as tx:
+            self._clear_panos(tx, route_id)
+            tx.put(route_key(route_id, 'meta'), msgpack.dumps(meta), db=self.routes_db)
+            tx.put(route_key(route_id, 'route'), route, db=self.routes_db)
+            if status is not None:
+                tx.put(route_key(route_id, 'status'), msgpack.dumps(status), db=self.routes_db)
+            for block in blocks:
+                self._append_block(tx, route_id, block)
+
+
+def route_key(route_id, part):
+    return '{}/{}'.format(route_id, part).encode()
+
+
+def panos_key(route_id, block_number):
+    """Key of a block. With block_number None, the prefix of the route's blocks."""
+    prefix = '{}/'.format(route_id).encode()
+    if block_number is None:
+        return prefix
+    return prefix + struct.pack('>I', block_number)
@@ -0,0 +1,265 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import struct
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class ApiQuotaExceeded(Exception):
+    pass
+
+
+class ApiScheduler(object):
+    """Schedules api requests, so that they stay under a rate limit (a token bucket of ``rate`` requests per second,
+    and bursts of up to ``burst``,) and a daily quota.
+
+    Interactive requests go first. Background requests are shared round robin between clients (e.g. the routes being
+    processed,) so that one big route can't hold up the others. The number of requests made each day is stored in the
+    ``api_quota`` lmdb database, so it survives restarts, and is shared with other processes. Days are UTC days.
+    """
+
+    def __init__(self, lmdb_env, rate=50, burst=50, daily_quota=None, save_interval=10):
+        self.lmdb_env = lmdb_env
+        self.quota_db = lmdb_env.open_db(b'api_quota')
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.save_interval = save_interval
+
+        self.tokens = burst
+        self.tokens_time = time.monotonic()
+        self.interactive_waiters = collections.deque()
+        # client -> deque of waiters. The order is the round robin order.
+        self.background_waiters = collections.OrderedDict()
+        self.has_waiters = asyncio.Event()
+
+        self.quota_day = None
+        self.quota_used = 0
+        self.quota_used_saved = 0
+        self.requests = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+        self.throttled = 0
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.load)
+        self.dispatch_fut = asyncio.ensure_future(self.dispatch())
+        self.save_fut = asyncio.ensure_future(self.save_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for fut in (self.dispatch_fut, self.save_fut):
+            fut.cancel()
+            try:
+                await fut
+            except asyncio.CancelledError:
+                pass
+        waiters = list(self.interactive_waiters)
+        for client_waiters in self.background_waiters.values():
+            waiters.extend(client_waiters)
+        for waiter in waiters:
+            waiter.cancel()
+        await self.save()
+
+    async def acquire(self, client=None, priority=PRIORITY_BACKGROUND):
+        """Wait until a request may be made. Raises ApiQuotaExceeded if the daily quota has been used."""
+        if not self.interactive_waiters and not self.background_waiters and self.refill_tokens() == 0:
+            self.grant(priority)
+            return
+
+        self.throttled += 1
+        waiter = asyncio.get_event_loop().create_future()
+        if priority == PRIORITY_INTERACTIVE:
+            self.interactive_waiters.append(waiter)
+        else:
+            self.background_waiters.setdefault(client, collections.deque()).append(waiter)
+        self.has_waiters.set()
+        await waiter
+
+    async def dispatch(self):
+        while True:
+            await self.has_waiters.wait()
+            wait = self.refill_tokens()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            waiter, priority = self.next_waiter()
+            if waiter is None:
+                self.has_waiters.clear()
+                continue
+            try:
+                self.grant(priority)
+            except ApiQuotaExceeded as e:
+                waiter.set_exception(e)
+            else:
+                waiter.set_result(None)
+
+    def next_waiter(self):
+        while self.interactive_waiters:
+            waiter = self.interactive_waiters.popleft()
+            if not waiter.done():
+                return waiter, PRIORITY_INTERACTIVE
+        while self.background_waiters:
+            client, client_waiters = self.background_waiters.popitem(last=False)
+            waiter = None
+            while client_waiters:
+                waiter = client_waiters.popleft()
+                if not waiter.done():
+                    break
+                waiter = None
+            if client_waiters:
+                # Back of the queue.
+                self.background_waiters[client] = client_waiters
+            if waiter:
+                return waiter, PRIORITY_BACKGROUND
+        return None, None
+
+    def refill_tokens(self):
+        """Returns how long to wait until there is a token available, or 0 if there is one now."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.tokens_time) * self.rate)
+        self.tokens_time = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def grant(self, priority):
+        day = current_quota_day()
+        if day != self.quota_day:
+            self.quota_day = day
+            self.quota_used = 0
+            self.quota_used_saved = 0
+        if self.daily_quota is not None and self.quota_used >= self.daily_quota:
+            raise ApiQuotaExceeded('Daily api quota of {} requests used.'.format(self.daily_quota))
+        self.quota_used += 1
+        self.tokens -= 1
+        self.requests[priority] += 1
+
+    def load(self):
+        day = current_quota_day()
+        with self.lmdb_env.begin() as tx:
+            value = tx.get(day.encode(), db=self.quota_db)
+        self.quota_day = day
+        self.quota_used = self.quota_used_saved = struct.unpack('<Q', value)[0] if value else 0
+
+    async def save(self):
+        """Add the requests made since the last save to the stored count, and pick up the requests other processes
+        have made."""
+        day, quota_used = self.quota_day, self.quota_used
+        if day is None:
+            return
+        loop = asyncio.get_event_loop()
+        total = await loop.run_in_executor(None, self._save, day, quota_used - self.quota_used_saved)
+        if self.quota_day == day:
+            self.quota_used = total + (self.quota_used - quota_used)
+            self.quota_used_saved = total
+
+    def _save(self, day, unsaved):
+        with self.lmdb_env.begin(write=True) as tx:
+            value = tx.get(day.encode(), db=self.quota_db)
+            total = (struct.unpack('<Q', value)[0] if value else 0) + unsaved
+            if unsaved:
+                tx.put(day.encode(), struct.pack('<Q', total), db=self.quota_db)
+        return total
+
+    async def save_periodically(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            try:
+                await self.save()
+            except Exception:
+                logging.exception('Error saving api quota use:')
+
+    def stats(self):
+        return {
+            'quota_day': self.quota_day,
+            'quota_used': self.quota_used,
+            'daily_quota': self.daily_quota,
+            'rate': self.rate,
+            'tokens': self.tokens,
+            'interactive_requests': self.requests[PRIORITY_INTERACTIVE],
+            'background_requests': self.requests[PRIORITY_BACKGROUND],
+            'throttled': self.throttled,
+            'waiting_interactive': len(self.interactive_waiters),
+            'waiting_background': sum(len(client_waiters) for client_waiters in self.background_waiters.values()),
+            'waiting_clients': len(self.background_waiters),
+        }
+
+
+class CircuitBreaker(object):
+    """Stops requests to an upstream that is failing.
+
+    After ``failure_threshold`` failures in a row, the breaker opens, and ``wait`` blocks (rather than fails) until
+    ``reset_timeout`` has passed. Then one request is let through to probe the upstream. If it succeeds, the breaker
+    closes and everything waiting carries on, otherwise it opens again. The probe must end with record_success,
+    record_failure, or, if it ends without telling us anything about the upstream, record_cancelled.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self.opens = 0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    async def wait(self):
+        """Wait until a request may be made. Returns True if the request is the probe."""
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0:
+                if not self.probing:
+                    self.probing = True
+                    return True
+                # Wait on the probe.
+                remaining = self.reset_timeout
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.closed.wait(), remaining)
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        if self.opened_at is not None:
+            logging.info('Api circuit breaker closed.')
+            self.opened_at = None
+            self.probing = False
+            self.closed.set()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None:
+                logging.warning('Api circuit breaker opened after {} failures.'.format(self.failures))
+                self.opens += 1
+            self.opened_at = time.monotonic()
+            self.probing = False
+            self.closed.clear()
+
+    def record_cancelled(self):
+        # The probe didn't tell us anything. Let another request probe, and wake what is waiting on the probe, so
+        # that one of them does that now.
+        if self.probing:
+            self.probing = False
+            self.closed.set()
+            self.closed.clear()
+
+    def stats(self):
+        return {
+            'state': ('half_open' if self.probing else 'open') if self.opened_at is not None else 'closed',
+            'failures': self.failures,
+            'opens': self.opens,
+        }
+
+
+def current_quota_day():
+    return time.strftime('%Y-%m-%d', time.gmtime())
@@ -1,29 +1,71 @@
 import argparse
 import asyncio
+import contextlib
 import copy
 import logging.config
 import os
 import shutil
 import signal
+import socket
 import sys
+from functools import partial
 
+import lmdb
 import uvloop
 import yaml
 from aiohttp.web import AppRunner, TCPSite, UnixSite
 from yarl import URL
 
+import route_view.cluster
 import route_view.core
 import route_view.web_app
+from route_view.route_store import RouteStore
+from route_view.util import mk_id
 
 defaults_yaml = """
     server_type: inet
     inet_host: ''
     inet_port: 6841
+    workers: 1   # Worker processes. More than 1 needs server_type inet. Processing and rate limits are per worker.
     debugtoolbar: False
     aioserver_debug: False
     data_path: data
     lmdb_path: data/lmdb
     lmdb_map_size: 10000000000   # 10 GB
+    processing_pipeline_depth: 4   # Street view api requests to run ahead while processing a route.
+    processing_concurrency: 4   # Routes processed at a time. Others wait in the queue.
+    processing_checkpoint_interval: 30   # Seconds between saves of processing progress.
+    processing_segments: 4   # Long routes are split into up to this many segments, processed at the same time.
+    processing_min_segment_length: 50000   # 50 km
+    session_max_pending: 200   # Changes queued for a route websocket before it is disconnected as too slow.
+    session_send_timeout: 30
+    upload_max_bytes: 209715200   # 200 MB. Larger GPX uploads are refused.
+    geometry_processes: 2   # Processes for heavy route geometry. 0 to do it in the server process.
+    ll_cache_ttl: 2592000   # 30 days
+    ll_cache_negative_ttl: 604800   # 7 days
+    prefer_local_ll: False   # Find panos near a location in the local cache before asking the api.
+    img_cache_max_bytes: 8000000000   # 8 GB. Images are evicted when over this. Keep under lmdb_map_size.
+    img_cache_policy: lru   # lru or lfu
+    write_buffer_max_items: 10000   # Fetched items waiting to be written to lmdb, before they are written early.
+    write_buffer_max_bytes: 67108864   # 64 MB
+    pano_data_cache_max_entries: 10000   # Decoded pano metadata kept in memory.
+    pano_data_cache_max_bytes: 33554432   # 32 MB
+    api_rate_limit: 50   # Street view api requests per second.
+    api_rate_burst: 50
+    api_daily_quota: null   # Requests per (UTC) day. null for no limit.
+    api_request_timeout: 30   # Total, including waiting for a connection.
+    api_connect_timeout: 10
+    api_read_timeout: 20
+    api_connection_limit: 100
+    api_connection_limit_per_host: 20
+    api_keepalive_timeout: 60   # Seconds to keep idle connections open for reuse.
+    api_dns_cache_ttl: 300
+    api_retries: 3   # Retries for 5xx, 429, connection errors and timeouts.
+    api_retry_base_delay: 0.5   # Doubled for each retry, with jitter.
+    api_retry_max_delay: 30
+    api_hedge_delay: null   # Send metadata requests again if they take longer than this. null to not.
+    api_circuit_breaker_failures: 5   # Failures in a row before all requests wait for the api to recover.
+    api_circuit_breaker_reset: 30   # Seconds between checks if the api has recovered.
 
     logging:
         version: 1
@@ -62,17 +104,11 @@ def main():
                         help='Enable development tools (e.g. debug toolbar.)')
     parser.add_argument('--api-key', action='store',
                         help='Google api key. ')
+    parser.add_argument('--workers', action='store', type=int,
+                        help='Number of worker processes, sharing the listening port (inet only.)')
     args = parser.parse_args()
 
-    defaults = yaml.load(defaults_yaml)
-    settings = copy.deepcopy(defaults)
-    try:
-        with open(args.settings_file) as f:
-            settings_from_file = yaml.load(f)
-    except FileNotFoundError:
-        settings_from_file = {}
-    settings.update(settings_from_file)
-
+    settings = load_settings(args.settings_file)
     logging.config.dictConfig(settings['logging'])
 
     try:
@@ -91,6 +127,13 @@ def main():
             settings['aioserver_debug'] = True
         if args.api_key:
             settings['api_key'] = args.api_key
+        if args.workers:
+            settings['workers'] = args.workers
+
+        if settings['workers'] > 1:
+            if settings['server_type'] != 'inet':
+                raise ValueError('Multiple workers needs server_type inet.')
+            sys.exit(run_workers(settings))
 
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         loop = asyncio.get_event_loop()
@@ -104,6 +147,142 @@ def main():
         sys.exit(3)
 
 
+def load_settings(settings_file):
+    defaults = yaml.load(defaults_yaml)
+    settings = copy.deepcopy(defaults)
+    try:
+        with open(settings_file) as f:
+            settings_from_file = yaml.load(f)
+    except FileNotFoundError:
+        settings_from_file = {}
+    settings.update(settings_from_file)
+    return settings
+
+
+def compact_lmdb_main():
+    parser = argparse.ArgumentParser(description='Compact the lmdb cache, returning space freed by evictions. '
+                                                 'The server must be stopped while this runs.')
+    parser.add_argument('settings_file', action='store', nargs='?', default='/etc/route_view.yaml',
+                        help='File to load settings from.')
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings_file)
+    logging.config.dictConfig(settings['logging'])
+
+    lmdb_path = settings['lmdb_path']
+    compact_path = lmdb_path + '.compact'
+    os.makedirs(compact_path, exist_ok=True)
+    with lmdb.open(lmdb_path, max_dbs=10, map_size=settings['lmdb_map_size']) as env:
+        before = env.info()['last_pgno'] * env.stat()['psize']
+        env.copy(compact_path, compact=True)
+    after = os.path.getsize(os.path.join(compact_path, 'data.mdb'))
+    os.replace(os.path.join(compact_path, 'data.mdb'), os.path.join(lmdb_path, 'data.mdb'))
+    shutil.rmtree(compact_path)
+    logging.info('Compacted {}: {} bytes -> {} bytes.'.format(lmdb_path, before, after))
+
+
+def import_routes_main():
+    parser = argparse.ArgumentParser(description='Import routes saved as files in data_path/routes into lmdb. Routes '
+                                                 'are also imported when first loaded, so the server can be running.')
+    parser.add_argument('settings_file', action='store', nargs='?', default='/etc/route_view.yaml',
+                        help='File to load settings from.')
+    parser.add_argument('--remove', action='store_true', help='Remove the route directories once imported.')
+    args = parser.parse_args()
+
+    settings = load_settings(args.settings_file)
+    logging.config.dictConfig(settings['logging'])
+
+    routes_path = os.path.join(settings['data_path'], 'routes')
+    if not os.path.isdir(routes_path):
+        logging.info('No routes to import.')
+        return
+    with lmdb.open(settings['lmdb_path'], max_dbs=10, map_size=settings['lmdb_map_size']) as env:
+        store = RouteStore(env)
+        imported = 0
+        for route_id in sorted(os.listdir(routes_path)):
+            dir_route = os.path.join(routes_path, route_id)
+            if not store.has_route(route_id):
+                try:
+                    store.import_dir(route_id, dir_route, route_view.core.Point)
+                except Exception:
+                    logging.exception('Error importing {}.'.format(dir_route))
+                    continue
+                imported += 1
+            if args.remove:
+                shutil.rmtree(dir_route)
+    logging.info('Imported {} routes.'.format(imported))
+
+
+def run_workers(settings):
+    """Fork settings['workers'] worker processes, which listen on the same port (with SO_REUSEPORT,) and relay
+    messages between them until they exit. Returns an exit code."""
+    n_workers = settings['workers']
+    generation = mk_id()
+    hub_socks = []
+    pids = []
+    for worker_index in range(n_workers):
+        hub_sock, worker_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 3
+            try:
+                for sock in hub_socks + [hub_sock]:
+                    sock.close()
+                worker_settings = dict(
+                    settings,
+                    worker_index=worker_index,
+                    cluster_generation=generation,
+                    # Share the api rate limit between the workers.
+                    api_rate_limit=settings['api_rate_limit'] / n_workers,
+                    api_rate_burst=max(settings['api_rate_burst'] / n_workers, 1),
+                )
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                try:
+                    loop.run_until_complete(serve(loop, worker_settings, partial(
+                        route_view.web_app.make_aio_app, cluster_sock=worker_sock)))
+                finally:
+                    loop.close()
+                exit_code = 0
+            except Exception:
+                logging.exception('Unhandled exception in worker {}:'.format(worker_index))
+            finally:
+                # os._exit does not flush.
+                logging.shutdown()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        worker_sock.close()
+        hub_socks.append(hub_sock)
+        pids.append(pid)
+
+    logging.info('Started {} workers: {}'.format(n_workers, pids))
+
+    def stop_workers():
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for signame in ('SIGINT', 'SIGTERM'):
+            loop.add_signal_handler(getattr(signal, signame), stop_workers)
+        # Runs till all the workers have disconnected.
+        loop.run_until_complete(route_view.cluster.run_hub(hub_socks))
+    finally:
+        loop.close()
+
+    exit_code = 0
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        if status:
+            exit_code = 3
+    return exit_code
+
+
 async def serve(loop, settings, make_app):
 
     app = await make_app(settings)
@@ -112,7 +291,8 @@ async def serve(loop, settings, make_app):
     await runner.setup()
 
     if settings['server_type'] == 'inet':
-        site = TCPSiteSocketName(runner, settings['inet_host'], settings['inet_port'])
+        site = TCPSiteSocketName(runner, settings['inet_host'], settings['inet_port'],
+                                 reuse_port=settings.get('workers', 1) > 1)
     elif settings['server_type'] == 'unix':
         unix_path = os.path.abspath(settings['unix_path'])
         if os.path.exists(unix_path):
@@ -135,8 +315,13 @@ async def serve(loop, settings, make_app):
     try:
         # Run forever (or we get interupt)
         run_fut = asyncio.Future()
+
+        def stop():
+            if not run_fut.done():
+                run_fut.set_result(None)
+
         for signame in ('SIGINT', 'SIGTERM'):
-            loop.add_signal_handler(getattr(signal, signame), run_fut.set_result, None)
+            loop.add_signal_handler(getattr(signal, signame), stop)
         try:
             await run_fut
         finally:
@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import json
+import logging
+
+import attr
+import msgpack
+from aiohttp import WSCloseCode
+
+from route_view.core import Point, route_status_attrs, RoutePoints
+
+point_json_attrs = {'lat', 'lng'}
+
+
+def json_encode(obj):
+    if isinstance(obj, Point):
+        return attr.asdict(obj, filter=lambda a, v: a.name in point_json_attrs)
+    if isinstance(obj, RoutePoints):
+        return [{'lat': lat, 'lng': lng} for lat, lng in zip(obj.lat.tolist(), obj.lng.tolist())]
+
+
+class EncodedChange(object):
+    """A change to send to route sessions. It is encoded as json (for text sessions) or msgpack (for binary
+    sessions) the first time that is needed, and not again for each session."""
+
+    def __init__(self, change, packed=None):
+        self.change = change
+        self._packed = packed
+        self._json = None
+        # Changes with the same coalesce_key replace each other in a session's queue.
+        self.coalesce_key = 'status' if set(change) == route_status_attrs else None
+        # Previews, that a session can do without when it's behind.
+        self.droppable = 'segment_panos' in change
+
+    @classmethod
+    def from_msgpack(cls, packed):
+        return cls(msgpack.loads(packed, raw=False), packed)
+
+    @property
+    def msgpack(self):
+        if self._packed is None:
+            self._packed = msgpack.dumps(self.change, default=json_encode, use_bin_type=True)
+        return self._packed
+
+    @property
+    def json(self):
+        if self._json is None:
+            self._json = json.dumps(self.change, default=json_encode)
+        return self._json
+
+
+class RouteSession(object):
+    """A websocket viewing a route. Changes are queued, and sent by the session's own task, so that sending to a slow
+    client does not hold up processing of the route, or the other sessions.
+
+    When a change is queued, an older one with the same coalesce_key is removed. When more than ``max_pending``
+    changes are queued, droppable changes are dropped, and if that is not enough, or if sending a change takes longer
+    than ``send_timeout``, the session is disconnected. ``stats`` is a Counter that the number of changes coalesced
+    and dropped, and sessions disconnected, are counted in.
+    """
+
+    def __init__(self, ws, binary=False, max_pending=200, send_timeout=30, stats=None):
+        self.ws = ws
+        self.binary = binary
+        self.max_pending = max_pending
+        self.send_timeout = send_timeout
+        self.stats = stats if stats is not None else collections.Counter()
+        self.pending = collections.deque()
+        self.has_pending = asyncio.Event()
+        self.closed = False
+
+    async def __aenter__(self):
+        self.send_task = asyncio.ensure_future(self.sender())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.closed = True
+        self.has_pending.set()
+        self.send_task.cancel()
+        await asyncio.wait([self.send_task])
+
+    def send(self, change):
+        """Queue change (an EncodedChange) to be sent. Does not block."""
+        if self.closed:
+            return
+        if change.coalesce_key is not None:
+            for pending in self.pending:
+                if pending.coalesce_key == change.coalesce_key:
+                    self.pending.remove(pending)
+                    self.stats['coalesced'] += 1
+                    break
+        self.pending.append(change)
+        self.has_pending.set()
+
+        if len(self.pending) > self.max_pending:
+            keep = collections.deque(pending for pending in self.pending if not pending.droppable)
+            self.stats['dropped'] += len(self.pending) - len(keep)
+            self.pending = keep
+            if len(self.pending) > self.max_pending:
+                self.disconnect('{} changes behind'.format(len(self.pending)))
+
+    def disconnect(self, reason):
+        logging.warning('Disconnecting slow route session: {}.'.format(reason))
+        self.stats['disconnected'] += 1
+        self.closed = True
+        self.pending.clear()
+        asyncio.ensure_future(self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow.'))
+
+    async def sender(self):
+        while not self.closed:
+            await self.has_pending.wait()
+            while self.pending and not self.closed:
+                change = self.pending.popleft()
+                try:
+                    if self.binary:
+                        await asyncio.wait_for(self.ws.send_bytes(change.msgpack), self.send_timeout)
+                    else:
+                        await asyncio.wait_for(self.ws.send_str(change.json), self.send_timeout)
+                except asyncio.TimeoutError:
+                    self.disconnect('send timed out')
+                except Exception:
+                    logging.exception('Error sending to client: ')
+            self.has_pending.clear()
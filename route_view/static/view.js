@@ -40,11 +40,25 @@ document.addEventListener('DOMContentLoaded', function() {
 
     var split_route_name = window.location.pathname.split('/');
     var route_id = split_route_name[split_route_name.length - 2];
-    var ws = new WebSocket(location.protocol.replace('http', 'ws') + '//' + location.host + '/route_sock/' + route_id + '/');
+    var ws;
     var panos = [];
+    // What we have, so that when we reconnect, we are only sent what we don't have.
+    var route_version = null;
+    var panos_epoch = null;
     var api_key = '';
+    // The route points we have, at a level of detail, and their indexes in the full route.
     var route_points = [];
+    var route_indexes = [];
+    var route_detail_levels = [];
+    var route_level = null;
+    var route_level_requested = null;
     var total_distance = null;
+    // Unless we are sent panos as the route is processed, we load them in windows of distance, as we need them.
+    var panos_windowed = false;
+    var panos_window_size = 5000;
+    var panos_window_start = null;
+    var panos_seek_to = null;
+    var last_pano_index = null;
 
     var distance = document.getElementById('dist_display');
     var processing_status = document.getElementById('processing_status');
@@ -69,6 +83,61 @@ document.addEventListener('DOMContentLoaded', function() {
     processing_progress.fillStyle = "#8080FF";
     processing_progress.fillRect(0, 0, 1000, 10);
 
+    function route_points_between(start_index, stop_index) {
+        // The route points we have with indexes from start_index, up to (but not including) stop_index.
+        return route_points.slice(bisect(route_indexes, start_index), bisect(route_indexes, stop_index));
+    }
+
+    function bisect(values, value) {
+        var lo = 0, hi = values.length;
+        while (lo < hi) {
+            var mid = (lo + hi) >> 1;
+            if (values[mid] < value) { lo = mid + 1; } else { hi = mid; }
+        }
+        return lo;
+    }
+
+    function request_route_level() {
+        // The least detailed level that has errors of under a pixel at the current zoom.
+        if (route_level === null || ws.readyState != WebSocket.OPEN) { return; }
+        var meters_per_pixel = 156543.03392 * Math.cos(map.getCenter().lat() * Math.PI / 180) / Math.pow(2, map.getZoom());
+        var level = route_detail_levels.length - 1;
+        for (var i = 0; i < route_detail_levels.length; i++) {
+            if (route_detail_levels[i] <= meters_per_pixel) {
+                level = i;
+                break;
+            }
+        }
+        if (level > route_level && (route_level_requested === null || level > route_level_requested)) {
+            route_level_requested = level;
+            ws.send(JSON.stringify({'get_route_level': level}));
+        }
+    }
+    map.addListener('idle', request_route_level);
+
+    function request_panos_window(to_dist) {
+        // Request the panos after the ones we have, if we have less than a window ahead of where we are playing, or
+        // we don't have up to to_dist.
+        if (!panos_windowed || panos_window_start !== null || ws.readyState != WebSocket.OPEN) { return; }
+        var start = panos.length ? panos[panos.length - 1].at_dist : 0;
+        var current_dist = current_pano_index >= 0 ? panos[current_pano_index].at_dist : 0;
+        if (start - current_dist >= panos_window_size && !(to_dist > start)) { return; }
+        panos_window_start = start;
+        ws.send(JSON.stringify({'get_panos_window': [start, Math.max(to_dist || 0, start) + panos_window_size]}));
+    }
+
+    function add_panos(new_panos) {
+        if (!new_panos.length) { return; }
+        panos = panos.concat(new_panos);
+        if (last_pano_index !== null && last_pano_index < panos.length) {
+            panos[last_pano_index].last = true;
+        }
+        load_next_panos();
+        continue_play();
+        update_progress_for_panos(new_panos);
+        do_show_pano_markers();
+    }
+
     function update_progress_for_panos(new_panos){
         var no_images_by_start_point = new_panos.reduce(function (memo, item) {
             if (item.type == 'no_images'){
@@ -85,7 +154,7 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             no_images = no_images_by_start_point[key];
             path = [no_images.start_point].concat(
-                route_points.slice(no_images.start_route_index, no_images.prev_route_index),
+                route_points_between(no_images.start_route_index, no_images.prev_route_index),
                 [no_images.point]);
             polyline = new google.maps.Polyline({
                 path: path,
@@ -104,15 +173,39 @@ document.addEventListener('DOMContentLoaded', function() {
             );
         }
 
+        if (!panos.length) {
+            processed_polyline.setPath([]);
+            return;
+        }
         var last_pano = panos[panos.length - 1]
-        var processed_path = route_points.slice(0, last_pano.prev_route_index).concat([last_pano.point]);
+        var processed_path = route_points_between(0, last_pano.prev_route_index).concat([last_pano.point]);
         processed_polyline.setPath(processed_path);
         processing_progress.fillStyle = "#4040FF";
         processing_progress.fillRect(0, 0, 1000 * last_pano.at_dist / total_distance, 10);
     }
 
-    ws.onmessage = function(e) {
-        var data = JSON.parse(e.data);
+    function connect() {
+        var query = '?protocol=msgpack';
+        if (route_version !== null) {
+            query += '&route_version=' + encodeURIComponent(route_version);
+        }
+        if (panos_epoch !== null) {
+            query += '&panos_epoch=' + panos_epoch + '&panos_count=' + panos.length;
+        }
+        panos_window_start = null;
+        ws = new WebSocket(location.protocol.replace('http', 'ws') + '//' + location.host + '/route_sock/' + route_id + '/' + query);
+        ws.binaryType = 'arraybuffer';
+        ws.onmessage = on_message;
+        ws.onclose = function (e) {
+            // Not if the server closed it normally, e.g. no permission.
+            if (e.code != 1000) {
+                setTimeout(connect, 2000);
+            }
+        };
+    }
+
+    function on_message(e) {
+        var data = (typeof e.data === 'string') ? JSON.parse(e.data) : msgpack_decode(e.data);
 //        console.log(data);
         if (data.hasOwnProperty('name')) {
             document.getElementById('name_display').textContent = data.name;
@@ -129,17 +222,68 @@ document.addEventListener('DOMContentLoaded', function() {
         if (data.hasOwnProperty('route_bounds')) {
             map.fitBounds(data['route_bounds']);
         }
-        if (data.hasOwnProperty('route_points')) {
-            route_points = data.route_points;
-            route_polyline.setPath(data.route_points);
+        if (data.hasOwnProperty('route_polyline')) {
+            var lat_lngs = polyline_decode(data.route_polyline, 2);
+            route_points = lat_lngs.map(function (lat_lng) { return {lat: lat_lng[0] / 1e5, lng: lat_lng[1] / 1e5}; });
+            route_indexes = polyline_decode(data.route_indexes, 1).map(function (index) { return index[0]; });
+            route_polyline.setPath(route_points);
             total_distance = data.route_distance;
+            route_version = data.route_version;
+            route_detail_levels = data.route_detail_levels;
+            route_level = data.route_level;
+            if (route_level_requested !== null && route_level_requested <= route_level) {
+                route_level_requested = null;
+            }
+            if (panos.length) {
+                update_progress_for_panos([]);
+            }
+            request_route_level();
         }
-        if (data.hasOwnProperty('panos')) {
-            panos = panos.concat(data.panos);
-            load_next_panos();
-            continue_play();
-            update_progress_for_panos(data.panos);
-            do_show_pano_markers();
+        if (data.hasOwnProperty('panos_epoch')) {
+            panos_epoch = data.panos_epoch;
+        }
+        if (data.hasOwnProperty('panos_window')) {
+            // Ignore windows requested before a reset, or reconnect.
+            if (data.panos_window[0] === panos_window_start) {
+                panos_window_start = null;
+                var new_panos = panos.length ? data.panos.filter(function (pano) { return pano.at_dist > data.panos_window[0]; }) : data.panos;
+                if (!new_panos.length || data.panos_window[1] >= total_distance) {
+                    // We have all that there is. Any more are sent as they are processed.
+                    panos_windowed = false;
+                }
+                add_panos(new_panos);
+                if (panos_seek_to !== null) {
+                    var seek_to = panos_seek_to;
+                    panos_seek_to = null;
+                    seek_to_dist(seek_to);
+                }
+                request_panos_window();
+            }
+        } else if (data.hasOwnProperty('panos') && !panos_windowed) {
+            add_panos(data.panos);
+        }
+
+        if (data.hasOwnProperty('panos_windowed')) {
+            panos_windowed = true;
+            request_panos_window();
+        }
+
+        if (data.hasOwnProperty('last_pano_index')) {
+            last_pano_index = data.last_pano_index;
+            if (last_pano_index < panos.length) {
+                panos[last_pano_index].last = true;
+            }
+        }
+
+        if (data.hasOwnProperty('segment_panos')) {
+            // Panos of a segment further along the route that is being processed at the same time. They are sent
+            // again in panos once it's joined up, so just show the progress.
+            var first = data.segment_panos[0];
+            var last = data.segment_panos[data.segment_panos.length - 1];
+            processing_progress.fillStyle = "#4040FF";
+            processing_progress.fillRect(
+                1000 * first.at_dist / total_distance, 0,
+                1000 * (last.at_dist - first.at_dist) / total_distance + 1, 10);
         }
 
         if (data.hasOwnProperty('reset_panos_index')) {
@@ -148,11 +292,15 @@ document.addEventListener('DOMContentLoaded', function() {
             no_images_polyline = {};
             processing_progress.fillStyle = "#8080FF";
             processing_progress.fillRect(0, 0, 1000, 10);
-            buffer_progress.clearRect(1000 * panos[data.reset_panos_index].at_dist / total_distance, 0, 1000, 10);
+            var reset_dist = data.reset_panos_index >= 0 ? panos[data.reset_panos_index].at_dist : 0;
+            buffer_progress.clearRect(1000 * reset_dist / total_distance, 0, 1000, 10);
             update_progress_for_panos(panos);
+            panos_window_start = null;
+            request_panos_window();
         }
 
-    };
+    }
+    connect();
 
     cancel.addEventListener('click', function (){
         ws.send(JSON.stringify('cancel'));
@@ -200,7 +348,7 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     function continue_play() {
-        if (playing) {
+        if (playing && current_pano_index + 1 < panos.length) {
             var pano_index = current_pano_index + 1
             var pano = panos[pano_index];
 
@@ -343,11 +491,21 @@ document.addEventListener('DOMContentLoaded', function() {
             continue_play();
             load_next_panos();
         }
+        request_panos_window();
     }
 
     play_progress.addEventListener('click', function(e){
         var rect = play_progress.getBoundingClientRect();
-        var seek_distance  = (e.offsetX || e.pageX - rect.left + document.body.scrollLeft) / play_progress.offsetWidth * total_distance;
+        seek_to_dist((e.offsetX || e.pageX - rect.left + document.body.scrollLeft) / play_progress.offsetWidth * total_distance);
+    });
+
+    function seek_to_dist(seek_distance) {
+        if (panos_windowed && (!panos.length || panos[panos.length - 1].at_dist < seek_distance)) {
+            // Seek once we have the panos up to there.
+            panos_seek_to = seek_distance;
+            request_panos_window(seek_distance);
+            return;
+        }
         function get_pano_at_dist(pano) {
             return pano.at_dist;
         }
@@ -360,7 +518,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 show_pano_rotate(pano_index);
             }
         }
-    });
+    }
 
 
     var pano_markers = [];
@@ -499,3 +657,92 @@ if (!Array.prototype.findIndex) {
 }
 
 
+// Decodes an encoded polyline of n_columns int columns, as the server's polyline_encode encodes them.
+function polyline_decode(encoded, n_columns) {
+    var rows = [];
+    var row = new Array(n_columns).fill(0);
+    var pos = 0;
+    while (pos < encoded.length) {
+        row = row.slice();
+        for (var column = 0; column < n_columns; column++) {
+            // Not bit operators, which are 32 bit.
+            var value = 0, factor = 1, chunk;
+            do {
+                chunk = encoded.charCodeAt(pos++) - 63;
+                value += (chunk & 0x1f) * factor;
+                factor *= 32;
+            } while (chunk >= 0x20);
+            row[column] += (value % 2) ? -(value + 1) / 2 : value / 2;
+        }
+        rows.push(row);
+    }
+    return rows;
+}
+
+// Decodes the msgpack messages the server sends (maps, arrays, strings, numbers, booleans and nil.)
+function msgpack_decode(buffer) {
+    var view = new DataView(buffer);
+    var bytes = new Uint8Array(buffer);
+    var pos = 0;
+    var utf8 = new TextDecoder('utf-8');
+
+    function str(length) {
+        var value = utf8.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+    function array(length) {
+        var value = new Array(length);
+        for (var i = 0; i < length; i++) { value[i] = decode(); }
+        return value;
+    }
+    function map(length) {
+        var value = {};
+        for (var i = 0; i < length; i++) {
+            var key = decode();
+            value[key] = decode();
+        }
+        return value;
+    }
+    function read(size, getter) {
+        var value = view[getter](pos);
+        pos += size;
+        return value;
+    }
+    function decode() {
+        var type = bytes[pos++];
+        var length, high;
+        if (type < 0x80) { return type; }
+        if (type < 0x90) { return map(type & 0x0f); }
+        if (type < 0xa0) { return array(type & 0x0f); }
+        if (type < 0xc0) { return str(type & 0x1f); }
+        if (type >= 0xe0) { return type - 0x100; }
+        switch (type) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: length = read(1, 'getUint8'); pos += length; return bytes.slice(pos - length, pos);
+            case 0xc5: length = read(2, 'getUint16'); pos += length; return bytes.slice(pos - length, pos);
+            case 0xc6: length = read(4, 'getUint32'); pos += length; return bytes.slice(pos - length, pos);
+            case 0xca: return read(4, 'getFloat32');
+            case 0xcb: return read(8, 'getFloat64');
+            case 0xcc: return read(1, 'getUint8');
+            case 0xcd: return read(2, 'getUint16');
+            case 0xce: return read(4, 'getUint32');
+            case 0xcf: high = read(4, 'getUint32'); return high * 4294967296 + read(4, 'getUint32');
+            case 0xd0: return read(1, 'getInt8');
+            case 0xd1: return read(2, 'getInt16');
+            case 0xd2: return read(4, 'getInt32');
+            case 0xd3: high = read(4, 'getInt32'); return high * 4294967296 + read(4, 'getUint32');
+            case 0xd9: return str(read(1, 'getUint8'));
+            case 0xda: return str(read(2, 'getUint16'));
+            case 0xdb: return str(read(4, 'getUint32'));
+            case 0xdc: return array(read(2, 'getUint16'));
+            case 0xdd: return array(read(4, 'getUint32'));
+            case 0xde: return map(read(2, 'getUint16'));
+            case 0xdf: return map(read(4, 'getUint32'));
+        }
+        throw new Error('Unsupported msgpack type 0x' + type.toString(16));
+    }
+    return decode();
+}
@@ -0,0 +1,34 @@
+import unittest
+
+from route_view.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2, max_bytes=100)
+        cache.put('a', 1, 1)
+        cache.put('b', 2, 1)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 1)
+        # b was the least recently used.
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=10)
+        cache.put('a', 1, 4)
+        cache.put('b', 2, 4)
+        cache.put('c', 3, 4)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 8)
+        # Replacing a value replaces it's size.
+        cache.put('b', 2, 1)
+        self.assertEqual(cache.bytes, 5)
+        # Too big to cache at all.
+        cache.put('d', 4, 11)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.bytes, 5)
@@ -0,0 +1,59 @@
+import asyncio
+import socket
+import unittest
+
+from route_view.async_exit_stack import AsyncExitStack
+from route_view.cluster import ClusterClient, run_hub
+from route_view.tests import unittest_run_loop
+
+
+class TestCluster(unittest.TestCase):
+
+    @unittest_run_loop
+    async def test_publish_and_request(self):
+        socket_pairs = [socket.socketpair() for _ in range(3)]
+        hub_fut = asyncio.ensure_future(run_hub([hub_sock for hub_sock, worker_sock in socket_pairs]))
+        received = [[] for _ in socket_pairs]
+        clients = []
+
+        def make_handle_message(i):
+            async def handle_message(msg):
+                received[i].append(msg)
+                if msg.get('type') == 'ping' and i == 2:
+                    await clients[i].reply(msg, {'pong': i})
+            return handle_message
+
+        async with AsyncExitStack() as stack:
+            for i, (hub_sock, worker_sock) in enumerate(socket_pairs):
+                clients.append(await stack.enter_context(ClusterClient(worker_sock, make_handle_message(i), request_timeout=1)))
+
+            await clients[0].publish({'type': 'change', 'n': 1})
+            async with clients[1].request({'type': 'ping'}) as reply:
+                self.assertEqual(reply, {'pong': 2})
+
+            for _ in range(100):
+                if len(received[2]) == 2:
+                    break
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(hub_fut, 1)
+        self.assertEqual(received[0], [{'type': 'ping', 'request_id': received[0][0]['request_id']}])
+        self.assertEqual(received[1], [{'type': 'change', 'n': 1}])
+        self.assertEqual([msg['type'] for msg in received[2]], ['change', 'ping'])
+
+    @unittest_run_loop
+    async def test_request_timeout(self):
+        socket_pairs = [socket.socketpair() for _ in range(2)]
+        hub_fut = asyncio.ensure_future(run_hub([hub_sock for hub_sock, worker_sock in socket_pairs]))
+
+        async def handle_message(msg):
+            pass
+
+        async with AsyncExitStack() as stack:
+            client = await stack.enter_context(ClusterClient(socket_pairs[0][1], handle_message, request_timeout=0.05))
+            await stack.enter_context(ClusterClient(socket_pairs[1][1], handle_message))
+            with self.assertRaises(asyncio.TimeoutError):
+                async with client.request({'type': 'ping'}):
+                    pass
+            self.assertEqual(client.pending_requests, {})
+        await asyncio.wait_for(hub_fut, 1)
@@ -3,22 +3,93 @@ import contextlib
 import functools
 import os
 import pprint
+import struct
 import tempfile
 import unittest
 
 import lmdb
+import numpy
+from numpy import (
+    arccos,
+    cross,
+    dot,
+    rad2deg,
+)
+from nvector import (
+    n_E2lat_lon,
+    unit,
+)
 
+from route_view.async_exit_stack import AsyncExitStack
 from route_view.core import (
+    distance,
     find_closest_point_pair,
+    find_closest_point_pair_indexed,
     geo_from_distance_on_route,
     geodesic,
     GoogleApi,
+    IndexedPoint,
     iter_route_points_with_set_spacing,
+    join_segments,
     Point,
+    polyline_encode,
+    ProcessSegment,
     Route,
+    route_points_detail,
     route_with_distance_and_index,
+    RoutePoints,
+    RouteSlice,
+    scan_closest_point_pair,
+    SegmentIndex,
 )
+from route_view.route_store import RouteStore
+from route_view.sessions import EncodedChange
 from route_view.tests import unittest_run_loop
+from route_view.tests.test_google_api import make_stub_api
+from route_view.util import id_encode
+
+
+def find_closest_point_pair_reference(points, to_point, req_min_dist=20, stop_after_dist=50):
+    # The original, one segment at a time implementation. Used to check the vectorized one.
+    tpn = to_point.nv
+    min_distance = None
+    min_point_pair = None
+    min_c_point = None
+    for point1, point2 in zip(points, points[1:]):
+        p1 = point1.nv
+        p2 = point2.nv
+        c12 = cross(p1, p2, axis=0)
+        ctp = cross(tpn, c12, axis=0)
+        c = unit(cross(ctp, c12, axis=0))
+        p1h = p1.reshape((3, ))
+        p2h = p2.reshape((3, ))
+        dp1p2 = arccos(dot(p1h, p2h))
+
+        sutable_c = None
+        for co in (c, 0 - c):
+            co_rs = co.reshape((3, ))
+            dp1co = arccos(dot(p1h, co_rs))
+            dp2co = arccos(dot(p2h, co_rs))
+            if abs(dp1co + dp2co - dp1p2) < 0.000001:
+                sutable_c = co
+                break
+
+        if sutable_c is not None:
+            c_point_lat, c_point_lng = n_E2lat_lon(sutable_c)
+            c_point = Point(lat=rad2deg(c_point_lat[0]), lng=rad2deg(c_point_lng[0]))
+            c_dist = distance(to_point, c_point)
+        else:
+            c_dist, c_point = min(((distance(to_point, p), p) for p in (point1, point2)), key=lambda item: item[0])
+
+        if min_distance is None or c_dist < min_distance:
+            min_distance = c_dist
+            min_point_pair = (point1, point2)
+            min_c_point = c_point
+
+        if min_distance < req_min_dist and c_dist > stop_after_dist:
+            break
+
+    return min_point_pair, min_c_point, min_distance
 
 
 class TestHelpers(unittest.TestCase):
@@ -29,6 +100,64 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual(closest_point_pair, (Point(0, 30), Point(0, 60)))
         self.assertEqual(cpoint, Point(0, 45))
 
+    def test_find_closest_point_pair_matches_reference(self):
+        # A zig zag route that crosses back over it's self, with some repeated points.
+        points = route_with_distance_and_index(
+            [(-26.09 + (i % 7) * 0.0003, 27.98 + i * 0.0002 - (i // 40) * 0.008) for i in range(150)] +
+            [(-26.0871, 27.9928)] * 3)
+        to_points = [Point(-26.0893 + i * 0.00026, 27.981 + i * 0.00082) for i in range(20)]
+        for to_point in to_points:
+            (r_point1, r_point2), r_cpoint, r_dist = find_closest_point_pair_reference(points, to_point)
+            for kwargs in ({}, {'chunk_size': 5}, {'chunk_size': 1}):
+                (point1, point2), cpoint, dist = find_closest_point_pair(points, to_point, **kwargs)
+                self.assertEqual((point1.index, point2.index), (r_point1.index, r_point2.index))
+                self.assertAlmostEqual(cpoint.lat, r_cpoint.lat, places=9)
+                self.assertAlmostEqual(cpoint.lng, r_cpoint.lng, places=9)
+                self.assertAlmostEqual(dist, r_dist, delta=0.001)
+
+    def test_find_closest_point_pair_indexed_matches_reference(self):
+        # A route that loops back over it's self 3 times.
+        points = route_with_distance_and_index(
+            [(-26.09 + (i % 50) * 0.0002, 27.98 + (i % 50) * 0.0001 + (i // 50) * 0.00005) for i in range(150)])
+        to_points = [Point(-26.0895 + i * 0.0002, 27.98 + i * 0.00012) for i in range(0, 48, 3)]
+        for start in (1, 20, 60, 149):
+            route_slice = RouteSlice(points, start, points[start - 1])
+            for to_point in to_points:
+                self.assertEqual(find_closest_point_pair(route_slice, to_point),
+                                 find_closest_point_pair_reference(list(route_slice), to_point))
+
+    def test_find_closest_point_pair_indexed_far_from_route(self):
+        # Nothing within stop_after_dist, so the closest of all is wanted, as the in order scan finds.
+        points = route_with_distance_and_index(
+            [(-26.09 + (i % 50) * 0.0002, 27.98 + (i % 50) * 0.0001 + (i // 50) * 0.00005) for i in range(150)])
+        to_points = [Point(-26.0905 - i * 0.0004, 27.9795 + (i % 4) * 0.0015) for i in range(12)]
+        for start in (1, 20, 60, 149):
+            route_slice = RouteSlice(points, start, Point(points[start - 1].lat + 0.0008, points[start - 1].lng - 0.002))
+            for to_point in to_points:
+                expected = scan_closest_point_pair(route_slice, to_point)
+                self.assertGreater(expected[2], 50)
+                self.assertEqual(find_closest_point_pair_indexed(route_slice, to_point), expected)
+
+    def test_segment_index(self):
+        points = route_with_distance_and_index(
+            [(-26.09 + (i % 50) * 0.0002, 27.98 + (i % 50) * 0.0001 + (i // 50) * 0.00005) for i in range(150)])
+        segment_index = SegmentIndex.build(points.nv, cell_size=50)
+        all_segments = numpy.arange(len(points) - 1)
+        for to_point in (Point(-26.085, 27.982), Point(-26.0899, 27.9811), Point(-26.07, 27.99)):
+            distances = segment_index.segment_distances(to_point, all_segments)
+            self.assertEqual(segment_index.within(to_point, 60).tolist(), all_segments[distances <= 60].tolist())
+            self.assertEqual(segment_index.within(to_point, 60, 40, 100).tolist(),
+                             [i for i in all_segments[distances <= 60] if 40 <= i < 100])
+            nearest = segment_index.nearest(to_point, 3, 10, 120)
+            self.assertEqual(sorted(distances[nearest]), sorted(distances[10:120])[:3])
+
+    def test_find_closest_point_pair_endpoint(self):
+        points = [Point(0, 0), Point(0, 1)]
+        closest_point_pair, cpoint, dist = find_closest_point_pair(points, Point(0, 1.5))
+        self.assertEqual(closest_point_pair, (Point(0, 0), Point(0, 1)))
+        self.assertIs(cpoint, points[1])
+        self.assertAlmostEqual(dist, distance(Point(0, 1), Point(0, 1.5)))
+
     def test_iter_route_points_with_set_spacing(self):
         points = [Point(0, 0), Point(0, 0.1), Point(0.1, 0.1)]
         points_with_minimal_spacing = list(iter_route_points_with_set_spacing(geodesic.InverseLine, points, spacing=4000))
@@ -42,6 +171,49 @@ class TestHelpers(unittest.TestCase):
             (Point(lat=0.0801999452098834, lng=0.1), Point(lat=0, lng=0.1), 20000.0, 4000)
         ])
 
+    def test_route_points(self):
+        points = route_with_distance_and_index([(0, 0), (0, 0.001), (0.001, 0.001)], exact=True)
+        self.assertIsInstance(points, RoutePoints)
+        self.assertEqual(len(points), 3)
+        self.assertEqual(points[1], IndexedPoint(lat=0, lng=0.001, index=1, distance=distance(Point(0, 0), Point(0, 0.001))))
+        self.assertEqual(points[-1].index, 2)
+        self.assertEqual(list(points), [points[0], points[1], points[2]])
+        self.assertEqual(points[1:], [points[1], points[2]])
+        self.assertEqual(points, list(points))
+        self.assertEqual(points.lat_lng_list(), [[0, 0], [0, 0.001], [0.001, 0.001]])
+        self.assertTrue((points[2].nv == Point(0.001, 0.001).nv).all())
+
+    def test_route_with_distance_and_index_exact(self):
+        route = [(-26.09321, 27.98130), (-26.09330, 27.98154), (-26.09341, 27.98186), (-26.5, 28.1), (-26.5, 28.1)]
+        approx_points = route_with_distance_and_index(route)
+        exact_points = route_with_distance_and_index(route, exact=True)
+        expected_distances = [0]
+        for (lat1, lng1), (lat2, lng2) in zip(route, route[1:]):
+            expected_distances.append(expected_distances[-1] + geodesic.Inverse(lat1, lng1, lat2, lng2)['s12'])
+        self.assertEqual(exact_points.distance.tolist(), expected_distances)
+        for approx_distance, expected_distance in zip(approx_points.distance, expected_distances):
+            self.assertAlmostEqual(approx_distance, expected_distance, places=3)
+
+    def test_route_slice(self):
+        points = route_with_distance_and_index([(0, 0), (0, 0.001), (0.001, 0.001), (0.001, 0.002)])
+        first_point = Point(0, 0.0005)
+        route_slice = RouteSlice(points, 1, first_point)
+        expected = [first_point] + points[1:]
+        self.assertEqual(len(route_slice), len(expected))
+        self.assertEqual(list(route_slice), expected)
+        self.assertEqual(route_slice[-1], expected[-1])
+        self.assertEqual(route_slice[1:3], expected[1:3])
+        with self.assertRaises(IndexError):
+            route_slice[len(expected)]
+
+        inverse_line_cached = functools.lru_cache(32)(geodesic.InverseLine)
+        self.assertEqual(
+            list(iter_route_points_with_set_spacing(inverse_line_cached, route_slice, spacing=30)),
+            list(iter_route_points_with_set_spacing(inverse_line_cached, expected, spacing=30)))
+        self.assertEqual(
+            find_closest_point_pair(route_slice, Point(0.0005, 0.0011)),
+            find_closest_point_pair(expected, Point(0.0005, 0.0011)))
+
     def test_point_from_distance_on_route(self):
         inverse_line_cached = functools.lru_cache(32)(geodesic.InverseLine)
         route = [Point(0, 0), Point(0, 0.0001), Point(0.0001, 0.0001)]
@@ -50,6 +222,17 @@ class TestHelpers(unittest.TestCase):
         self.assertEqual((geo10['lat2'], geo10['lon2']), (0.0, 8.983152841195216e-05))
         self.assertEqual((geo20['lat2'], geo20['lon2']), (8.019994573584536e-05, 0.0001))
 
+    def test_point_from_distance_on_route_slice(self):
+        inverse_line_cached = functools.lru_cache(32)(geodesic.InverseLine)
+        points = route_with_distance_and_index([(0, 0), (0, 0.0001), (0.0001, 0.0001), (0.0001, 0.0003), (0.0002, 0.0003)])
+        for start, first_point in ((1, Point(0, 0.00005)), (2, Point(0.00005, 0.0001)), (4, Point(0.0001, 0.0003))):
+            route_slice = RouteSlice(points, start, first_point)
+            for dist in (0, 3, 5.55, 10, 17, 25, 31, 43, 60, 100):
+                geo = geo_from_distance_on_route(inverse_line_cached, route_slice, dist)
+                expected_geo = geo_from_distance_on_route(inverse_line_cached, list(route_slice), dist)
+                for key in ('lat2', 'lon2', 'azi1'):
+                    self.assertAlmostEqual(geo[key], expected_geo[key], places=6)
+
 
 class TestPointProcess(unittest.TestCase):
 
@@ -64,19 +247,19 @@ class TestPointProcess(unittest.TestCase):
             lmdbtempdir = stack.enter_context(tempfile.TemporaryDirectory())
             lmdb_env = stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10))
 
-            tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+            store = RouteStore(lmdb_env)
             api = GoogleApi(api_key, lmdb_env, asyncio.get_event_loop())
 
             def change_callback(change):
                 pprint.pprint(change)
 
-            yield api, tempdir, change_callback
+            yield api, store, change_callback
 
     @unittest_run_loop
     async def test_process1(self):
-        with self.process_stack() as (api, tempdir, change_callback):
+        with self.process_stack() as (api, store, change_callback):
             async with api:
-                route = Route(None, tempdir, change_callback, name='Test Route', google_api=api)
+                route = Route(None, store, change_callback, name='Test Route', google_api=api)
                 await route.save_metadata()
                 await route.set_route_points(route_with_distance_and_index([
                     (-26.09332, 27.98120),
@@ -86,8 +269,9 @@ class TestPointProcess(unittest.TestCase):
                 await route.process_task
                 self.assertTrue(route.processing_complete)
 
-                loaded_route = await Route.load(None, tempdir, change_callback)
+                loaded_route = await Route.load(None, store, change_callback)
                 await loaded_route.ensure_data_loaded()
+                await loaded_route.ensure_panos_loaded()
 
                 self.maxDiff = None
                 self.assertEqual(route.route_points, loaded_route.route_points)
@@ -97,9 +281,9 @@ class TestPointProcess(unittest.TestCase):
     async def test_process2(self):
         # This route would go into an infinate loop at the end. Test to make sure it finishes.
 
-        with self.process_stack() as (api, tempdir, change_callback):
+        with self.process_stack() as (api, store, change_callback):
             async with api:
-                route = Route(None, tempdir, change_callback, name='Test Route', google_api=api)
+                route = Route(None, store, change_callback, name='Test Route', google_api=api)
                 await route.set_route_points(route_with_distance_and_index([
                     (45.03778, 6.92901),
                     (45.03790, 6.92922),
@@ -108,3 +292,285 @@ class TestPointProcess(unittest.TestCase):
                 await route.start_processing()
                 await route.process_task
                 self.assertTrue(route.processing_complete)
+
+
+class TestSegmentedProcess(unittest.TestCase):
+
+    async def process_route(self, route_lat_lngs, add_panos, **route_kwargs):
+        async with AsyncExitStack() as stack:
+            api, stub = await make_stub_api(stack)
+            add_panos(stub)
+            store = RouteStore(api.lmdb_env)
+            changes = []
+
+            async def change_callback(change):
+                changes.append(change)
+
+            route = Route('test', store, change_callback, name='Test Route', google_api=api, **route_kwargs)
+            await route.set_route_points(route_with_distance_and_index(route_lat_lngs))
+            await route.start_processing()
+            await route.process_task
+            self.assertTrue(route.processing_complete)
+            sent_panos = [pano for change in changes if 'panos' in change for pano in change['panos']]
+            self.assertEqual(sent_panos, route.panos)
+            self.assertTrue(route.panos[-1]['last'])
+            self.assertIn({'last_pano_index': len(route.panos) - 1}, changes)
+            return route, changes
+
+    @unittest_run_loop
+    async def test_matches_sequential(self):
+        # A 3 km route heading east, with panos every ~20 m that link to their neighbours, and a gap with no panos.
+        route_lat_lngs = [(-26.0, 28.0 + i * 0.001) for i in range(31)]
+        pano_lngs = [lng for lng in numpy.arange(28.0, 28.03, 0.0002).tolist() if not 28.0205 < lng < 28.0225]
+        pano_ids = [id_encode(struct.pack('>QQ', 0, i)).decode() for i in range(len(pano_lngs))]
+
+        def add_panos(stub):
+            for i, (pano_id, lng) in enumerate(zip(pano_ids, pano_lngs)):
+                stub.add_pano(pano_id, -26.00002, lng)
+                links = []
+                if i + 1 < len(pano_ids) and pano_lngs[i + 1] - lng < 0.0003:
+                    links.append({'panoId': pano_ids[i + 1], 'yawDeg': '90'})
+                if i and lng - pano_lngs[i - 1] < 0.0003:
+                    links.append({'panoId': pano_ids[i - 1], 'yawDeg': '270'})
+                stub.panos[pano_id]['Links'] = links
+
+        sequential, _ = await self.process_route(route_lat_lngs, add_panos)
+        segmented, changes = await self.process_route(route_lat_lngs, add_panos, segments=3, min_segment_length=500)
+
+        self.assertGreater(len([change for change in changes if 'segment_panos' in change]), 0)
+        self.assertEqual([pano.get('id') for pano in segmented.panos], [pano.get('id') for pano in sequential.panos])
+        self.assertEqual([pano['type'] for pano in segmented.panos], [pano['type'] for pano in sequential.panos])
+        self.assertIn('no_images', [pano['type'] for pano in segmented.panos])
+        for segmented_pano, sequential_pano in zip(segmented.panos, sequential.panos):
+            self.assertAlmostEqual(segmented_pano['at_dist'], sequential_pano['at_dist'], delta=1)
+
+    @unittest_run_loop
+    async def test_prefetch_stays_on_route(self):
+        # A road heading east, with panos every ~20 m, and side streets heading north off every third one.
+        route_lat_lngs = [(-26.0, 28.0 + i * 0.001) for i in range(7)]
+        pano_lngs = numpy.arange(28.0, 28.006, 0.0002).tolist()
+        pano_ids = [id_encode(struct.pack('>QQ', 0, i)).decode() for i in range(len(pano_lngs))]
+        side_ids = set()
+
+        def add_panos(stub):
+            stubs.append(stub)
+            for i, (pano_id, lng) in enumerate(zip(pano_ids, pano_lngs)):
+                stub.add_pano(pano_id, -26.00002, lng)
+                links = []
+                if i + 1 < len(pano_ids):
+                    links.append({'panoId': pano_ids[i + 1], 'yawDeg': '90'})
+                if i:
+                    links.append({'panoId': pano_ids[i - 1], 'yawDeg': '270'})
+                if i % 3 == 0:
+                    side = [id_encode(struct.pack('>QQ', i + 1, j)).decode() for j in range(5)]
+                    side_ids.update(side)
+                    links.append({'panoId': side[0], 'yawDeg': '0'})
+                    for j, side_id in enumerate(side):
+                        stub.add_pano(side_id, -26.00002 + (j + 1) * 0.0002, lng)
+                        stub.panos[side_id]['Links'] = (
+                            [{'panoId': side[j + 1], 'yawDeg': '0'}] if j + 1 < len(side) else []) + [
+                            {'panoId': side[j - 1] if j else pano_id, 'yawDeg': '180'}]
+                stub.panos[pano_id]['Links'] = links
+
+        stubs = []
+        sequential, _ = await self.process_route(route_lat_lngs, add_panos)
+        pipelined, _ = await self.process_route(route_lat_lngs, add_panos, pipeline_depth=4)
+
+        self.assertEqual([pano.get('id') for pano in pipelined.panos], [pano.get('id') for pano in sequential.panos])
+        sequential_stub, pipelined_stub = stubs
+        requested_ids = {query['panoid'] for kind, query in pipelined_stub.requests if 'panoid' in query}
+        self.assertFalse(requested_ids & side_ids)
+        self.assertLessEqual(pipelined_stub.request_count(), sequential_stub.request_count() + 3)
+
+    @unittest_run_loop
+    async def test_apply_remote_change(self):
+        route_lat_lngs = [(-26.0, 28.0 + i * 0.001) for i in range(4)]
+        pano_lngs = numpy.arange(28.0, 28.003, 0.0002).tolist()
+        pano_ids = [id_encode(struct.pack('>QQ', 0, i)).decode() for i in range(len(pano_lngs))]
+
+        def add_panos(stub):
+            for i, (pano_id, lng) in enumerate(zip(pano_ids, pano_lngs)):
+                stub.add_pano(pano_id, -26.00002, lng)
+                stub.panos[pano_id]['Links'] = [{'panoId': pano_ids[i + 1], 'yawDeg': '90'}] if i + 1 < len(pano_ids) else []
+
+        route, changes = await self.process_route(route_lat_lngs, add_panos, segments=2, min_segment_length=100)
+
+        # A copy in another process, that was loaded before processing started.
+        copy = Route('test', None, None)
+        copy.data_loaded = copy.panos_loaded = True
+        for change in changes:
+            change = EncodedChange.from_msgpack(EncodedChange(change).msgpack).change
+            if 'route_version' not in change:
+                copy.apply_remote_change(change)
+        self.assertEqual(copy.processing_status, route.processing_status)
+        self.assertTrue(copy.processing_complete)
+        self.assertEqual(copy.panos_len_at_last_save, len(route.panos))
+        self.assertEqual([(pano['type'], pano.get('id'), pano['at_dist']) for pano in copy.panos],
+                         [(pano['type'], pano.get('id'), pano['at_dist']) for pano in route.panos])
+        self.assertEqual([(pano['point'].lat, pano['point'].lng) for pano in copy.panos],
+                         [(pano['point'].lat, pano['point'].lng) for pano in route.panos])
+        self.assertTrue(copy.panos[-1]['last'])
+
+        copy.apply_remote_change({'reset_panos_index': 1, 'panos_epoch': 5})
+        self.assertEqual(len(copy.panos), 2)
+        self.assertEqual(copy.panos_epoch, 5)
+
+        copy.apply_remote_change(route.route_points_change())
+        self.assertFalse(copy.data_loaded)
+
+    @unittest_run_loop
+    async def test_error_before_crawl(self):
+        class FailingApi(object):
+            async def get_pano_id(self, id, client=None):
+                raise ValueError('Api down.')
+
+        async with AsyncExitStack() as stack:
+            lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+            store = RouteStore(await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10)))
+
+            async def change_callback(change):
+                pass
+
+            route = Route('test', store, change_callback, name='Test Route', google_api=FailingApi())
+            await route.set_route_points(route_with_distance_and_index([(-26.0, 28.0), (-26.0, 28.001), (-26.0, 28.002)]))
+            route.panos = [dict(type='pano', id='A' * 22, point=Point(-26.0, 28.0005), prev_route_index=0, at_dist=50.0)]
+            await route.start_processing()
+            await route.process_task
+            self.assertEqual(route.processing_status['text'], 'Processing error: Api down.')
+            self.assertTrue(route.processing_status['resumable'])
+
+    def test_join_segments(self):
+        segment = ProcessSegment(index=0, start_index=0, stop_distance=100)
+        next_segment = ProcessSegment(index=1, start_index=10)
+        for i, at_dist in enumerate((60, 90, 110, 130)):
+            segment.add(dict(type='pano', id='a{}'.format(i), at_dist=at_dist, dist_from_last=30))
+        for i, at_dist in enumerate((100, 120)):
+            next_segment.add(dict(type='pano', id='b{}'.format(i), at_dist=at_dist, dist_from_last=20))
+        # No pano in common, so joined at the start of next_segment.
+        self.assertEqual(join_segments(segment, next_segment, 2), (2, 0))
+        self.assertEqual(next_segment.panos[0]['dist_from_last'], 10)
+
+        next_segment.add(dict(type='pano', id='a2', at_dist=110, dist_from_last=10))
+        self.assertEqual(join_segments(segment, next_segment, 2), (3, 3))
+
+
+class TestExistingChanges(unittest.TestCase):
+
+    @unittest_run_loop
+    async def test_only_what_client_does_not_have(self):
+        async with AsyncExitStack() as stack:
+            lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+            store = RouteStore(await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10)))
+
+            async def change_callback(change):
+                pass
+
+            route = Route('test', store, change_callback, name='Test Route')
+            await route.save_metadata()
+            await route.set_route_points(route_with_distance_and_index([(-26.1, 28.0), (-26.1, 28.01), (-26.1, 28.02)]))
+            route.panos = [{'type': 'pano', 'id': str(i), 'at_dist': i * 10.0} for i in range(10)]
+            route.processing_status = {'processing': False}
+            route_version = route.route_version
+            epoch = route.panos_epoch
+
+            def changes(**have):
+                # Without the meta and status, which are always sent.
+                return [{key: len(value) if key == 'panos' else value for key, value in change.items()
+                         if key not in ('route_bounds', 'route_distance', 'route_detail_levels', 'route_level', 'route_polyline', 'route_indexes')}
+                        for change in list(route.get_existing_changes(**have))[1:]]
+
+            # Not processing, so loaded in windows.
+            self.assertEqual(changes(), [{'route_version': route_version}, {'panos_epoch': epoch}, {'panos_windowed': True}])
+            route.process_task = asyncio.Future()
+
+            self.assertEqual(changes(), [{'route_version': route_version}, {'panos_epoch': epoch}, {'panos': 10}])
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch, panos_count=10), [])
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch, panos_count=4), [{'panos': 6}])
+
+            await route.reset_panos(6)
+            self.assertEqual(route.panos_epoch, epoch + 1)
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch, panos_count=10),
+                             [{'reset_panos_index': 5, 'panos_epoch': epoch + 1}])
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch, panos_count=3),
+                             [{'panos_epoch': epoch + 1}, {'panos': 3}])
+            # More than we have.
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch + 1, panos_count=8),
+                             [{'reset_panos_index': 5, 'panos_epoch': epoch + 1}])
+            # An epoch we don't know.
+            self.assertEqual(changes(route_version=route_version, panos_epoch=epoch + 5, panos_count=3),
+                             [{'reset_panos_index': -1, 'panos_epoch': epoch + 1}, {'panos': 6}])
+
+            loaded_route = await Route.load('test', store, change_callback)
+            await loaded_route.ensure_data_loaded()
+            self.assertEqual(loaded_route.route_version, route_version)
+            self.assertEqual(loaded_route.panos_resets, route.panos_resets)
+            # Panos are not loaded, but what was saved is still counted.
+            self.assertFalse(loaded_route.panos_loaded)
+            saved_panos_count = await loaded_route.load_panos_count()
+            self.assertEqual(saved_panos_count, 6)
+            self.assertEqual(list(loaded_route.get_existing_changes(route_version=route_version, panos_epoch=epoch + 1, panos_count=8,
+                                                                    saved_panos_count=saved_panos_count))[1:],
+                             [{'reset_panos_index': 5, 'panos_epoch': epoch + 1}, {'panos_windowed': True}])
+            self.assertEqual(await loaded_route.load_panos_window(15, 35), route.panos[2:4])
+            self.assertEqual(await route.load_panos_window(15, 35), route.panos[2:4])
+
+            await loaded_route.ensure_panos_loaded()
+            self.assertEqual(loaded_route.panos, route.panos)
+
+
+class TestRouteDetail(unittest.TestCase):
+
+    def douglas_peucker(self, x, y, start, end, tolerance):
+        if end - start < 2:
+            return [start]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        dists = [abs(dx * (y[i] - y[start]) - dy * (x[i] - x[start])) / (dx * dx + dy * dy) ** 0.5
+                 for i in range(start + 1, end)]
+        i = max(range(len(dists)), key=dists.__getitem__)
+        if dists[i] < tolerance:
+            return [start]
+        mid = start + 1 + i
+        return self.douglas_peucker(x, y, start, mid, tolerance) + self.douglas_peucker(x, y, mid, end, tolerance)
+
+    def test_route_points_detail(self):
+        rng = numpy.random.RandomState(1)
+        lat = -26.1 + numpy.cumsum(rng.normal(0, 0.0003, 300))
+        lng = 28.0 + numpy.cumsum(rng.normal(0.0002, 0.0003, 300))
+        detail = route_points_detail(lat, lng)
+
+        y = numpy.deg2rad(lat) * 6371008.8
+        x = numpy.deg2rad(lng) * 6371008.8 * numpy.cos(numpy.deg2rad(lat.mean()))
+        for tolerance in (1000, 300, 100, 30, 10, 3):
+            self.assertEqual(numpy.flatnonzero(detail >= tolerance).tolist(),
+                             self.douglas_peucker(x, y, 0, len(lat) - 1, tolerance) + [len(lat) - 1])
+        self.assertTrue((detail >= 0).all())
+
+    def test_polyline_encode(self):
+        # The example from Google's encoded polyline format documentation.
+        lat = numpy.round(numpy.array([38.5, 40.7, 43.252]) * 1e5)
+        lng = numpy.round(numpy.array([-120.2, -120.95, -126.453]) * 1e5)
+        self.assertEqual(polyline_encode(lat, lng), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        self.assertEqual(polyline_encode(numpy.array([0, 1, 100])), '?AeE')
+
+    @unittest_run_loop
+    async def test_saved_when_missing(self):
+        async with AsyncExitStack() as stack:
+            lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+            store = RouteStore(await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10)))
+
+            async def change_callback(change):
+                pass
+
+            route = Route('test', store, change_callback, name='Test Route')
+            await route.save_metadata()
+            await route.set_route_points(route_with_distance_and_index([(-26.1, 28.0), (-26.1, 28.01), (-26.09, 28.02)]))
+            # As saved before route_detail was added.
+            saved_route = store.load('test', 'route')
+            del saved_route['route_detail']
+            store.save('test', 'route', saved_route)
+
+            loaded_route = await Route.load('test', store, change_callback)
+            await loaded_route.ensure_data_loaded()
+            numpy.testing.assert_array_equal(loaded_route.route_detail, route.route_detail)
+            self.assertEqual(numpy.frombuffer(store.load('test', 'route')['route_detail'], dtype='<f4').tolist(),
+                             route.route_detail.astype('<f4').tolist())
@@ -0,0 +1,64 @@
+import tempfile
+import unittest
+
+import lmdb
+import numpy
+
+from route_view.async_exit_stack import AsyncExitStack
+from route_view.core import (
+    find_closest_point_pair,
+    Point,
+    Route,
+    route_with_distance_and_index,
+    RouteSlice,
+)
+from route_view.geometry_pool import GeometryPool
+from route_view.route_store import RouteStore
+from route_view.tests import unittest_run_loop
+
+
+class TestGeometryPool(unittest.TestCase):
+
+    @unittest_run_loop
+    async def test_matches_in_process(self):
+        # A route that loops back over it's self 3 times.
+        lat_lngs = [(-26.09 + (i % 50) * 0.0002, 27.98 + (i % 50) * 0.0001 + (i // 50) * 0.00005) for i in range(150)]
+        points = route_with_distance_and_index(lat_lngs)
+        to_points = [Point(-26.0895 + i * 0.0002, 27.98 + i * 0.00012) for i in range(0, 48, 3)] + [Point(-26.07, 27.99)]
+
+        async with GeometryPool(processes=1) as pool:
+            pool_points = await pool.route_with_distance_and_index(lat_lngs)
+            for name in ('lat', 'lng', 'distance', 'nv'):
+                numpy.testing.assert_array_equal(getattr(pool_points, name), getattr(points, name))
+
+            for start, first_point in ((1, points[0]), (20, points[19]), (60, Point(-26.0885, 27.9807)), (149, points[148])):
+                route_slice = RouteSlice(points, start, first_point)
+                for to_point in to_points:
+                    self.assertEqual(await pool.find_closest_point_pair(route_slice, to_point),
+                                     find_closest_point_pair(route_slice, to_point))
+
+            empty_slice = RouteSlice(points, len(points), points[-1])
+            self.assertEqual(await pool.find_closest_point_pair(empty_slice, to_points[0]), (None, None, None))
+            self.assertEqual(pool.stats()['calls'], 1 + 4 * len(to_points) + 1)
+
+    @unittest_run_loop
+    async def test_route_loaded_in_pool(self):
+        async with AsyncExitStack() as stack:
+            lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+            store = RouteStore(await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10)))
+            pool = await stack.enter_context(GeometryPool(processes=1))
+
+            async def change_callback(change):
+                pass
+
+            route = Route('test', store, change_callback, name='Test Route')
+            await route.save_metadata()
+            await route.set_route_points(route_with_distance_and_index([(-26.1, 28.0), (-26.1, 28.01), (-26.09, 28.02)]))
+
+            loaded_route = await Route.load('test', store, change_callback)
+            loaded_route.geometry_pool = pool
+            await loaded_route.ensure_data_loaded()
+            self.assertEqual(pool.stats()['calls'], 1)
+            for name in ('lat', 'lng', 'distance', 'nv'):
+                numpy.testing.assert_array_equal(getattr(loaded_route.route_points, name), getattr(route.route_points, name))
+            self.assertEqual(loaded_route.route_version, route.route_version)
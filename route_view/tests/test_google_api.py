@@ -0,0 +1,382 @@
+import asyncio
+import contextlib
+import json
+import struct
+import tempfile
+import unittest
+
+import aiohttp
+import lmdb
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from route_view.async_exit_stack import AsyncExitStack
+from route_view.core import GoogleApi, Point
+from route_view.scheduler import ApiQuotaExceeded
+from route_view.tests import unittest_run_loop
+from route_view.util import id_decode
+
+
+def pano_data(pano_id, lat, lng):
+    return {'Location': {'panoId': pano_id, 'lat': str(lat), 'lng': str(lng), 'description': ''}, 'Links': []}
+
+
+class StubApiServer(object):
+    """Local stand in for the street view api endpoints, that records the requests made to it.
+
+    Add to ``delays`` to delay the next responses, and to ``fail_statuses`` to make the next responses fail.
+    """
+
+    def __init__(self):
+        self.panos = {}
+        self.requests = []
+        self.delays = []
+        self.fail_statuses = []
+        self.app = web.Application()
+        self.app.router.add_route('GET', '/cbk', self.cbk)
+        self.app.router.add_route('GET', '/streetview', self.streetview)
+        self.server = TestServer(self.app)
+
+    def add_pano(self, pano_id, lat, lng):
+        self.panos[pano_id] = pano_data(pano_id, lat, lng)
+
+    async def injected_failure(self):
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        if self.fail_statuses:
+            return web.Response(status=self.fail_statuses.pop(0))
+
+    async def cbk(self, request):
+        self.requests.append(('cbk', dict(request.query)))
+        failure = await self.injected_failure()
+        if failure:
+            return failure
+        if 'panoid' in request.query:
+            return web.Response(text=json.dumps(self.panos.get(request.query['panoid'], {})))
+        lat, lng = (float(item) for item in request.query['ll'].split(','))
+        radius = float(request.query['radius'])
+        for data in self.panos.values():
+            location = data['Location']
+            # Good enough for the small distances used in tests.
+            if ((float(location['lat']) - lat) ** 2 + (float(location['lng']) - lng) ** 2) ** 0.5 * 111000 <= radius:
+                return web.Response(text=json.dumps(data))
+        return web.Response(text='{}')
+
+    async def streetview(self, request):
+        self.requests.append(('streetview', dict(request.query)))
+        failure = await self.injected_failure()
+        if failure:
+            return failure
+        return web.Response(body=b'jpeg:' + request.query['pano'].encode(), content_type='image/jpeg')
+
+    def request_count(self, kind='cbk'):
+        return len([request for request in self.requests if request[0] == kind])
+
+
+async def make_stub_api(stack, **kwargs):
+    """Make a GoogleApi that uses a StubApiServer. Returns ``(api, stub)``."""
+    stub = StubApiServer()
+    await stack.enter_context(stub.server)
+    lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+    lmdb_env = await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10))
+    api = GoogleApi('test_key', lmdb_env, **kwargs)
+    api.cbk_url = str(stub.server.make_url('/cbk'))
+    api.streetview_url = str(stub.server.make_url('/streetview'))
+    await stack.enter_context(api)
+    return api, stub
+
+
+class TestGoogleApi(unittest.TestCase):
+
+    async def make_api(self, stack, **kwargs):
+        return await make_stub_api(stack, **kwargs)
+
+    async def flush_cache(self, api):
+        # Let the writer get to it's wait before writing, then cancel it, which makes it write what it has straight
+        # away.
+        await asyncio.sleep(0)
+        api.write_cache_items_fut.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await api.write_cache_items_fut
+
+    @unittest_run_loop
+    async def test_get_pano_ll_cache(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+
+            data = await api.get_pano_ll(Point(-26.09001, 27.98), radius=10)
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(await api.get_pano_ll(Point(-26.09001, 27.98), radius=10), data)
+            # Filled the pano id cache too.
+            self.assertEqual(await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA'), data)
+            self.assertEqual(stub.request_count(), 1)
+
+            # No pano here. Negative answers are cached too.
+            self.assertEqual(await api.get_pano_ll(Point(-26.1, 27.98), radius=10), {})
+            self.assertEqual(await api.get_pano_ll(Point(-26.1, 27.98), radius=10), {})
+            self.assertEqual(stub.request_count(), 2)
+
+            # Different radius is a different key.
+            await api.get_pano_ll(Point(-26.09001, 27.98), radius=20)
+            self.assertEqual(stub.request_count(), 3)
+
+            # Still cached after being written to lmdb.
+            await self.flush_cache(api)
+            self.assertEqual(api.get_pano_ll_unwriten_cache, {})
+            self.assertEqual(await api.get_pano_ll(Point(-26.09001, 27.98), radius=10), data)
+            self.assertEqual(stub.request_count(), 3)
+
+    @unittest_run_loop
+    async def test_get_pano_id_data_cache(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            data = await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            await self.flush_cache(api)
+            self.assertIs(await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA'), data)
+            self.assertEqual(api.stats()['pano_data_cache']['hits'], 1)
+
+            # Loaded from lmdb when not in memory.
+            api.pano_data_cache.items.clear()
+            self.assertEqual(await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA'), data)
+            self.assertEqual(api.pano_data_cache.stats()['entries'], 1)
+            self.assertEqual(stub.request_count(), 1)
+
+    @unittest_run_loop
+    async def test_get_pano_ll_cache_ttl(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, ll_cache_ttl=-1, ll_cache_negative_ttl=-1)
+            await api.get_pano_ll(Point(-26.1, 27.98), radius=10)
+            await api.get_pano_ll(Point(-26.1, 27.98), radius=10)
+            self.assertEqual(stub.request_count(), 2)
+
+    @unittest_run_loop
+    async def test_get_pano_ll_prefer_local(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, prefer_local_ll=True)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            stub.add_pano('BBBBBBBBBBBBBBBBBBBBBA', -26.0901, 27.98)
+            await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            await api.get_pano_id('BBBBBBBBBBBBBBBBBBBBBA')
+            await self.flush_cache(api)
+            self.assertEqual(stub.request_count(), 2)
+
+            self.assertEqual(api.get_pano_ll_local(Point(-26.09009, 27.98), 20), 'BBBBBBBBBBBBBBBBBBBBBA')
+            self.assertEqual(api.get_pano_ll_local(Point(-26.09, 27.98001), 20), 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertIsNone(api.get_pano_ll_local(Point(-26.1, 27.98), 20))
+
+            data = await api.get_pano_ll(Point(-26.09009, 27.98), radius=20)
+            self.assertEqual(data['Location']['panoId'], 'BBBBBBBBBBBBBBBBBBBBBA')
+            self.assertEqual(stub.request_count(), 2)
+
+            # Not found locally, so asks the api.
+            await api.get_pano_ll(Point(-26.1, 27.98), radius=20)
+            self.assertEqual(stub.request_count(), 3)
+
+    @unittest_run_loop
+    async def test_pano_location_index_built_for_existing_cache(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            await self.flush_cache(api)
+            with api.lmdb_env.begin(write=True) as tx:
+                tx.drop(api.pano_location_index_db, delete=False)
+
+            api2 = GoogleApi('test_key', api.lmdb_env)
+            await stack.enter_context(api2)
+            self.assertEqual(api2.get_pano_ll_local(Point(-26.09, 27.98), 20), 'AAAAAAAAAAAAAAAAAAAAAA')
+
+    @unittest_run_loop
+    async def test_retry(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retry_base_delay=0.001)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            stub.fail_statuses = [503, 500]
+            data = await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(stub.request_count(), 3)
+            self.assertEqual(api.stats()['requests']['retries'], 2)
+
+    @unittest_run_loop
+    async def test_retry_gives_up(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retries=1, retry_base_delay=0.001)
+            stub.fail_statuses = [503, 503, 503]
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 0)
+            self.assertEqual(stub.request_count('streetview'), 2)
+
+    @unittest_run_loop
+    async def test_client_error_not_retried(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retry_base_delay=0.001)
+            stub.fail_statuses = [403]
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 0)
+            self.assertEqual(stub.request_count('streetview'), 1)
+
+    @unittest_run_loop
+    async def test_circuit_breaker(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retries=1, retry_base_delay=0.001,
+                                            circuit_breaker_failures=2, circuit_breaker_reset=0.05)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            # More failures than retries, but once the breaker is open, it waits for the api rather than failing.
+            stub.fail_statuses = [503, 503, 503, 503]
+            data = await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(stub.request_count(), 5)
+            stats = api.stats()['requests']
+            self.assertEqual(stats['retries'], 1)
+            self.assertEqual(stats['circuit_breaker'], {'state': 'closed', 'failures': 0, 'opens': 1})
+
+    @unittest_run_loop
+    async def test_circuit_breaker_probe_client_error(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retries=0, circuit_breaker_failures=1, circuit_breaker_reset=0.05)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            # The probe gets a 404, which is not retried.
+            stub.fail_statuses = [503, 404]
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(api.stats()['requests']['circuit_breaker']['state'], 'open')
+            data = await asyncio.wait_for(api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA'), 1)
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(api.stats()['requests']['circuit_breaker']['state'], 'closed')
+
+    @unittest_run_loop
+    async def test_circuit_breaker_probe_quota_exceeded(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, retries=0, circuit_breaker_failures=1, circuit_breaker_reset=0.05,
+                                            daily_quota=1)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            stub.fail_statuses = [503]
+            with self.assertRaises(ApiQuotaExceeded):
+                await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(api.stats()['requests']['circuit_breaker']['state'], 'open')
+            api.scheduler.daily_quota = None
+            data = await asyncio.wait_for(api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA'), 1)
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(stub.request_count(), 2)
+
+    @unittest_run_loop
+    async def test_hedged_request(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, hedge_delay=0.02)
+            stub.add_pano('AAAAAAAAAAAAAAAAAAAAAA', -26.09, 27.98)
+            stub.delays = [5]
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            data = await api.get_pano_id('AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertLess(loop.time() - start, 1)
+            self.assertEqual(data['Location']['panoId'], 'AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(stub.request_count(), 2)
+            self.assertEqual(api.stats()['requests']['hedged'], 1)
+
+    @unittest_run_loop
+    async def test_connections_reused(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack)
+            for heading in range(3):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', heading)
+            stats = api.stats()['connections']
+            self.assertEqual(stats['created'], 1)
+            self.assertEqual(stats['reused'], 2)
+
+    @unittest_run_loop
+    async def test_write_buffer_flushes_early_when_full(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, write_interval=3600, write_buffer_max_items=3, write_batch_bytes=1)
+            for heading in range(3):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', heading)
+            self.assertEqual(api.write_buffer_items, 3)
+            # Give the writer time to write the batches.
+            for _ in range(100):
+                if not api.write_buffer_items:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(api.get_pano_img_unwriten_cache, {})
+            self.assertEqual(api.write_buffer_bytes, 0)
+            with api.lmdb_env.begin() as tx:
+                self.assertEqual(tx.stat(api.get_pano_img_db)['entries'], 3)
+            self.assertEqual(api.stats()['write_buffer']['flushes'], 1)
+
+            # Still readable after being written.
+            await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 0)
+            self.assertEqual(stub.request_count('streetview'), 3)
+
+    @unittest_run_loop
+    async def test_write_buffer_backpressure(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, write_interval=3600, write_buffer_max_items=1)
+            # Stop the writer, so that it can't keep up.
+            api.write_cache_items_fut.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await api.write_cache_items_fut
+
+            await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 0)
+            await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 1)
+            blocked = asyncio.ensure_future(api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 2))
+            await asyncio.sleep(0.05)
+            self.assertFalse(blocked.done())
+            self.assertEqual(stub.request_count('streetview'), 2)
+            self.assertEqual(api.stats()['write_buffer']['backpressure_waits'], 1)
+
+            api.write_cache_items_fut = asyncio.ensure_future(api.write_cache_items())
+            await blocked
+            self.assertEqual(stub.request_count('streetview'), 3)
+
+    async def img_cache_evict(self, policy):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, img_cache_policy=policy, img_cache_evict_interval=3600)
+            img_cache = api.img_cache
+            img_cache.load()
+            # 0 is the most frequently used, but least recently used.
+            for _ in range(3):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', 0)
+            for heading in range(1, 10):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', heading)
+            await self.flush_cache(api)
+            img_cache.flush_accesses()
+            self.assertEqual(img_cache.entries, 10)
+            img_size = len(b'jpeg:AAAAAAAAAAAAAAAAAAAAAA')
+            self.assertEqual(img_cache.bytes, img_size * 10)
+
+            img_cache.max_bytes = img_size * 6
+            self.assertEqual(img_cache.evict(), 5)
+            self.assertEqual(img_cache.entries, 5)
+            self.assertEqual(img_cache.bytes, img_size * 5)
+            self.assertEqual(api.stats()['img_cache']['evictions'], 5)
+            # Under budget, so nothing more to do.
+            self.assertEqual(img_cache.evict(), 0)
+
+            with api.lmdb_env.begin() as tx:
+                self.assertEqual(tx.stat(img_cache.access_db)['entries'], 5)
+                return [
+                    heading for heading in range(10)
+                    if tx.get(id_decode('AAAAAAAAAAAAAAAAAAAAAA') + struct.pack('H', heading * 100), db=api.get_pano_img_db)
+                ]
+
+    @unittest_run_loop
+    async def test_img_cache_evict_lru(self):
+        self.assertEqual(await self.img_cache_evict('lru'), [5, 6, 7, 8, 9])
+
+    @unittest_run_loop
+    async def test_img_cache_evict_lfu(self):
+        self.assertEqual(await self.img_cache_evict('lfu'), [0, 6, 7, 8, 9])
+
+    @unittest_run_loop
+    async def test_img_cache_load_existing(self):
+        async with AsyncExitStack() as stack:
+            api, stub = await self.make_api(stack, img_cache_evict_interval=3600)
+            for i in range(3):
+                await api.get_pano_img('AAAAAAAAAAAAAAAAAAAAAA', i)
+            await self.flush_cache(api)
+            with api.lmdb_env.begin(write=True) as tx:
+                tx.drop(api.img_cache.access_db, delete=False)
+
+            api.img_cache.load()
+            self.assertEqual(api.img_cache.entries, 3)
+            self.assertEqual(api.img_cache.bytes, 3 * len(b'jpeg:AAAAAAAAAAAAAAAAAAAAAA'))
@@ -2,12 +2,21 @@ import tempfile
 import textwrap
 import unittest
 
-from route_view.core import IndexedPoint, Route
+import lmdb
+
+from route_view.core import GpxError, GpxParser, IndexedPoint, Route
+from route_view.route_store import RouteStore
 from route_view.tests import unittest_run_loop
 
 
 class TestGpx(unittest.TestCase):
 
+    def assertRoutePointsAlmostEqual(self, route_points, expected_points):
+        # Route distances are approximations, so only compare them to the mm.
+        self.assertEqual([(p.lat, p.lng, p.index) for p in route_points], [(p.lat, p.lng, p.index) for p in expected_points])
+        for point, expected_point in zip(route_points, expected_points):
+            self.assertAlmostEqual(point.distance, expected_point.distance, places=3)
+
     @unittest_run_loop
     async def test_load_route_from_gpx_11(self):
 
@@ -25,18 +34,18 @@ class TestGpx(unittest.TestCase):
             </gpx>
         """).lstrip('\n').encode()
 
-        with tempfile.TemporaryDirectory() as tempdir:
+        with tempfile.TemporaryDirectory() as tempdir, lmdb.open(tempdir, max_dbs=10) as lmdb_env:
             async def change_callback(data):
                 pass
 
-            route = Route(id=self.id(), name='foobar', dir_route=tempdir, change_callback=change_callback)
+            route = Route(id=self.id(), name='foobar', store=RouteStore(lmdb_env), change_callback=change_callback)
             await route.load_route_from_upload(gpx)
             expected_points = [
                 IndexedPoint(lat=-26.09321, lng=27.98130, index=0, distance=0),
                 IndexedPoint(lat=-26.09330, lng=27.98154, index=1, distance=25.99741939049353),
                 IndexedPoint(lat=-26.09341, lng=27.98186, index=2, distance=60.25098280725716),
             ]
-            self.assertEqual(route.route_points, expected_points)
+            self.assertRoutePointsAlmostEqual(route.route_points, expected_points)
             self.assertEqual(route.name, 'Test GPX route')
 
     @unittest_run_loop
@@ -57,16 +66,85 @@ class TestGpx(unittest.TestCase):
             </gpx>
         """).lstrip('\n').encode()
 
-        with tempfile.TemporaryDirectory() as tempdir:
+        with tempfile.TemporaryDirectory() as tempdir, lmdb.open(tempdir, max_dbs=10) as lmdb_env:
             async def change_callback(data):
                 pass
 
-            route = Route(id=self.id(), name='foobar', dir_route=tempdir, change_callback=change_callback)
+            route = Route(id=self.id(), name='foobar', store=RouteStore(lmdb_env), change_callback=change_callback)
             await route.load_route_from_upload(gpx)
             expected_points = [
                 IndexedPoint(lat=-26.09321, lng=27.98130, index=0, distance=0),
                 IndexedPoint(lat=-26.09330, lng=27.98154, index=1, distance=25.99741939049353),
                 IndexedPoint(lat=-26.09341, lng=27.98186, index=2, distance=60.25098280725716),
             ]
-            self.assertEqual(route.route_points, expected_points)
+            self.assertRoutePointsAlmostEqual(route.route_points, expected_points)
             self.assertEqual(route.name, 'Test GPX route')
+
+    @unittest_run_loop
+    async def test_load_route_from_upload_chunks(self):
+        gpx = textwrap.dedent("""
+            <?xml version="1.0"?>
+            <gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+            <metadata><name>Not the track</name></metadata>
+            <trk>
+              <name>Day 1</name>
+              <trkseg>
+                <trkpt lat="-26.09321" lon="27.9813"><ele>1600</ele><time>2018-01-01T10:00:00Z</time></trkpt>
+                <trkpt lat="-26.0933" lon="27.98154"></trkpt>
+              </trkseg>
+              <trkseg>
+                <trkpt lat="-26.09341" lon="27.98186"></trkpt>
+              </trkseg>
+            </trk>
+            <trk>
+              <name>Day 2</name>
+              <trkseg>
+                <trkpt lat="-26.09350" lon="27.98200"></trkpt>
+              </trkseg>
+            </trk>
+            </gpx>
+        """).lstrip('\n').encode()
+
+        async def chunks():
+            for i in range(0, len(gpx), 7):
+                yield gpx[i:i + 7]
+
+        with tempfile.TemporaryDirectory() as tempdir, lmdb.open(tempdir, max_dbs=10) as lmdb_env:
+            async def change_callback(data):
+                pass
+
+            route = Route(id=self.id(), name='foobar', store=RouteStore(lmdb_env), change_callback=change_callback)
+            await route.load_route_from_upload(chunks())
+            self.assertEqual([(p.lat, p.lng) for p in route.route_points],
+                             [(-26.09321, 27.9813), (-26.0933, 27.98154), (-26.09341, 27.98186), (-26.0935, 27.982)])
+            self.assertEqual(route.name, 'Day 1, Day 2')
+
+            route = Route(id=self.id() + '2', name='foobar', store=RouteStore(lmdb_env), change_callback=change_callback)
+            with self.assertRaises(GpxError):
+                await route.load_route_from_upload(
+                    b'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg><trkpt lat="1" lon="1"/></trkseg></trk></gpx>')
+
+    def test_gpx_parser_errors(self):
+        for data in (
+            b'not xml',
+            b'<?xml version="1.0"?><kml xmlns="http://www.opengis.net/kml/2.2"></kml>',
+            b'<?xml version="1.0"?><gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk>',
+            b'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg><trkpt lat="x" lon="1"/></trkseg></trk></gpx>',
+        ):
+            with self.subTest(data=data):
+                parser = GpxParser()
+                with self.assertRaises(GpxError):
+                    parser.feed(data)
+                    parser.close()
+
+    def test_gpx_parser_drops_elements(self):
+        parser = GpxParser()
+        parser.feed(b'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>')
+        for i in range(100):
+            parser.feed('<trkpt lat="{}" lon="28"><ele>10</ele></trkpt>'.format(i).encode())
+        trkseg = parser.elements[-1]
+        self.assertEqual(len(trkseg), 0)
+        parser.feed(b'</trkseg></trk></gpx>')
+        name, lat, lng = parser.close()
+        self.assertEqual(lat.tolist(), list(range(100)))
+        self.assertEqual(lng.tolist(), [28] * 100)
@@ -0,0 +1,155 @@
+import asyncio
+import tempfile
+import unittest
+
+import lmdb
+
+from route_view.async_exit_stack import AsyncExitStack
+from route_view.jobs import ProcessingQueue
+from route_view.tests import unittest_run_loop
+
+
+class QueueTestRoute(object):
+    """Just enough of a Route for ProcessingQueue. Processing waits for ``finish`` to be set."""
+
+    def __init__(self, id, processed):
+        self.id = id
+        self.processed = processed
+        self.process_task = None
+        self.finish = asyncio.Event()
+
+    async def ensure_data_loaded(self):
+        pass
+
+    async def start_processing(self):
+        self.process_task = asyncio.ensure_future(self.process())
+        self.process_task.add_done_callback(self.process_task_done_callback)
+
+    def process_task_done_callback(self, fut):
+        self.process_task = None
+
+    async def process(self):
+        self.processed.append(self.id)
+        try:
+            await self.finish.wait()
+        except asyncio.CancelledError:
+            self.processed.append(self.id + ' cancelled')
+
+
+class TestProcessingQueue(unittest.TestCase):
+
+    async def make_lmdb_env(self, stack):
+        lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+        return await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10))
+
+    def make_routes(self):
+        processed = []
+        routes = {}
+
+        async def load_route(route_id):
+            if route_id not in routes:
+                routes[route_id] = QueueTestRoute(route_id, processed)
+            return routes[route_id]
+
+        return processed, routes, load_route
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Timed out.')
+
+    @unittest_run_loop
+    async def test_resumes_after_restart(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            processed, routes, load_route = self.make_routes()
+
+            async with ProcessingQueue(lmdb_env, load_route, concurrency=1) as queue:
+                await queue.enqueue('a')
+                await queue.enqueue('b')
+                await self.wait_for(lambda: processed == ['a'])
+                self.assertEqual(queue.stats(), {'concurrency': 1, 'waiting': 1, 'running': 1})
+            self.assertEqual(processed, ['a', 'a cancelled'])
+
+            processed, routes, load_route = self.make_routes()
+            async with ProcessingQueue(lmdb_env, load_route, concurrency=1) as queue:
+                await self.wait_for(lambda: processed == ['a'])
+                routes['a'].finish.set()
+                await self.wait_for(lambda: processed == ['a', 'b'])
+                routes['b'].finish.set()
+                await self.wait_for(lambda: not queue.running)
+            with lmdb_env.begin() as tx:
+                self.assertEqual(tx.stat(queue.jobs_db)['entries'], 0)
+
+    @unittest_run_loop
+    async def test_remove(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            processed, routes, load_route = self.make_routes()
+            async with ProcessingQueue(lmdb_env, load_route, concurrency=1) as queue:
+                await queue.enqueue('a')
+                await queue.enqueue('b')
+                self.assertTrue(await queue.remove('b'))
+                self.assertFalse(await queue.remove('b'))
+                await self.wait_for(lambda: processed == ['a'])
+                routes['a'].finish.set()
+                await self.wait_for(lambda: not queue.running)
+                self.assertEqual(processed, ['a'])
+
+    @unittest_run_loop
+    async def test_rerun(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            processed, routes, load_route = self.make_routes()
+            async with ProcessingQueue(lmdb_env, load_route, concurrency=1) as queue:
+                await queue.enqueue('a')
+                await self.wait_for(lambda: processed == ['a'])
+                # Cancelled and resumed, like Route.add_pano_chain_item does.
+                routes['a'].process_task.cancel()
+                await queue.enqueue('a')
+                await self.wait_for(lambda: processed == ['a', 'a cancelled', 'a'])
+                routes['a'].finish.set()
+                await self.wait_for(lambda: not queue.running)
+
+    @unittest_run_loop
+    async def test_claims_shared(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            processed1, routes1, load_route1 = self.make_routes()
+            processed2, routes2, load_route2 = self.make_routes()
+            queue1 = await stack.enter_context(ProcessingQueue(lmdb_env, load_route1, generation='g', poll_interval=0.01))
+            queue2 = await stack.enter_context(ProcessingQueue(lmdb_env, load_route2, generation='g', poll_interval=0.01))
+
+            await queue1.enqueue('a')
+            await self.wait_for(lambda: processed1 == ['a'])
+            self.assertTrue(await queue2.claimed_elsewhere('a'))
+            self.assertFalse(await queue1.claimed_elsewhere('a'))
+            # Polled by queue2, but claimed by queue1.
+            await asyncio.sleep(0.05)
+            self.assertEqual(processed2, [])
+
+            await queue1.enqueue('b')
+            await self.wait_for(lambda: 'b' in processed1 + processed2)
+            routes1['a'].finish.set()
+            for routes in (routes1, routes2):
+                if 'b' in routes:
+                    routes['b'].finish.set()
+            await self.wait_for(lambda: not queue1.running and not queue2.running)
+            self.assertEqual(processed1.count('b') + processed2.count('b'), 1)
+
+    @unittest_run_loop
+    async def test_claim_from_previous_generation(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            processed, routes, load_route = self.make_routes()
+            old_queue = ProcessingQueue(lmdb_env, load_route, generation='old')
+            await asyncio.get_event_loop().run_in_executor(None, old_queue._put_job, 'a')
+            self.assertTrue(await asyncio.get_event_loop().run_in_executor(None, old_queue._claim_job, 'a'))
+
+            async with ProcessingQueue(lmdb_env, load_route, generation='new') as queue:
+                self.assertFalse(await queue.claimed_elsewhere('a'))
+                await self.wait_for(lambda: processed == ['a'])
+                routes['a'].finish.set()
+                await self.wait_for(lambda: not queue.running)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import msgpack
+import numpy
+
+from route_view.core import Point
+from route_view.pano_log import Block, encode_block, file_header, file_magic, format_version, PanoLog
+
+
+def make_panos(n, start=0):
+    panos = []
+    for i in range(start, start + n):
+        if i % 5 == 4:
+            panos.append({'type': 'no_images', 'start_point': Point(-26.1, 28.0 + i / 1000), 'start_route_index': i,
+                          'start_dist_from': 1.5, 'point': Point(-26.2, 28.0 + i / 1000), 'at_dist': i * 10.0,
+                          'prev_route_index': i})
+        else:
+            panos.append({'type': 'pano', 'id': 'A' * 21 + 'Q', 'point': Point(-26.1, 28.0 + i / 1000),
+                          'original_point': Point(-26.11, 28.01), 'description': 'Street {} é'.format(i),
+                          'prev_route_index': i, 'heading': 90.5, 'at_dist': i * 10.0, 'dist_from_last': 10.0})
+    return panos
+
+
+def write_panos_bin(path, *pano_blocks):
+    """Write a panos.bin, as routes saved as files had, with a block for each of pano_blocks."""
+    with open(path, 'wb') as f:
+        f.write(file_header.pack(file_magic, format_version))
+        for panos in pano_blocks:
+            f.write(encode_block(panos))
+
+
+class TestPanoLog(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir_route = tmp.name
+        self.log = PanoLog(self.dir_route, Point)
+
+    def test_block_round_trip(self):
+        panos = make_panos(20)
+        # Values that don't fit the schema.
+        panos[1]['id'] = 'not a pano id'
+        panos[2]['last'] = True
+        panos[3]['heading'] = None
+        panos[6]['something_new'] = {'a': [1, 2]}
+        panos[7]['prev_route_index'] = numpy.int64(7)
+
+        block = Block(encode_block(panos), 0)
+        self.assertEqual(block.decode(Point), panos)
+        self.assertEqual(block.decode(Point, [2, 5]), [panos[2], panos[5]])
+        self.assertEqual(block.index_entry(3), (3, 20, 0.0, 190.0))
+
+    def test_read_blocks(self):
+        panos = make_panos(30)
+        self.assertFalse(self.log.exists())
+        write_panos_bin(self.log.bin_path, panos[:10], panos[10:20], panos[20:])
+        self.assertTrue(self.log.exists())
+        blocks = self.log.read_blocks()
+        self.assertEqual([pano for block in blocks for pano in Block(block, 0).decode(Point)], panos)
+
+        # Killed part way through writing a block.
+        with open(self.log.bin_path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.log.bin_path) - 10)
+        self.assertEqual(self.log.read_blocks(), blocks[:2])
+
+    def test_read_old(self):
+        panos = make_panos(12)
+
+        def encode(obj):
+            if isinstance(obj, Point):
+                return (obj.lat, obj.lng)
+
+        with open(self.log.old_path, 'wb') as f:
+            for pano in panos:
+                msgpack.pack(pano, f, default=encode)
+
+        self.assertEqual(self.log.read_old(), panos)
@@ -0,0 +1,75 @@
+import contextlib
+import json
+import os
+import tempfile
+import unittest
+
+import lmdb
+import msgpack
+
+from route_view.core import Point
+from route_view.route_store import RouteStore
+from route_view.tests.test_pano_log import make_panos, write_panos_bin
+
+
+class TestRouteStore(unittest.TestCase):
+
+    def setUp(self):
+        stack = contextlib.ExitStack()
+        self.addCleanup(stack.close)
+        self.tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+        lmdb_env = stack.enter_context(lmdb.open(os.path.join(self.tempdir, 'lmdb'), max_dbs=10))
+        self.store = RouteStore(lmdb_env)
+
+    def test_save_load(self):
+        self.store.save('a', 'meta', {'name': 'Route A', 'owner': None, 'private': True})
+        self.store.save('b', 'meta', {'name': 'Route B', 'owner': None, 'private': True})
+        self.store.save('a', 'route', {'route_points': [Point(-26.1, 28.0)], 'pano_chain': {}},
+                        default=lambda obj: (obj.lat, obj.lng))
+
+        self.assertEqual(self.store.load('a', 'meta')['name'], 'Route A')
+        self.assertEqual(self.store.load('a', 'route'), {'route_points': [[-26.1, 28.0]], 'pano_chain': {}})
+        self.assertTrue(self.store.has_route('b'))
+        self.assertFalse(self.store.has_route('c'))
+        self.assertEqual(self.store.route_ids(), ['a', 'b'])
+        with self.assertRaises(KeyError):
+            self.store.load('b', 'route')
+
+    def test_panos(self):
+        panos = make_panos(30)
+        for i in range(0, 30, 10):
+            self.store.save_processing('a', {'processing_complete': i == 20}, panos[i:i + 10])
+        self.store.save_processing('a', {'processing_complete': True}, [])
+        self.store.save_processing('b', {'processing_complete': False}, make_panos(5))
+
+        self.assertEqual(self.store.load('a', 'status'), {'processing_complete': True})
+        self.assertEqual(self.store.load_panos('a', Point), panos)
+        self.assertEqual(self.store.load_panos_window('a', 95, 205, Point), panos[10:21])
+
+        self.store.clear_panos('a')
+        self.assertEqual(self.store.load_panos('a', Point), [])
+        self.assertEqual(self.store.load_panos('b', Point), make_panos(5))
+
+    def test_import_dir(self):
+        panos = make_panos(12)
+        for old_format in (True, False):
+            dir_route = os.path.join(self.tempdir, 'route_{}'.format(old_format))
+            os.mkdir(dir_route)
+            with open(os.path.join(dir_route, 'meta.json'), 'w') as f:
+                json.dump({'name': 'Route', 'owner': 'user', 'private': False}, f)
+            with open(os.path.join(dir_route, 'route.pack'), 'wb') as f:
+                msgpack.pack({'route_points': [[-26.1, 28.0]], 'route_bounds': None, 'pano_chain': {}}, f)
+            with open(os.path.join(dir_route, 'status.json'), 'w') as f:
+                json.dump({'processing_complete': True, 'processing_status': {}}, f)
+            if old_format:
+                with open(os.path.join(dir_route, 'panos.pack'), 'wb') as f:
+                    for pano in panos:
+                        msgpack.pack(pano, f, default=lambda obj: (obj.lat, obj.lng))
+            else:
+                write_panos_bin(os.path.join(dir_route, 'panos.bin'), panos[:5], panos[5:])
+
+            self.store.import_dir('r', dir_route, Point)
+            self.assertEqual(self.store.load('r', 'meta'), {'name': 'Route', 'owner': 'user', 'private': False})
+            self.assertEqual(self.store.load('r', 'route')['route_points'], [[-26.1, 28.0]])
+            self.assertEqual(self.store.load('r', 'status')['processing_complete'], True)
+            self.assertEqual(self.store.load_panos('r', Point), panos)
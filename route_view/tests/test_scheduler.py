@@ -0,0 +1,91 @@
+import asyncio
+import tempfile
+import unittest
+
+import lmdb
+
+from route_view.async_exit_stack import AsyncExitStack
+from route_view.scheduler import ApiQuotaExceeded, ApiScheduler, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from route_view.tests import unittest_run_loop
+
+
+class TestApiScheduler(unittest.TestCase):
+
+    async def make_lmdb_env(self, stack):
+        lmdbtempdir = await stack.enter_context(tempfile.TemporaryDirectory())
+        return await stack.enter_context(lmdb.open(lmdbtempdir, max_dbs=10))
+
+    async def granted_order(self, scheduler, requests):
+        order = []
+
+        async def request(name, client, priority):
+            await scheduler.acquire(client, priority)
+            order.append(name)
+
+        await asyncio.gather(*(request(*item) for item in requests))
+        return order
+
+    @unittest_run_loop
+    async def test_fair_and_prioritised(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            scheduler = await stack.enter_context(ApiScheduler(lmdb_env, rate=1000, burst=1))
+            # Use the burst, so that everything after this has to wait it's turn.
+            await scheduler.acquire()
+
+            order = await self.granted_order(scheduler, [
+                ('a1', 'a', PRIORITY_BACKGROUND),
+                ('a2', 'a', PRIORITY_BACKGROUND),
+                ('a3', 'a', PRIORITY_BACKGROUND),
+                ('b1', 'b', PRIORITY_BACKGROUND),
+                ('b2', 'b', PRIORITY_BACKGROUND),
+                ('img', None, PRIORITY_INTERACTIVE),
+            ])
+            self.assertEqual(order, ['img', 'a1', 'b1', 'a2', 'b2', 'a3'])
+            stats = scheduler.stats()
+            self.assertEqual(stats['interactive_requests'], 1)
+            self.assertEqual(stats['background_requests'], 6)
+            self.assertEqual(stats['waiting_background'], 0)
+
+    @unittest_run_loop
+    async def test_rate_limit(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            scheduler = await stack.enter_context(ApiScheduler(lmdb_env, rate=100, burst=5))
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            await self.granted_order(scheduler, [(i, None, PRIORITY_BACKGROUND) for i in range(15)])
+            # 5 straight away, then 10 at 100 / second.
+            self.assertGreaterEqual(loop.time() - start, 0.09)
+
+    @unittest_run_loop
+    async def test_daily_quota(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            async with ApiScheduler(lmdb_env, daily_quota=3) as scheduler:
+                await scheduler.acquire()
+                await scheduler.acquire()
+
+            # Quota used is kept across restarts.
+            async with ApiScheduler(lmdb_env, daily_quota=3) as scheduler:
+                self.assertEqual(scheduler.stats()['quota_used'], 2)
+                await scheduler.acquire()
+                with self.assertRaises(ApiQuotaExceeded):
+                    await scheduler.acquire()
+
+    @unittest_run_loop
+    async def test_daily_quota_shared(self):
+        async with AsyncExitStack() as stack:
+            lmdb_env = await self.make_lmdb_env(stack)
+            scheduler1 = await stack.enter_context(ApiScheduler(lmdb_env, daily_quota=3))
+            scheduler2 = await stack.enter_context(ApiScheduler(lmdb_env, daily_quota=3))
+            await scheduler1.acquire()
+            await scheduler2.acquire()
+            await scheduler1.save()
+            await scheduler2.save()
+            await scheduler1.save()
+            self.assertEqual(scheduler1.quota_used, 2)
+            self.assertEqual(scheduler2.quota_used, 2)
+            await scheduler1.acquire()
+            with self.assertRaises(ApiQuotaExceeded):
+                await scheduler1.acquire()
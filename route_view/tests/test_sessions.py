@@ -0,0 +1,96 @@
+import asyncio
+import collections
+import json
+import unittest
+
+import msgpack
+
+from route_view.core import Point
+from route_view.sessions import EncodedChange, RouteSession
+from route_view.tests import unittest_run_loop
+
+
+class SlowWs(object):
+    """Records what is sent. Sends wait for ``release`` to be set."""
+
+    def __init__(self):
+        self.sent = []
+        self.release = asyncio.Event()
+        self.closed_with = None
+
+    async def send_str(self, data):
+        await self.release.wait()
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        await self.release.wait()
+        self.sent.append(msgpack.loads(data, raw=False))
+
+    async def close(self, code=None, message=None):
+        self.closed_with = code
+
+
+def status(text):
+    return EncodedChange({'processing_complete': False, 'processing_status': {'text': text}})
+
+
+class TestRouteSession(unittest.TestCase):
+
+    @unittest_run_loop
+    async def test_send(self):
+        for binary in (False, True):
+            ws = SlowWs()
+            ws.release.set()
+            async with RouteSession(ws, binary) as session:
+                session.send(EncodedChange({'panos': [{'point': Point(-26.1, 28.0), 'at_dist': 1.5}]}))
+                session.send(status('Done'))
+                await asyncio.sleep(0.01)
+            self.assertEqual(ws.sent, [
+                {'panos': [{'point': {'lat': -26.1, 'lng': 28.0}, 'at_dist': 1.5}]},
+                {'processing_complete': False, 'processing_status': {'text': 'Done'}},
+            ])
+
+    @unittest_run_loop
+    async def test_slow_session(self):
+        ws = SlowWs()
+        stats = collections.Counter()
+        async with RouteSession(ws, max_pending=4, stats=stats) as session:
+            session.send(EncodedChange({'panos': [1]}))
+            await asyncio.sleep(0.01)
+            # The first is being sent. The rest wait.
+            session.send(status('1'))
+            session.send(EncodedChange({'panos': [2]}))
+            session.send(EncodedChange({'segment_panos': [10], 'segment': 1}))
+            session.send(status('2'))
+            session.send(EncodedChange({'segment_panos': [11], 'segment': 1}))
+            self.assertEqual(len(session.pending), 4)
+            session.send(EncodedChange({'panos': [3]}))
+            self.assertEqual(stats, {'coalesced': 1, 'dropped': 2})
+            ws.release.set()
+            await asyncio.sleep(0.01)
+
+        self.assertEqual(ws.sent, [
+            {'panos': [1]},
+            {'panos': [2]},
+            {'processing_complete': False, 'processing_status': {'text': '2'}},
+            {'panos': [3]},
+        ])
+        self.assertIsNone(ws.closed_with)
+
+    @unittest_run_loop
+    async def test_disconnect_lagging(self):
+        ws = SlowWs()
+        async with RouteSession(ws, max_pending=2) as session:
+            for i in range(4):
+                session.send(EncodedChange({'panos': [i]}))
+            await asyncio.sleep(0.01)
+            self.assertTrue(session.closed)
+            self.assertIsNotNone(ws.closed_with)
+
+        ws = SlowWs()
+        stats = collections.Counter()
+        async with RouteSession(ws, send_timeout=0.05, stats=stats) as session:
+            session.send(EncodedChange({'panos': [1]}))
+            await asyncio.sleep(0.1)
+            self.assertTrue(session.closed)
+        self.assertEqual(stats, {'disconnected': 1})
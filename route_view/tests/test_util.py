@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+
+from route_view.tests import unittest_run_loop
+from route_view.util import iter_prefetched
+
+
+class TestIterPrefetched(unittest.TestCase):
+
+    @unittest_run_loop
+    async def test_iter_prefetched(self):
+        started = []
+
+        async def fetch(item):
+            started.append(item)
+            # Later items finish first.
+            await asyncio.sleep(0.01 * (5 - item))
+            return item * 10
+
+        results = []
+        prefetched = iter_prefetched(range(5), fetch, 3)
+        async for item, result in prefetched:
+            results.append((item, result))
+            if item == 0:
+                self.assertEqual(started, [0, 1, 2])
+        self.assertEqual(results, [(0, 0), (1, 10), (2, 20), (3, 30), (4, 40)])
+
+    @unittest_run_loop
+    async def test_iter_prefetched_close_cancels(self):
+        cancelled = []
+
+        async def fetch(item):
+            try:
+                await asyncio.sleep(0.01 + item * 0.05)
+            except asyncio.CancelledError:
+                cancelled.append(item)
+                raise
+            return item
+
+        prefetched = iter_prefetched(range(10), fetch, 4)
+        async for item, result in prefetched:
+            break
+        await prefetched.aclose()
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [1, 2, 3])
@@ -1,5 +1,7 @@
 import asyncio
 import base64
+import collections
+import contextlib
 import functools
 import uuid
 
@@ -14,6 +16,39 @@ def runs_in_executor(fn):
     return runs_in_executor_inner
 
 
+async def iter_prefetched(items, fetch, depth):
+    """Yield ``(item, await fetch(item))`` for each of items, in order, with up to ``depth`` fetches running ahead.
+
+    Fetches that are still running when the generator is closed are cancelled, so always ``aclose()`` it if not
+    iterating to the end.
+    """
+    items = iter(items)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                pending.append((item, asyncio.ensure_future(fetch(item))))
+            if not pending:
+                return
+            item, fut = pending.popleft()
+            yield item, await fut
+    finally:
+        for item, fut in pending:
+            fut.cancel()
+
+
+async def cancel_and_wait(task):
+    """Cancel task (if not None,) and wait for it to finish. What it raises is ignored."""
+    if task is not None:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await task
+
+
 def mk_id():
     return id_encode(uuid.uuid4().bytes).decode('ascii')
 
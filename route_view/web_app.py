@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import contextlib
 import hashlib
@@ -5,10 +6,9 @@ import io
 import json
 import logging
 import os
-from collections import defaultdict
+from collections import Counter, defaultdict
 from functools import partial
 
-import attr
 import lmdb
 import pkg_resources
 from aiohttp import web, WSMsgType
@@ -18,16 +18,22 @@ from slugify import slugify
 
 import route_view.auth
 from route_view.async_exit_stack import AsyncExitStack
-from route_view.core import Point, Route
+from route_view.cluster import ClusterClient
+from route_view.core import GpxError, Point, Route, route_detail_levels
+from route_view.geometry_pool import GeometryPool
+from route_view.jobs import ProcessingQueue
+from route_view.route_store import RouteStore
+from route_view.sessions import EncodedChange, RouteSession
 from route_view.util import mk_id
 
 
-async def make_aio_app(settings):
+async def make_aio_app(settings, cluster_sock=None):
     app = web.Application()
     app['route_view.settings'] = settings
     app['route_view.static_etags'] = {}
     app['route_view.routes'] = {}
     app['route_view.routes_sessions'] = defaultdict(list)
+    app['route_view.session_stats'] = Counter()
 
     add_static = partial(add_static_resource, app)
     add_static('static/view.js', '/static/view.js', content_type='application/javascript', charset='utf8',)
@@ -43,6 +49,7 @@ async def make_aio_app(settings):
     app.router.add_route('GET', '/route_sock/{route_id}/', handler=route_ws, name='route_ws')
     app.router.add_route('GET', '/view/{route_id}/', handler=partial(route_view_handler, route_view_static), name='route_view')
     app.router.add_route('GET', '/img/{pano_id_and_heading}', handler=img_handler, name='img')
+    app.router.add_route('GET', '/stats', handler=stats_handler, name='stats')
 
     route_view.auth.config_aio_app(app, settings)
 
@@ -52,11 +59,42 @@ async def make_aio_app(settings):
 
     with contextlib.suppress(FileExistsError):
         os.mkdir(settings['data_path'])
-    with contextlib.suppress(FileExistsError):
-        os.mkdir(os.path.join(settings['data_path'], 'routes'))
 
     lmdb_env = await app_stack.enter_context(lmdb.open(settings['lmdb_path'], max_dbs=10, map_size=settings['lmdb_map_size']))
-    app['route_view.google_api'] = await app_stack.enter_context(route_view.core.GoogleApi(settings['api_key'], lmdb_env))
+    app['route_view.route_store'] = RouteStore(lmdb_env)
+    app['route_view.google_api'] = await app_stack.enter_context(route_view.core.GoogleApi(
+        settings['api_key'], lmdb_env,
+        ll_cache_ttl=settings['ll_cache_ttl'], ll_cache_negative_ttl=settings['ll_cache_negative_ttl'],
+        prefer_local_ll=settings['prefer_local_ll'],
+        img_cache_max_bytes=settings['img_cache_max_bytes'], img_cache_policy=settings['img_cache_policy'],
+        write_buffer_max_items=settings['write_buffer_max_items'], write_buffer_max_bytes=settings['write_buffer_max_bytes'],
+        pano_data_cache_max_entries=settings['pano_data_cache_max_entries'],
+        pano_data_cache_max_bytes=settings['pano_data_cache_max_bytes'],
+        rate_limit=settings['api_rate_limit'], rate_burst=settings['api_rate_burst'], daily_quota=settings['api_daily_quota'],
+        request_timeout=settings['api_request_timeout'], retries=settings['api_retries'],
+        retry_base_delay=settings['api_retry_base_delay'], retry_max_delay=settings['api_retry_max_delay'],
+        hedge_delay=settings['api_hedge_delay'], circuit_breaker_failures=settings['api_circuit_breaker_failures'],
+        circuit_breaker_reset=settings['api_circuit_breaker_reset'],
+        connection_limit=settings['api_connection_limit'], connection_limit_per_host=settings['api_connection_limit_per_host'],
+        keepalive_timeout=settings['api_keepalive_timeout'], dns_cache_ttl=settings['api_dns_cache_ttl'],
+        connect_timeout=settings['api_connect_timeout'], read_timeout=settings['api_read_timeout'],
+        img_cache_evict=settings.get('worker_index', 0) == 0, img_cache_shared=settings.get('workers', 1) > 1))
+
+    # When running as one of several worker processes, route changes and commands are passed between the workers.
+    if cluster_sock:
+        app['route_view.cluster'] = await app_stack.enter_context(
+            ClusterClient(cluster_sock, partial(handle_cluster_message, app)))
+    else:
+        app['route_view.cluster'] = None
+
+    if settings['geometry_processes']:
+        app['route_view.geometry_pool'] = await app_stack.enter_context(GeometryPool(settings['geometry_processes']))
+    else:
+        app['route_view.geometry_pool'] = None
+
+    app['route_view.processing_queue'] = await app_stack.enter_context(ProcessingQueue(
+        lmdb_env, partial(load_route, app), concurrency=settings['processing_concurrency'],
+        generation=settings.get('cluster_generation')))
 
     return app
 
@@ -127,38 +165,73 @@ def add_static_resource(app, resource_name, route, *args, **kwargs):
 
 async def upload_route(request):
     app = request.app
-    data = await request.post()
-    upload_file = data['gpx'].file.read()
-    name = data['gpx'].filename
     user = await route_view.auth.get_user_or_login(request)
 
+    # Read the multipart body as a stream, rather than with request.post(), which would read all of it into memory.
+    reader = await request.multipart()
+    field = await reader.next()
+    while field is not None and field.name != 'gpx':
+        field = await reader.next()
+    if field is None:
+        raise web.HTTPBadRequest(text='No GPX file uploaded.')
+    name = field.filename
+
     route_id = mk_id()
-    route_dir_route = os.path.join(app['route_view.settings']['data_path'], 'routes', route_id)
-    os.mkdir(route_dir_route)
     route = Route(
-        id=route_id, name=name, dir_route=route_dir_route,
-        change_callback=partial(change_callback, request.app['route_view.routes_sessions'][route_id]),
-        google_api=app['route_view.google_api'], owner=user.id)
+        id=route_id, name=name, store=app['route_view.route_store'],
+        change_callback=partial(change_callback, app, route_id),
+        google_api=app['route_view.google_api'], owner=user.id,
+        pipeline_depth=app['route_view.settings']['processing_pipeline_depth'],
+        processing_queue=app['route_view.processing_queue'],
+        checkpoint_interval=app['route_view.settings']['processing_checkpoint_interval'],
+        geometry_pool=app['route_view.geometry_pool'],
+        segments=app['route_view.settings']['processing_segments'],
+        min_segment_length=app['route_view.settings']['processing_min_segment_length'])
+    try:
+        await route.load_route_from_upload(read_upload(field, app['route_view.settings']['upload_max_bytes']))
+    except GpxError as e:
+        raise web.HTTPBadRequest(text=str(e))
     app['route_view.routes'][route_id] = route
-    await route.load_route_from_upload(upload_file)
     await route.save_metadata()
-    await route.start_processing()
-    user = await route_view.auth.get_user_or_login(request)
+    await route.resume_processing()
     user.routes.append(route_id)
     await user.save()
     return web.HTTPFound('/view/{}/'.format(route_id))
 
 
+async def read_upload(field, max_bytes, chunk_size=262144):
+    """Yield chunks of an uploaded multipart field. Raises HTTPRequestEntityTooLarge if it is more than max_bytes."""
+    size = 0
+    while True:
+        chunk = await field.read_chunk(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_bytes, actual_size=size)
+        yield chunk
+
+
 async def load_route(app, route_id):
     route = app['route_view.routes'].get(route_id)
     if route is None:
-        route_dir_route = os.path.join(app['route_view.settings']['data_path'], 'routes', route_id)
-        try:
-            route = await (Route.load(route_id, route_dir_route, partial(change_callback, app['route_view.routes_sessions'][route_id])))
-        except FileNotFoundError as e:
-            raise KeyError() from e
+        store = app['route_view.route_store']
+        loop = asyncio.get_event_loop()
+        if not await loop.run_in_executor(None, store.has_route, route_id):
+            # Saved before routes were stored in lmdb.
+            route_dir_route = os.path.join(app['route_view.settings']['data_path'], 'routes', route_id)
+            if os.path.isdir(route_dir_route):
+                await loop.run_in_executor(None, store.import_dir, route_id, route_dir_route, Point)
+                logging.info('Imported route {} from {}.'.format(route_id, route_dir_route))
+        route = await (Route.load(route_id, store, partial(change_callback, app, route_id)))
 
         route.google_api = app['route_view.google_api']
+        route.pipeline_depth = app['route_view.settings']['processing_pipeline_depth']
+        route.processing_queue = app['route_view.processing_queue']
+        route.checkpoint_interval = app['route_view.settings']['processing_checkpoint_interval']
+        route.geometry_pool = app['route_view.geometry_pool']
+        route.segments = app['route_view.settings']['processing_segments']
+        route.min_segment_length = app['route_view.settings']['processing_min_segment_length']
         app['route_view.routes'][route_id] = route
     return route
 
@@ -208,61 +281,138 @@ async def route_view_handler(route_view_static, request):
 async def route_ws(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    # Clients that want changes as binary msgpack messages, rather than json text, ask with ?protocol=msgpack.
+    binary = request.query.get('protocol') == 'msgpack'
+    have = client_has(request.query)
+    settings = request.app['route_view.settings']
 
     route_id = request.match_info['route_id']
     route = await load_route(request.app, route_id)
 
     if not await request_has_access_to_route(request, route):
-        await ws.send_str(json.dumps({'error': 'no permission'}))
+        error = EncodedChange({'error': 'no permission'})
+        await (ws.send_bytes(error.msgpack) if binary else ws.send_str(error.json))
         await ws.close()
         return ws
 
     await route.ensure_data_loaded()
 
     route_sessions = request.app['route_view.routes_sessions'][route_id]
-    route_sessions.append(ws)
-
-    # Send initial data.
-    await ws.send_str(json.dumps({'api_key': request.app['route_view.google_api'].api_key}))
-    for msg in route.get_existing_changes():
-        await ws.send_str(json.dumps(msg, default=json_encode))
+    session = RouteSession(ws, binary, max_pending=settings['session_max_pending'],
+                           send_timeout=settings['session_send_timeout'], stats=request.app['route_view.session_stats'])
+    async with session:
+        session.send(EncodedChange({'api_key': request.app['route_view.google_api'].api_key}))
+
+        cluster = request.app['route_view.cluster']
+        existing_changes = None
+        if cluster and not route.process_task and await request.app['route_view.processing_queue'].claimed_elsewhere(route_id):
+            # What we have loaded is only up to the last save, so get the current state from the process processing
+            # it. Changes after the reply are held back until we have added this session.
+            try:
+                async with cluster.request({'route_id': route_id, 'get_existing_changes': have}) as existing_changes:
+                    for packed in existing_changes:
+                        session.send(EncodedChange.from_msgpack(packed))
+                    route_sessions.append(session)
+            except asyncio.TimeoutError:
+                logging.warning('No reply to get_existing_changes for route {}.'.format(route_id))
+                existing_changes = None
+
+        if existing_changes is None:
+            saved_panos_count = None if route.panos_loaded else await route.load_panos_count()
+            route_sessions.append(session)
+            for change in route.get_existing_changes(saved_panos_count=saved_panos_count, **have):
+                session.send(EncodedChange(change))
 
-    try:
-        async for msg in ws:
-            if msg.type == WSMsgType.text:
-                data = json.loads(msg.data)
-                # logging.debug(data)
-                if data == 'cancel':
-                    await route.cancel_processing()
-                if data == 'resume':
-                    await route.resume_processing()
-                if isinstance(data, dict) and 'add_pano_chain_item' in data:
-                    await route.add_pano_chain_item(*data['add_pano_chain_item'])
-            if msg.type == WSMsgType.close:
-                await ws.close()
-            if msg.type == WSMsgType.error:
-                raise ws.exception()
-    finally:
-        route_sessions.remove(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.text:
+                    data = json.loads(msg.data)
+                    # logging.debug(data)
+                    if isinstance(data, dict) and 'get_panos_window' in data:
+                        # Saved panos for a distance range, just for this session.
+                        start_dist, end_dist = data['get_panos_window']
+                        panos = await route.load_panos_window(start_dist, end_dist)
+                        session.send(EncodedChange({'panos_window': [start_dist, end_dist], 'panos': panos}))
+                    elif isinstance(data, dict) and 'get_route_level' in data:
+                        # More detailed route points, for when zoomed in.
+                        level = data['get_route_level']
+                        # Not 1.0 or true, which are in the range, but are not levels.
+                        is_level = isinstance(level, int) and not isinstance(level, bool) and level in range(len(route_detail_levels))
+                        if route.route_points and is_level:
+                            session.send(EncodedChange(route.route_points_change(level)))
+                    elif cluster and not route.process_task and await request.app['route_view.processing_queue'].claimed_elsewhere(route_id):
+                        await cluster.publish({'route_id': route_id, 'command': data})
+                    else:
+                        await route_command(route, data)
+                if msg.type == WSMsgType.close:
+                    await ws.close()
+                if msg.type == WSMsgType.error:
+                    raise ws.exception()
+        finally:
+            route_sessions.remove(session)
     return ws
 
 
-async def change_callback(route_sessions, change):
-    msg = json.dumps(change, default=json_encode)
-    # logging.debug(str(change)[:120])
+def client_has(query):
+    """What a reconnecting client says it has, from the route_ws query string, as get_existing_changes kwargs."""
+    have = {}
+    with contextlib.suppress(KeyError, ValueError):
+        have['route_version'] = query['route_version']
+    with contextlib.suppress(KeyError, ValueError):
+        have['panos_epoch'] = int(query['panos_epoch'])
+        have['panos_count'] = int(query['panos_count'])
+    return have
+
+
+async def route_command(route, data):
+    if data == 'cancel':
+        await route.cancel_processing()
+    if data == 'resume':
+        await route.resume_processing()
+    if isinstance(data, dict) and 'add_pano_chain_item' in data:
+        await route.add_pano_chain_item(*data['add_pano_chain_item'])
+
+
+async def change_callback(app, route_id, change):
+    change = EncodedChange(change)
+    # logging.debug(str(change.change)[:120])
+    if app['route_view.cluster']:
+        await app['route_view.cluster'].publish({'route_id': route_id, 'change': change.msgpack})
+    send_to_route_sessions(app['route_view.routes_sessions'][route_id], change)
+
+
+def send_to_route_sessions(route_sessions, change):
+    # Only queues the change, so that processing does not wait for clients.
     for session in route_sessions:
-        try:
-            await session.send_str(msg)
-        except Exception:
-            logging.exception('Error sending to client: ')
+        session.send(change)
 
 
-point_json_attrs = {'lat', 'lng'}
+async def handle_cluster_message(app, msg):
+    route_id = msg['route_id']
+    route = app['route_view.routes'].get(route_id)
+    processing_here = route is not None and route.process_task is not None
+
+    if 'change' in msg:
+        change = EncodedChange.from_msgpack(msg['change'])
+        send_to_route_sessions(app['route_view.routes_sessions'][route_id], change)
+        if route is not None and not processing_here:
+            # Keep our copy up to date. It's the one that our sessions and queue jobs have.
+            route.apply_remote_change(change.change)
+
+    if 'get_existing_changes' in msg and processing_here:
+        have = msg['get_existing_changes']
+        await app['route_view.cluster'].reply(msg, [EncodedChange(change).msgpack for change in route.get_existing_changes(**have)])
+
+    if 'command' in msg and processing_here:
+        # Not awaited, so as not to hold up the cluster messages after it.
+        command_task = asyncio.ensure_future(route_command(route, msg['command']))
+        command_task.add_done_callback(route_command_done_callback)
 
 
-def json_encode(obj):
-    if isinstance(obj, Point):
-        return attr.asdict(obj, filter=lambda a, v: a.name in point_json_attrs)
+def route_command_done_callback(fut):
+    with contextlib.suppress(asyncio.CancelledError):
+        if fut.exception():
+            logging.error('Error in route command from cluster:', exc_info=fut.exception())
 
 
 async def img_handler(request):
@@ -281,3 +431,16 @@ async def img_handler(request):
             ('Content-Type', 'image/jpeg'),
             ('ETag', etag),
         ))
+
+
+async def stats_handler(request):
+    user = await route_view.auth.get_user_or_login(request)
+    if not user.admin:
+        raise web.HTTPForbidden()
+    return web.json_response(dict(
+        request.app['route_view.google_api'].stats(),
+        processing_queue=request.app['route_view.processing_queue'].stats(),
+        geometry_pool=request.app['route_view.geometry_pool'].stats() if request.app['route_view.geometry_pool'] else None,
+        sessions=dict(request.app['route_view.session_stats'],
+                      open=sum(len(sessions) for sessions in request.app['route_view.routes_sessions'].values())),
+    ))